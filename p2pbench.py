@@ -0,0 +1,2173 @@
+#encoding=utf-8
+"""
+    side by side benchmark of the proxy engines on loopback. For each
+    server:client engine pair it starts an echo backend, the proxy
+    server and client, and measures stream setup, round trip latency
+    and bulk throughput through the proxy port. gevent sides also
+    report the DATA frames the throughput run cost, read from -stats.
+
+    -latency=B,... times round trips of B byte messages on one
+    connection through each pair.
+
+    -tunnels=N,... echoes streams at once through a pair with N tunnel
+    connections.
+
+    -workers=N,... does the same with N processes on each side.
+
+    -compress=codec,... echoes json and random data through a pair with
+    each codec over a tunnel of limited bandwidth and reports the
+    throughput, the tunnel bytes and the cpu they cost.
+
+    -logging=file,pipe,off churns connections through a pair that logs
+    to a file, to a slowly read pipe or nowhere.
+
+    -decoder=B,... runs the frame parser of p2pproxy.py, and the one it
+    replaced, over B byte DATA frames in one process.
+
+    -fair=N,... times pings on a tunnel session of p2pproxy.py shared
+    with N bulk streams, with and without its write scheduler.
+
+    -slow uploads through each pair into a backend that reads slowly
+    and checks that neither side's memory grows with the backlog.
+
+    -services=N compares N services on one p2pproxy.py pair, one tunnel
+    with a -services table, against N pairs with one -server each.
+
+    -idle=N,... opens N streams through one p2pproxy.py pair, echoes a
+    byte on each and reports the resident memory they cost each side.
+
+    -timers=N,... opens N idle streams the same way and reports how
+    often the timer wheel wakes up while they wait for -streamidle.
+
+    -flap=N echoes one stream through a pair whose tunnel runs over a
+    relay that cuts it N times, with and without -resume, and checks
+    what came back.
+
+    -load=echo,sink,source drives one pair with concurrent connections
+    for a while, with churn if asked, and reports throughput, latency
+    percentiles, connections/s and the cpu and memory of both sides, 
+    as a table or as json lines to keep and compare.
+
+    -loss=P,... compares the round trips of streams over a tcp and a
+    udp tunnel that cross a path losing P percent of the packets.
+
+    -http compares GETs of static assets through a pair with and 
+    without the -http cache, with an HTTP stand-in backend.
+
+    -replay=path plays the streams of a p2pproxy.py -capture file
+    through each pair, at their pace or faster, and reports throughput
+    and the latency of every chunk.
+
+    -shape reads from source backends through a pair with -ratelimit
+    and compares the rates it gets with the configured limits.
+"""
+
+import importlib.util
+import json
+import os
+import random
+import resource
+import selectors
+import shutil
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+def workers_option(spec):
+    """ N of a +workers=N in spec, 1 without """
+    for option in spec.split('+')[1:]:
+        if option.startswith('workers='):
+            return int(option.split('=', 1)[1])
+    return 1
+
+def engine_command(spec, python2):
+    """ spec is an engine name, options may follow: gevent+splice=on """
+    options = spec.split('+')
+    engine = options.pop(0)
+    options = ['-' + o for o in options]
+    if engine == 'gevent':
+        return [python2, os.path.join(HERE, 'p2pproxy.py')] + options
+    if engine in ('asyncio', 'uvloop'):
+        return [sys.executable, os.path.join(HERE, 'p2pproxy3.py'), '-loop=' + engine] + options
+    sys.exit('Unknown engine %r, have gevent, asyncio, uvloop' % engine)
+
+# bytes/s a slow backend takes from each connection
+SLOW_RATE = 400 << 10
+
+def backend_main(kind, ports):
+    """ echo what comes in, sink it, sink it slowly or source data to every connection """
+    import asyncio
+
+    class Echo(asyncio.Protocol):
+        def connection_made(self, transport):
+            self.transport = transport
+
+        def data_received(self, data):
+            self.transport.write(data)
+
+    class Sink(asyncio.Protocol):
+        def data_received(self, data):
+            pass
+
+    class SlowSink(asyncio.Protocol):
+        def connection_made(self, transport):
+            self.transport = transport
+
+        def data_received(self, data):
+            # the next read waits until this one was taken at SLOW_RATE
+            self.transport.pause_reading()
+            loop.call_later(len(data) / SLOW_RATE, self.transport.resume_reading)
+
+    class Source(asyncio.Protocol):
+        block = b'x' * 65536
+
+        def connection_made(self, transport):
+            self.transport = transport
+            self.resume_writing()
+
+        def pause_writing(self):
+            self.paused = True
+
+        def resume_writing(self):
+            self.paused = False
+            while not self.paused and not self.transport.is_closing():
+                self.transport.write(self.block)
+
+    protocol = {'echo': Echo, 'sink': Sink, 'slowsink': SlowSink, 'source': Source}[kind]
+    loop = asyncio.new_event_loop()
+    for port in ports:
+        loop.run_until_complete(loop.create_server(protocol, '127.0.0.1', port))
+    loop.run_forever()
+
+def cpu_time(pid):
+    """ user + system seconds of a process, from /proc """
+    with open('/proc/%d/stat' % pid) as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / float(os.sysconf('SC_CLK_TCK'))
+
+def family(pid):
+    """ pid and the processes it forked, the -workers of a side """
+    with open('/proc/%d/task/%d/children' % (pid, pid)) as f:
+        return [pid] + [int(child) for child in f.read().split()]
+
+def rss(pid):
+    """ resident set size in MB """
+    with open('/proc/%d/status' % pid) as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) / 1024.0
+    return 0.0
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+def recv_exactly(sock, count):
+    got = 0
+    while got < count:
+        data = sock.recv(65536)
+        if not data:
+            raise IOError('connection closed')
+        got += len(data)
+
+def wait_port(port, timeout = 10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return
+        except socket.error:
+            time.sleep(0.1)
+    raise IOError('port %d is not listening' % port)
+
+def wait_echo(port, timeout = 20):
+    """ until a byte makes it through proxy, tunnel and backend """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            sock = socket.create_connection(('127.0.0.1', port), 1)
+            sock.settimeout(2)
+            sock.sendall(b'x')
+            recv_exactly(sock, 1)
+            sock.close()
+            return
+        except (socket.error, IOError):
+            time.sleep(0.2)
+    raise IOError('no echo through port %d' % port)
+
+def scrape(port, name, *labels):
+    """ sum of the -stats samples of name that carry all labels """
+    text = urllib.request.urlopen('http://127.0.0.1:%d/' % port, timeout = 5).read().decode()
+    total = 0.0
+    for line in text.splitlines():
+        if line.startswith(name + '{') and all(label in line for label in labels):
+            total += float(line.rsplit(' ', 1)[1])
+    return total
+
+def tunnel_frames(ports):
+    """ frames both sides wrote to their tunnels, None if one has no -stats """
+    if None in ports:
+        return None
+    return sum(scrape(port, 'p2p_frames_total', 'kind="tunnel"', 'dir="out"') for port in ports)
+
+def setup_time(port, count = 50):
+    """ connect, first 64 byte echo, close """
+    times = []
+    for i in range(count):
+        started = time.time()
+        sock = socket.create_connection(('127.0.0.1', port))
+        sock.sendall(b'x' * 64)
+        recv_exactly(sock, 64)
+        sock.close()
+        times.append(time.time() - started)
+    return percentile(times, .5)
+
+def round_trips(port, count, size = 64):
+    """ seconds of count echoes of size bytes on one connection, after an untimed one """
+    sock = socket.create_connection(('127.0.0.1', port))
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    msg = b'x' * size
+    sock.sendall(msg)
+    recv_exactly(sock, size)
+    times = []
+    for i in range(count):
+        started = time.time()
+        sock.sendall(msg)
+        recv_exactly(sock, size)
+        times.append(time.time() - started)
+    sock.close()
+    return times
+
+def latency(port, count, size = 64):
+    times = round_trips(port, count, size)
+    return percentile(times, .5), percentile(times, .99)
+
+def throughput(port, total, chunk = 65536):
+    sock = socket.create_connection(('127.0.0.1', port))
+    sock.sendall(b'x')
+    recv_exactly(sock, 1)
+    msg = b'x' * chunk
+    reader = threading.Thread(target = recv_exactly, args = (sock, total))
+    started = time.time()
+    reader.start()
+    sent = 0
+    while sent < total:
+        sock.sendall(msg)
+        sent += chunk
+    reader.join()
+    elapsed = time.time() - started
+    sock.close()
+    return total / elapsed / 1e6
+
+def parallel_throughput(port, streams, total):
+    """ streams connections echoing total bytes each at once, MB/s of them all """
+    threads = [threading.Thread(target = throughput, args = (port, total)) for i in range(streams)]
+    started = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return streams * total / (time.time() - started) / 1e6
+
+def stats_option(spec, port):
+    """ only p2pproxy.py serves -stats """
+    if spec.split('+')[0] == 'gevent':
+        return port, ['-stats=127.0.0.1:%d' % port]
+    return None, []
+
+def start_pair(procs, server, client, python2, backend, proxy, p2p, server_args = (),
+        client_args = ()):
+    """ a pair from the proxy port to the backend's, its processes go on procs """
+    procs.append(subprocess.Popen(engine_command(server, python2) + ['-s', '-log=off',
+        '-p2p=127.0.0.1:%d' % p2p, '-server=127.0.0.1:%d' % proxy] + list(server_args),
+        stdout = subprocess.DEVNULL))
+    wait_port(proxy)
+    procs.append(subprocess.Popen(engine_command(client, python2) + ['-c', '-log=off',
+        '-p2p=127.0.0.1:%d' % p2p, '-server=127.0.0.1:%d' % backend] + list(client_args),
+        stdout = subprocess.DEVNULL))
+
+def pair_ports(server, client):
+    """ loopback ports a run_pair takes, a p2p and two stats ports per worker """
+    return 2 + 3 * max(workers_option(server), workers_option(client))
+
+def run_pair(server, client, python2, base, count, total):
+    """
+        Ports: echo base, proxy base + 1, then per worker i server stats
+        base + 2 + i, client stats base + 2 + N + i, p2p base + 2 + 2N + i
+    """
+    workers = max(workers_option(server), workers_option(client))
+    echo_port, proxy_port, p2p_port = base, base + 1, base + 2 + 2 * workers
+    server_stats, server_args = stats_option(server, base + 2)
+    client_stats, client_args = stats_option(client, base + 2 + workers)
+    procs = []
+    try:
+        procs.append(subprocess.Popen([sys.executable, __file__, '-echo=%d' % echo_port]))
+        wait_port(echo_port)
+        start_pair(procs, server, client, python2, echo_port, proxy_port, p2p_port, server_args,
+            client_args)
+        wait_echo(proxy_port)
+
+        setup = setup_time(proxy_port)
+        p50, p99 = latency(proxy_port, count)
+        stats = (server_stats, client_stats)
+        if None not in stats:
+            # every worker serves its own
+            stats = [port + i for port in stats for i in range(workers)]
+        pids = family(procs[1].pid) + family(procs[2].pid)
+        frames = tunnel_frames(stats)
+        cpu = sum(cpu_time(pid) for pid in pids)
+        mbs = throughput(proxy_port, total)
+        cpu = sum(cpu_time(pid) for pid in pids) - cpu
+        if frames is not None:
+            # the data crosses the tunnel once each way, every frame
+            # costs a 12 byte header
+            frames = (tunnel_frames(stats) - frames) / (2.0 * total)
+        return (setup * 1e3, p50 * 1e3, p99 * 1e3, mbs, cpu * (100 << 20) / total, 
+            frames and '%.1f' % (frames * (1 << 20)), frames and '%.3f' % (frames * 12 * 100))
+    finally:
+        for p in procs:
+            p.kill()
+            p.wait()
+
+def sweep_run(server, client, python2, base, option, n, streams, total):
+    """
+        streams echoing total bytes each at once through a pair with
+        -option=n on both sides. Returns MB/s and the cpu seconds of
+        both sides per 100 MB.
+        Ports: echo base, proxy base + 1, p2p base + 2 and up, one per 
+        worker
+    """
+    echo, proxy, p2p = base, base + 1, base + 2
+    args = ['-%s=%d' % (option, n)]
+    procs = []
+    try:
+        procs.append(subprocess.Popen([sys.executable, __file__, '-echo=%d' % echo]))
+        wait_port(echo)
+        start_pair(procs, server, client, python2, echo, proxy, p2p, args, args)
+        # the kernel spreads connections over the workers, each pair
+        # of them has to be up
+        for i in range(4 * n if option == 'workers' else 1):
+            wait_echo(proxy)
+
+        pids = family(procs[1].pid) + family(procs[2].pid)
+        cpu = sum(cpu_time(pid) for pid in pids)
+        mbs = parallel_throughput(proxy, streams, total)
+        cpu = sum(cpu_time(pid) for pid in pids) - cpu
+        return mbs, cpu * (100 << 20) / (streams * total)
+    finally:
+        for p in procs:
+            p.kill()
+            p.wait()
+
+def sweep_main(python2, pairs, option, counts, streams, total, base):
+    """ a sweep_run for every pair and count """
+    width = max([17] + [len(pair) for pair in pairs])
+    print('%-*s %8s %8s %7s %12s' % (width, 'server:client', option, 'streams', 'MB/s', 
+        'cpu s/100MB'))
+    for pair in pairs:
+        server, client = pair.split(':')
+        for n in counts:
+            result = sweep_run(server, client, python2, base, option, n, streams, total)
+            # fresh ports per run, the last run's may still be in TIME_WAIT
+            base += 10 + n
+            print('%-*s %8d %8d %7.1f %12.2f' % ((width, pair, n, streams) + result))
+            sys.stdout.flush()
+
+def latency_main(python2, pairs, sizes, count, base):
+    """
+        count round trips of one connection through each pair for every
+        message size.
+        Ports: echo base, proxy base + 1, p2p base + 2
+    """
+    width = max([17] + [len(pair) for pair in pairs])
+    print('%-*s %7s %8s %8s %9s %8s' % (width, 'server:client', 'bytes', 'p50 ms', 'p99 ms',
+        'p999 ms', 'max ms'))
+    for i, pair in enumerate(pairs):
+        server, client = pair.split(':')
+        # fresh ports per pair, the last pair's may still be in TIME_WAIT
+        echo, proxy, p2p = base + i * 10, base + i * 10 + 1, base + i * 10 + 2
+        procs = []
+        try:
+            procs.append(subprocess.Popen([sys.executable, __file__, '-echo=%d' % echo]))
+            wait_port(echo)
+            start_pair(procs, server, client, python2, echo, proxy, p2p)
+            wait_echo(proxy)
+            for size in sizes:
+                times = round_trips(proxy, count, size)
+                print('%-*s %7d %8.3f %8.3f %9.3f %8.3f' % ((width, pair, size) + tuple(
+                    percentile(times, p) * 1e3 for p in (.5, .99, .999)) + (max(times) * 1e3,)))
+                sys.stdout.flush()
+        finally:
+            for p in procs:
+                p.kill()
+                p.wait()
+
+def run_python2(python2, script, *args):
+    """ script run by python2 next to p2pproxy.py, the json line it prints per result """
+    out = subprocess.check_output([python2, '-c', script] + [str(a) for a in args], cwd = HERE)
+    return [json.loads(line) for line in out.decode().splitlines()]
+
+# python 2: frames/s of the header-then-payload reads FrameDecoder
+# replaced and of FrameDecoder.frames(), over a gevent socketpair
+DECODER_SCRIPT = r'''
+import json, struct, sys, time
+import gevent, gevent.socket
+import p2pproxy
+
+def old_frames(session):
+    """ a read for the header, one or more for the payload, joined """
+    while True:
+        data = session.read(12)
+        if not data:
+            return
+        count, clientid, cmd = struct.unpack('iii', data)
+        data = session.read(count) if count else ''
+        if data is None:
+            return
+        yield clientid, cmd, data
+
+def new_frames(session):
+    return p2pproxy.FrameDecoder(session).frames()
+
+for size in map(int, sys.argv[1].split(',')):
+    frame = struct.pack('iii', size, 1, p2pproxy.P2P_CMD_DATA) + 'x' * size
+    batch = frame * max(1, 65536 // len(frame))
+    rounds = max(10, int(sys.argv[2]) // len(batch))
+    row = {'size': size, 'frames': rounds * len(batch) // len(frame)}
+    for name, frames in (('old', old_frames), ('new', new_frames)):
+        a, b = gevent.socket.socketpair()
+        def write():
+            for i in xrange(rounds):
+                a.sendall(batch)
+            a.close()
+        started = time.time()
+        writer = gevent.spawn(write)
+        got = 0
+        for clientid, cmd, data in frames(p2pproxy.P2pSession(b)):
+            got += len(data)
+        elapsed = time.time() - started
+        writer.join()
+        b.close()
+        if got != rounds * len(batch) // len(frame) * size:
+            sys.exit('%s decoder: %d of %d bytes' % (name, got, rounds * len(batch) // len(frame) * size))
+        row[name] = row['frames'] / elapsed
+    print json.dumps(row)
+    sys.stdout.flush()
+'''
+
+def decoder_main(python2, sizes, total):
+    """ the tunnel frame parsers of p2pproxy.py on total bytes of size byte frames """
+    print('%8s %9s %14s %14s %7s' % ('payload', 'frames', 'old frames/s', 'new frames/s', 'gain'))
+    for row in run_python2(python2, DECODER_SCRIPT, ','.join(map(str, sizes)), total):
+        print('%8d %9d %14.0f %14.0f %6.2fx' % (row['size'], row['frames'], row['old'],
+            row['new'], row['new'] / row['old']))
+
+# python 2: a 64 byte ping queued every 20 ms on a tunnel session
+# whose bulk streams keep their windows full, while the other end of
+# its socketpair drains at the link rate. Its write queue has every
+# frame in one lane (fifo), the FairQueue (fair), and the FairQueue 
+# with the bulk streams a priority level behind the ping (priority)
+FAIR_SCRIPT = r'''
+import json, socket, struct, sys, time
+import gevent, gevent.socket
+from gevent.event import Event
+import p2pproxy
+
+class FifoQueue(p2pproxy.FairQueue):
+    """ the scheduler off, every frame in one lane in arrival order """
+    def put(self, item, key = 0, urgent = False):
+        p2pproxy.FairQueue.put(self, item)
+
+PING = 1000
+bulks, rate, count = int(sys.argv[1]), float(sys.argv[2]), int(sys.argv[3])
+for mode in ('fifo', 'fair', 'priority'):
+    a, b = gevent.socket.socketpair()
+    for sock in (a, b):
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 16384)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 16384)
+    queue = FifoQueue() if mode == 'fifo' else p2pproxy.FairQueue()
+    tunnel = p2pproxy.P2pSession(a, queue = queue)
+    # bytes of each bulk stream written and not drained yet
+    flight = dict((i, 0) for i in range(1, bulks + 1))
+    drained = Event()
+    times = []
+
+    def bulk(clientid):
+        data = 'x' * p2pproxy.P2P_BUFFER_MAX
+        if mode == 'priority':
+            queue.set_priority(clientid, 1)
+        while True:
+            while flight[clientid] + len(data) > p2pproxy.P2P_STREAM_WINDOW:
+                drained.clear()
+                drained.wait()
+            flight[clientid] += len(data)
+            tunnel.write_frame(clientid, p2pproxy.P2P_CMD_DATA, data)
+
+    def drain():
+        due = time.time()
+        ping = bytearray()
+        for clientid, cmd, data in p2pproxy.FrameDecoder(p2pproxy.P2pSession(b)).frames():
+            if clientid == PING:
+                ping += data
+                while len(ping) >= 64:
+                    times.append(time.time() - struct.unpack_from('d', bytes(ping))[0])
+                    del ping[:64]
+            else:
+                flight[clientid] -= len(data)
+                drained.set()
+            # the link takes rate bytes/s
+            due += len(data) / rate
+            if due > time.time():
+                gevent.sleep(due - time.time())
+
+    greenlets = [gevent.spawn(tunnel.write_loop), gevent.spawn(drain)]
+    greenlets += [gevent.spawn(bulk, i) for i in flight]
+    # the windows fill first
+    gevent.sleep(0.5)
+    for i in xrange(count):
+        tunnel.write_frame(PING, p2pproxy.P2P_CMD_DATA, struct.pack('d', time.time()) + 'p' * 56)
+        gevent.sleep(0.02)
+    deadline = time.time() + 10
+    while len(times) < count and time.time() < deadline:
+        gevent.sleep(0.05)
+    gevent.killall(greenlets)
+    tunnel.close()
+    b.close()
+    times.sort()
+    print json.dumps({'mode': mode, 'bulks': bulks, 'pings': len(times), 
+        'p50': times[len(times) // 2], 'p99': times[min(len(times) - 1, len(times) * 99 // 100)], 
+        'max': times[-1]})
+    sys.stdout.flush()
+'''
+
+def fair_main(python2, bulks, rate, count):
+    """ how long pings wait on a tunnel session under bulk load, per write queue """
+    print('%5s %9s %6s %8s %8s %8s' % ('bulk', 'queue', 'pings', 'p50 ms', 'p99 ms', 'max ms'))
+    for n in bulks:
+        for row in run_python2(python2, FAIR_SCRIPT, n, rate, count):
+            print('%5d %9s %6d %8.1f %8.1f %8.1f' % (row['bulks'], row['mode'], row['pings'], 
+                row['p50'] * 1e3, row['p99'] * 1e3, row['max'] * 1e3))
+        sys.stdout.flush()
+
+# P2P_STREAM_WINDOW, what either side may hold of one stream
+STREAM_WINDOW = 256 << 10
+
+def slow_main(python2, pairs, streams, duration, base):
+    """
+        streams uploads as fast as they go through each pair into a
+        backend taking SLOW_RATE of each, the memory of both sides every
+        second. Exits with an error when a side grew by more than the
+        windows of the streams after the first seconds filled them.
+        Ports: backend base, proxy base + 1, p2p base + 2
+    """
+    failed = []
+    for i, pair in enumerate(pairs):
+        server, client = pair.split(':')
+        # fresh ports per pair, the last pair's may still be in TIME_WAIT
+        backend, proxy, p2p = base + i * 10, base + i * 10 + 1, base + i * 10 + 2
+        procs = []
+        socks = []
+        sent = [0] * streams
+        stop = threading.Event()
+
+        def upload(sock, j):
+            msg = b'x' * 65536
+            try:
+                while not stop.is_set():
+                    try:
+                        sent[j] += sock.send(msg)
+                    except socket.timeout:
+                        # held back by the window, look at stop again
+                        pass
+            except socket.error:
+                pass
+
+        try:
+            procs.append(subprocess.Popen([sys.executable, __file__, '-slowsink=%d' % backend]))
+            wait_port(backend)
+            start_pair(procs, server, client, python2, backend, proxy, p2p)
+            # no echo to wait for behind a sink
+            time.sleep(1)
+            for j in range(streams):
+                sock = socket.create_connection(('127.0.0.1', proxy))
+                sock.settimeout(1)
+                socks.append(sock)
+                threading.Thread(target = upload, args = (sock, j), daemon = True).start()
+
+            print('%s: %d streams into a %d KB/s backend each' % (pair, streams, SLOW_RATE >> 10))
+            print('%5s %10s %10s %8s' % ('s', 'server MB', 'client MB', 'sent MB'))
+            samples = []
+            started = time.time()
+            for t in range(1, int(duration) + 1):
+                time.sleep(max(0, started + t - time.time()))
+                samples.append((rss(procs[1].pid), rss(procs[2].pid), sum(sent) / 1e6))
+                print('%5d %10.1f %10.1f %8.1f' % ((t,) + samples[-1]))
+                sys.stdout.flush()
+
+            # the first seconds fill the windows and the kernel's
+            # buffers, after that neither side may grow
+            warm = min(2, len(samples) - 1)
+            cap = streams * STREAM_WINDOW / float(1 << 20)
+            growth = [max(s[side] for s in samples[warm:]) - samples[warm][side] for side in (0, 1)]
+            rate = (samples[-1][2] - samples[warm][2]) / max(1, len(samples) - 1 - warm)
+            verdict = 'ok' if max(growth) <= cap else 'FAIL'
+            print('%s: grew server %.1f MB, client %.1f MB after %d s, window cap %.1f MB, '
+                'uploads ran at %.2f MB/s, %s' % (pair, growth[0], growth[1], warm + 1, cap, rate, 
+                verdict))
+            if verdict != 'ok':
+                failed.append(pair)
+        finally:
+            stop.set()
+            for sock in socks:
+                sock.close()
+            for p in procs:
+                p.kill()
+                p.wait()
+    if failed:
+        sys.exit('memory grew past the window cap: %s' % ' '.join(failed))
+
+def stream_load(ports, streams, size, chunk = 16384):
+    """
+        streams concurrent connections spread round robin over ports, each
+        echoes size bytes. Returns connect + first echo times, MB/s
+    """
+    import asyncio
+
+    async def one(port, setups):
+        started = time.time()
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        msg = b'x' * chunk
+        writer.write(msg[:64])
+        await reader.readexactly(64)
+        setups.append(time.time() - started)
+        sent = 0
+        while sent < size:
+            writer.write(msg)
+            await writer.drain()
+            await reader.readexactly(chunk)
+            sent += chunk
+        writer.close()
+
+    async def run():
+        setups = []
+        started = time.time()
+        await asyncio.gather(*[one(ports[i % len(ports)], setups) for i in range(streams)])
+        return setups, time.time() - started
+
+    setups, elapsed = asyncio.run(run())
+    return setups, streams * size / elapsed / 1e6
+
+def write_services(path, ports):
+    with open(path, 'w') as f:
+        for i, port in enumerate(ports):
+            f.write('svc%d 127.0.0.1:%d\n' % (i, port))
+
+def run_services(python2, base, count, streams, size, shared):
+    """
+        count services behind one proxy pair (shared) or count pairs. 
+        Ports: echo base + i, proxy base + 100 + i, p2p base + 200 + i
+    """
+    echo_ports = [base + i for i in range(count)]
+    proxy_ports = [base + 100 + i for i in range(count)]
+    procs = []
+    tmp = tempfile.mkdtemp()
+    try:
+        procs.append(subprocess.Popen([sys.executable, __file__, 
+            '-echo=' + ','.join(map(str, echo_ports))]))
+        for port in echo_ports:
+            wait_port(port)
+
+        if shared:
+            sides = []
+            for mode, ports in (('s', proxy_ports), ('c', echo_ports)):
+                path = os.path.join(tmp, mode)
+                write_services(path, ports)
+                sides.append(['-' + mode, '-services=' + path, '-p2p=127.0.0.1:%d' % (base + 200)])
+        else:
+            sides = []
+            for i in range(count):
+                p2p = '-p2p=127.0.0.1:%d' % (base + 200 + i)
+                sides.append(['-s', p2p, '-server=127.0.0.1:%d' % proxy_ports[i]])
+                sides.append(['-c', p2p, '-server=127.0.0.1:%d' % echo_ports[i]])
+
+        for args in sides:
+            procs.append(subprocess.Popen(engine_command('gevent', python2) + ['-log=off'] + args,
+                stdout = subprocess.DEVNULL))
+        for port in proxy_ports:
+            wait_echo(port)
+
+        proxies = [p.pid for p in procs[1:]]
+        cpu = sum(cpu_time(pid) for pid in proxies)
+        setups, mbs = stream_load(proxy_ports, streams, size)
+        cpu = sum(cpu_time(pid) for pid in proxies) - cpu
+        memory = sum(rss(pid) for pid in proxies)
+        return (len(proxies), percentile(setups, .5) * 1e3, percentile(setups, .99) * 1e3, 
+            mbs, cpu * (100 << 20) / (streams * size), memory)
+    finally:
+        for p in procs:
+            p.kill()
+            p.wait()
+        shutil.rmtree(tmp)
+
+def services_main(python2, count, streams, size, base):
+    print('%-7s %8s %8s %6s %12s %12s %7s %12s %7s' % ('layout', 'services', 'streams', 'procs', 
+        'setup p50 ms', 'setup p99 ms', 'MB/s', 'cpu s/100MB', 'rss MB'))
+    for i, shared in enumerate((True, False)):
+        result = run_services(python2, base + i * 300, count, streams, size, shared)
+        print('%-7s %8d %8d %6d %12.2f %12.2f %7.1f %12.2f %7.1f' % (
+            (shared and 'shared' or 'split', count, streams) + result))
+        sys.stdout.flush()
+
+def start_services_pair(python2, base, services, tmp, args = ([], [])):
+    """
+        echo backend and one p2pproxy.py pair with a service per echo
+        port, args go to the server and the client. Returns the
+        processes and the proxy ports.
+        Ports: echo base + i, proxy base + 100 + i, p2p base + 200
+    """
+    echo_ports = [base + i for i in range(services)]
+    proxy_ports = [base + 100 + i for i in range(services)]
+    procs = [subprocess.Popen([sys.executable, __file__, '-echo=' + ','.join(map(str, echo_ports))])]
+    for port in echo_ports:
+        wait_port(port)
+
+    for mode, ports, extra in (('s', proxy_ports, args[0]), ('c', echo_ports, args[1])):
+        path = os.path.join(tmp, mode)
+        write_services(path, ports)
+        procs.append(subprocess.Popen(engine_command('gevent', python2) + ['-log=off', '-' + mode, 
+            '-services=' + path, '-p2p=127.0.0.1:%d' % (base + 200)] + extra, 
+            stdout = subprocess.DEVNULL))
+    for port in proxy_ports:
+        wait_echo(port)
+    return procs, proxy_ports
+
+def open_streams(proxy_ports, count, socks, echoed = None):
+    """
+        count streams into socks, a batch in flight at a time. Each is 
+        open end to end once its byte came back, echoed gets that time
+    """
+    for i in range(0, count, 500):
+        batch = [socket.create_connection(('127.0.0.1', proxy_ports[j % len(proxy_ports)])) 
+            for j in range(i, min(count, i + 500))]
+        for sock in batch:
+            sock.sendall(b'x')
+        for sock in batch:
+            sock.settimeout(30)
+            recv_exactly(sock, 1)
+            if echoed is not None:
+                echoed.append(time.time())
+        socks.extend(batch)
+
+def idle_streams(python2, base, count):
+    """
+        count idle streams over one pair. A source address reaches one
+        port about 28000 times, so a service per 20000 streams.
+    """
+    procs = []
+    socks = []
+    tmp = tempfile.mkdtemp()
+    try:
+        procs, proxy_ports = start_services_pair(python2, base, count // 20000 + 1, tmp)
+        before = [rss(p.pid) for p in procs[1:]]
+        open_streams(proxy_ports, count, socks)
+        time.sleep(2)
+        after = [rss(p.pid) for p in procs[1:]]
+        return tuple((a - b) * 1024 / count for a, b in zip(after, before)) + tuple(after)
+    finally:
+        for sock in socks:
+            sock.close()
+        for p in procs:
+            p.kill()
+            p.wait()
+        shutil.rmtree(tmp)
+
+def idle_main(python2, counts, base):
+    # every process of the run holds a descriptor per stream
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    print('%8s %14s %14s %14s %14s' % ('streams', 'server KB/strm', 'client KB/strm', 
+        'server rss MB', 'client rss MB'))
+    for i, count in enumerate(counts):
+        if hard != resource.RLIM_INFINITY and count + 100 > hard:
+            print('%8d  needs %d descriptors, RLIMIT_NOFILE allows %d' % (count, count + 100, hard))
+            continue
+        result = idle_streams(python2, base + i * 300, count)
+        print('%8d %14.2f %14.2f %14.1f %14.1f' % ((count,) + result))
+        sys.stdout.flush()
+
+def timer_streams(python2, base, count, idle):
+    """
+        count idle streams over one pair run with -streamidle=idle. 
+        Returns timer wakeups and callbacks per second of both sides
+        and their cpu ms per second while the streams wait, then the
+        streams the idle timeout closed and the longest a stream lived
+        after its echo
+    """
+    procs = []
+    socks = []
+    tmp = tempfile.mkdtemp()
+    try:
+        stats = [base + 201, base + 202]
+        args = [['-stats=127.0.0.1:%d' % port, '-streamidle=%d' % idle] for port in stats]
+        procs, proxy_ports = start_services_pair(python2, base, count // 20000 + 1, tmp, args)
+        echoed = []
+        open_streams(proxy_ports, count, socks, echoed)
+        if time.time() - echoed[0] + 5 > idle:
+            raise IOError('opening took %.1fs, more than -streamidle=%d leaves' % (
+                time.time() - echoed[0], idle))
+
+        def sample():
+            return (sum(scrape(port, 'p2p_timer_wakeups_total') for port in stats), 
+                sum(scrape(port, 'p2p_timer_callbacks_total') for port in stats))
+        # rendering the stats of every stream is not what is measured
+        before = sample()
+        cpu = sum(cpu_time(p.pid) for p in procs[1:])
+        started = time.time()
+        time.sleep(5)
+        cpu = sum(cpu_time(p.pid) for p in procs[1:]) - cpu
+        elapsed = time.time() - started
+        rates = tuple((a - b) / elapsed for a, b in zip(sample(), before))
+
+        # every stream should see eof from the server about idle 
+        # seconds after its echo, at most a tick or two later
+        selector = selectors.DefaultSelector()
+        for i, sock in enumerate(socks):
+            sock.setblocking(False)
+            selector.register(sock, selectors.EVENT_READ, i)
+        lived = 0.0
+        closed = 0
+        deadline = echoed[-1] + idle * 2 + 10
+        while closed < count and time.time() < deadline:
+            for key, events in selector.select(1):
+                selector.unregister(key.fileobj)
+                lived = max(lived, time.time() - echoed[key.data])
+                closed += 1
+        return rates + (cpu * 1e3 / elapsed, closed, lived)
+    finally:
+        for sock in socks:
+            sock.close()
+        for p in procs:
+            p.kill()
+            p.wait()
+        shutil.rmtree(tmp)
+
+def timers_main(python2, counts, idle, base):
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    print('%8s %11s %12s %10s %8s %9s' % ('streams', 'wakeups/s', 'callbacks/s', 'cpu ms/s', 
+        'closed', 'lived s'))
+    for i, count in enumerate(counts):
+        if hard != resource.RLIM_INFINITY and count + 100 > hard:
+            print('%8d  needs %d descriptors, RLIMIT_NOFILE allows %d' % (count, count + 100, hard))
+            continue
+        result = timer_streams(python2, base + i * 300, count, idle)
+        print('%8d %11.2f %12.2f %10.2f %8d %9.1f' % ((count,) + result))
+        sys.stdout.flush()
+
+def relay_main(listen, target, rate = 0):
+    """
+        forwards loopback connections from listen to target and cuts
+        all of them with a reset on SIGUSR1, a network path going away.
+        Each direction of a connection moves at most rate bytes/s, 0 for
+        no limit. SIGUSR2 prints the bytes forwarded so far.
+    """
+    import asyncio
+    import signal
+    import struct
+
+    pairs = set()
+    moved = [0]
+
+    async def pipe(reader, writer):
+        due = loop.time()
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                moved[0] += len(data)
+                if rate:
+                    due = max(due, loop.time()) + len(data) / rate
+                    await asyncio.sleep(due - loop.time())
+                writer.write(data)
+                await writer.drain()
+        except OSError:
+            pass
+        finally:
+            writer.close()
+
+    async def handle(reader, writer):
+        try:
+            up_reader, up_writer = await asyncio.open_connection('127.0.0.1', target)
+        except OSError:
+            writer.close()
+            return
+        pair = (writer, up_writer)
+        pairs.add(pair)
+        await asyncio.gather(pipe(reader, up_writer), pipe(up_reader, writer))
+        pairs.discard(pair)
+
+    def cut():
+        for pair in list(pairs):
+            for writer in pair:
+                # no fin, whatever is in flight is lost
+                writer.get_extra_info('socket').setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, 
+                    struct.pack('ii', 1, 0))
+                writer.transport.abort()
+        pairs.clear()
+
+    def report():
+        print(moved[0])
+        sys.stdout.flush()
+
+    loop = asyncio.new_event_loop()
+    loop.add_signal_handler(signal.SIGUSR1, cut)
+    loop.add_signal_handler(signal.SIGUSR2, report)
+    loop.run_until_complete(asyncio.start_server(handle, '127.0.0.1', listen))
+    loop.run_forever()
+
+def relay_moved(relay):
+    """ bytes a relay_main process started with stdout = PIPE has forwarded """
+    relay.send_signal(signal.SIGUSR2)
+    return int(relay.stdout.readline())
+
+def corpus(kind, total):
+    """ total bytes of json records or of random data """
+    if kind == 'random':
+        return os.urandom(total)
+    rnd = random.Random(1)
+    lines = []
+    size = 0
+    while size < total:
+        i = len(lines)
+        lines.append(json.dumps({'id': i, 'user': 'user%d' % rnd.randrange(1000), 
+            'time': 1700000000 + i * 7, 'status': rnd.choice(('ok', 'retry', 'failed')), 
+            'tags': rnd.sample(('api', 'web', 'db', 'cache', 'auth', 'batch'), 2), 
+            'score': round(rnd.random(), 4)}).encode() + b'\n')
+        size += len(lines[-1])
+    return b''.join(lines)[:total]
+
+def compress_run(server, client, python2, base, codec, data, rate):
+    """
+        data echoed through a pair with -compress=codec on the client, 
+        off for none, its tunnel through a relay of rate bytes/s each 
+        way. Returns MB/s, tunnel bytes per payload byte, cpu seconds of
+        both sides per 100 MB and whether data came back unchanged.
+        Ports: echo base, proxy base + 1, p2p base + 2, relay base + 3
+    """
+    echo, proxy, p2p, relay = base, base + 1, base + 2, base + 3
+    procs = []
+    try:
+        procs.append(subprocess.Popen([sys.executable, __file__, '-echo=%d' % echo]))
+        procs.append(subprocess.Popen([sys.executable, __file__, '-relay=%d:%d:%d' % (relay, p2p, 
+            rate)], stdout = subprocess.PIPE))
+        wait_port(echo)
+        wait_port(relay)
+        args = [] if codec == 'off' else ['-compress=' + codec]
+        start_pair(procs, server, client, python2, echo, proxy, p2p, [], 
+            args + ['-p2p=127.0.0.1:%d' % relay])
+        wait_echo(proxy)
+
+        sock = socket.create_connection(('127.0.0.1', proxy))
+        sock.settimeout(30)
+        moved = relay_moved(procs[1])
+        cpu = cpu_time(procs[2].pid) + cpu_time(procs[3].pid)
+        started = time.time()
+        threading.Thread(target = sock.sendall, args = (data,), daemon = True).start()
+        got = []
+        size = 0
+        while size < len(data):
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            got.append(chunk)
+            size += len(chunk)
+        elapsed = time.time() - started
+        cpu = cpu_time(procs[2].pid) + cpu_time(procs[3].pid) - cpu
+        # the data crosses the tunnel once each way
+        wire = (relay_moved(procs[1]) - moved) / (2.0 * len(data))
+        sock.close()
+        return (size / elapsed / 1e6, wire, cpu * (100 << 20) / len(data), 
+            b''.join(got) == data)
+    finally:
+        for p in procs:
+            p.kill()
+            p.wait()
+
+def compress_main(python2, pairs, codecs, kinds, total, rate, base):
+    print('%-*s %7s %7s %7s %6s %12s %7s' % (17, 'server:client', 'codec', 'corpus', 'MB/s', 
+        'wire', 'cpu s/100MB', 'intact'))
+    corpora = dict((kind, corpus(kind, total)) for kind in kinds)
+    i = 0
+    for pair in pairs:
+        server, client = pair.split(':')
+        for kind in kinds:
+            for codec in codecs:
+                # fresh ports per run, the last run's may still be in TIME_WAIT
+                result = compress_run(server, client, python2, base + i * 10, codec, corpora[kind], 
+                    rate)
+                i += 1
+                print('%-17s %7s %7s %7.1f %6.2f %12.2f %7s' % ((pair, codec, kind) + result[:3] + 
+                    (result[3] and 'yes' or 'no',)))
+                sys.stdout.flush()
+
+def flap_transfer(python2, base, resume, total, cuts):
+    """
+        one stream echoing total bytes of a pattern through a pair whose
+        tunnel goes through a relay, cut cuts times along the way. Returns
+        the bytes that came back in order, whether that was all of them,
+        the longest wait for data and the seconds it all took.
+        Ports: echo base, proxy base + 1, p2p base + 2, relay base + 3
+    """
+    echo, proxy, p2p, relay = base, base + 1, base + 2, base + 3
+    procs = []
+    sock = None
+    try:
+        procs.append(subprocess.Popen([sys.executable, __file__, '-echo=%d' % echo]))
+        procs.append(subprocess.Popen([sys.executable, __file__, '-relay=%d:%d' % (relay, p2p)]))
+        wait_port(echo)
+        wait_port(relay)
+        extra = ['-resume=%d' % resume] if resume else []
+        for mode, p2p_port, host in (('s', p2p, proxy), ('c', relay, echo)):
+            procs.append(subprocess.Popen(engine_command('gevent', python2) + ['-log=off', '-' + mode, 
+                '-p2p=127.0.0.1:%d' % p2p_port, '-server=127.0.0.1:%d' % host] + extra, 
+                stdout = subprocess.DEVNULL))
+        wait_echo(proxy)
+
+        pattern = bytes(range(256)) * 256
+        # any 64 KB of the stream starting at got % 256
+        expected = pattern * 3
+        sock = socket.create_connection(('127.0.0.1', proxy))
+        sock.settimeout(30)
+
+        def send():
+            try:
+                for offset in range(0, total, len(pattern)):
+                    sock.sendall(pattern[:total - offset])
+            except OSError:
+                pass
+        threading.Thread(target = send, daemon = True).start()
+
+        marks = [total * (i + 1) // (cuts + 1) for i in range(cuts)]
+        got = 0
+        stall = 0.0
+        started = last = time.time()
+        while got < total:
+            try:
+                data = sock.recv(65536)
+            except OSError:
+                break
+            if not data or data != expected[got % 256:got % 256 + len(data)]:
+                break
+            got += len(data)
+            now = time.time()
+            stall = max(stall, now - last)
+            last = now
+            while marks and got >= marks[0]:
+                marks.pop(0)
+                procs[1].send_signal(signal.SIGUSR1)
+        return got, got == total, stall, time.time() - started
+    finally:
+        if sock is not None:
+            sock.close()
+        for p in procs:
+            p.kill()
+            p.wait()
+
+def flap_main(python2, cuts, total, resume, base):
+    print('%8s %6s %10s %8s %11s %9s' % ('resume s', 'cuts', 'MB echoed', 'intact', 'max stall s', 
+        'elapsed s'))
+    for i, seconds in enumerate((0, resume)):
+        got, intact, stall, elapsed = flap_transfer(python2, base + i * 10, seconds, total, cuts)
+        print('%8s %6d %10.1f %8s %11.2f %9.1f' % (seconds or 'off', cuts, got / 1048576.0, 
+            intact and 'yes' or 'no', stall, elapsed))
+        sys.stdout.flush()
+
+def load_run(port, kind, concurrency, size, churn, duration, warmup = 0):
+    """
+        concurrency connections through port for duration seconds, each
+        sends or reads size byte messages and reconnects after churn of
+        them, 0 for never. Returns bytes moved, messages, round trip
+        times of the echoed ones but the first warmup of a connection,
+        connections made and failed, seconds
+    """
+    import asyncio
+
+    stats = {'bytes': 0, 'messages': 0, 'times': [], 'connects': 0, 'errors': 0}
+
+    async def worker(deadline):
+        msg = b'x' * size
+        while time.time() < deadline:
+            try:
+                reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            except OSError:
+                stats['errors'] += 1
+                await asyncio.sleep(0.01)
+                continue
+            stats['connects'] += 1
+            count = 0
+            try:
+                while time.time() < deadline and (not churn or count < churn):
+                    if kind == 'echo':
+                        started = time.time()
+                        writer.write(msg)
+                        await reader.readexactly(size)
+                        if count >= warmup:
+                            stats['times'].append(time.time() - started)
+                    elif kind == 'sink':
+                        writer.write(msg)
+                        await writer.drain()
+                    else:
+                        await reader.readexactly(size)
+                    stats['bytes'] += size
+                    stats['messages'] += 1
+                    count += 1
+            except (OSError, asyncio.IncompleteReadError):
+                stats['errors'] += 1
+            finally:
+                writer.close()
+
+    async def run():
+        started = time.time()
+        tasks = [asyncio.ensure_future(worker(started + duration)) for i in range(concurrency)]
+        # a stalled proxy does not hold the run up for long
+        done, pending = await asyncio.wait(tasks, timeout = duration + 10)
+        for task in pending:
+            task.cancel()
+        stats['errors'] += len(pending)
+        return time.time() - started
+
+    elapsed = asyncio.run(run())
+    return (stats['bytes'], stats['messages'], stats['times'], stats['connects'], 
+        stats['errors'], elapsed)
+
+def run_load(server, client, python2, base, kind, concurrency, size, churn, duration):
+    """
+        the load generator against a kind backend behind one pair. 
+        Returns a dict of the results.
+        Ports: backend base, proxy base + 1, p2p base + 2
+    """
+    backend_port, proxy_port, p2p_port = base, base + 1, base + 2
+    procs = []
+    try:
+        procs.append(subprocess.Popen([sys.executable, __file__, '-%s=%d' % (kind, backend_port)]))
+        wait_port(backend_port)
+        procs.append(subprocess.Popen(engine_command(server, python2) + ['-s', '-log=off',
+            '-p2p=127.0.0.1:%d' % p2p_port, '-server=127.0.0.1:%d' % proxy_port],
+            stdout = subprocess.DEVNULL))
+        wait_port(proxy_port)
+        procs.append(subprocess.Popen(engine_command(client, python2) + ['-c', '-log=off',
+            '-p2p=127.0.0.1:%d' % p2p_port, '-server=127.0.0.1:%d' % backend_port],
+            stdout = subprocess.DEVNULL))
+        # no echo to wait for behind a sink or a source
+        time.sleep(1)
+
+        cpu = [cpu_time(p.pid) for p in procs[1:]]
+        moved, messages, times, connects, errors, elapsed = load_run(proxy_port, kind, 
+            concurrency, size, churn, duration)
+        cpu = [cpu_time(p.pid) - c for p, c in zip(procs[1:], cpu)]
+
+        def ms(p):
+            return times and round(percentile(times, p) * 1e3, 3) or None
+        return {
+            'time': round(time.time()), 'pair': '%s:%s' % (server, client), 'backend': kind, 
+            'concurrency': concurrency, 'size': size, 'churn': churn, 
+            'seconds': round(elapsed, 2), 'mb_per_s': round(moved / elapsed / 1e6, 2), 
+            'msgs_per_s': round(messages / elapsed, 1), 'p50_ms': ms(.5), 'p99_ms': ms(.99), 
+            'p999_ms': ms(.999), 'conns_per_s': round(connects / elapsed, 1), 'errors': errors, 
+            'server_cpu_pct': round(cpu[0] * 100 / elapsed, 1), 
+            'client_cpu_pct': round(cpu[1] * 100 / elapsed, 1), 
+            'server_rss_mb': round(rss(procs[1].pid), 1), 
+            'client_rss_mb': round(rss(procs[2].pid), 1),
+        }
+    finally:
+        for p in procs:
+            p.kill()
+            p.wait()
+
+# bytes/s the reader of a pipe log takes, a slow log shipper
+LOG_PIPE_RATE = 20 << 10
+
+def log_reader(path):
+    """ read the fifo at path at LOG_PIPE_RATE until its writer goes """
+    with open(path, 'rb') as f:
+        while f.read(LOG_PIPE_RATE // 20):
+            time.sleep(0.05)
+
+def logging_run(server, client, python2, base, sink, rate, concurrency, duration, tmp):
+    """
+        connect, 64 byte echo and close over and over through a pair 
+        logging to sink: a file, a pipe read at LOG_PIPE_RATE or off. 
+        rate is the -lograte of p2pproxy.py sides, None for theirs.
+        Returns the results of load_run and the log bytes written.
+        Ports: echo base, proxy base + 1, p2p base + 2
+    """
+    echo, proxy, p2p = base, base + 1, base + 2
+    args = []
+    for side in ('server', 'client'):
+        path = os.path.join(tmp, '%s-%d.log' % (side, base))
+        option = ['-log=' + (path if sink != 'off' else 'off')]
+        if sink == 'pipe':
+            os.mkfifo(path)
+            threading.Thread(target = log_reader, args = (path,), daemon = True).start()
+        if rate is not None and (side == 'server' and server or client).split('+')[0] == 'gevent':
+            option.append('-lograte=%d' % rate)
+        args.append(option)
+    procs = []
+    try:
+        procs.append(subprocess.Popen([sys.executable, __file__, '-echo=%d' % echo]))
+        wait_port(echo)
+        start_pair(procs, server, client, python2, echo, proxy, p2p, *args)
+        wait_echo(proxy)
+        result = load_run(proxy, 'echo', concurrency, 64, 1, duration)
+        written = sum(os.path.getsize(os.path.join(tmp, name)) for name in os.listdir(tmp) 
+            if name.endswith('-%d.log' % base) and sink == 'file')
+        return result, written
+    finally:
+        for p in procs:
+            p.kill()
+            p.wait()
+
+def logging_main(python2, pairs, sinks, rates, concurrency, duration, base):
+    print('%-17s %5s %8s %9s %8s %8s %7s %8s' % ('server:client', 'log', 'lograte', 'conns/s', 
+        'p50 ms', 'p99 ms', 'errors', 'log KB'))
+    tmp = tempfile.mkdtemp()
+    i = 0
+    try:
+        for pair in pairs:
+            server, client = pair.split(':')
+            for sink in sinks:
+                for rate in rates:
+                    # fresh ports per run, the last run's may still be in TIME_WAIT
+                    (moved, messages, times, connects, errors, elapsed), written = logging_run(
+                        server, client, python2, base + i * 10, sink, rate, concurrency, 
+                        duration, tmp)
+                    i += 1
+                    print('%-17s %5s %8s %9.1f %8.2f %8.2f %7d %8s' % (pair, sink, 
+                        '-' if rate is None else rate, connects / elapsed, 
+                        percentile(times or [0], .5) * 1e3, percentile(times or [0], .99) * 1e3, errors, 
+                        sink == 'file' and '%d' % (written >> 10) or '-'))
+                    sys.stdout.flush()
+    finally:
+        shutil.rmtree(tmp)
+
+def lossy_main(kind, listen, target, loss, delay):
+    """
+        a lossy path from listen to target, delay seconds each way. udp
+        datagrams are dropped with probability loss. A tcp stream cannot
+        be dropped from in user space, so its segments are modelled: a
+        lost one comes two round trips late, what a tail loss probe
+        costs, and every byte behind it waits, the head of line blocking
+        a real loss causes. Congestion control is not modelled, which 
+        flatters tcp
+    """
+    import asyncio
+    import random
+
+    loop = asyncio.new_event_loop()
+    rng = random.Random(listen)
+
+    if kind == 'udp':
+        client = [None]
+
+        class Front(asyncio.DatagramProtocol):
+            def connection_made(self, transport):
+                self.transport = transport
+
+            def datagram_received(self, data, address):
+                client[0] = address
+                if rng.random() >= loss:
+                    loop.call_later(delay, back.transport.sendto, data)
+
+        class Back(asyncio.DatagramProtocol):
+            def connection_made(self, transport):
+                self.transport = transport
+
+            def datagram_received(self, data, address):
+                if rng.random() >= loss:
+                    loop.call_later(delay, front.transport.sendto, data, client[0])
+
+        front = Front()
+        back = Back()
+        loop.run_until_complete(loop.create_datagram_endpoint(lambda: front, 
+            local_addr = ('127.0.0.1', listen)))
+        loop.run_until_complete(loop.create_datagram_endpoint(lambda: back, 
+            remote_addr = ('127.0.0.1', target)))
+        loop.run_forever()
+
+    async def pipe(reader, writer):
+        segments = asyncio.Queue()
+
+        async def deliver():
+            while True:
+                due, data = await segments.get()
+                if data is None:
+                    break
+                if due > loop.time():
+                    await asyncio.sleep(due - loop.time())
+                writer.write(data)
+            writer.close()
+
+        task = loop.create_task(deliver())
+        last = 0
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                for i in range(0, len(data), 1448):
+                    due = loop.time() + delay
+                    if rng.random() < loss:
+                        due += 4 * delay
+                    # in order, behind a late one
+                    last = max(last, due)
+                    segments.put_nowait((last, data[i:i + 1448]))
+        except OSError:
+            pass
+        segments.put_nowait((0, None))
+        await task
+
+    async def handle(reader, writer):
+        try:
+            up_reader, up_writer = await asyncio.open_connection('127.0.0.1', target)
+        except OSError:
+            writer.close()
+            return
+        await asyncio.gather(pipe(reader, up_writer), pipe(up_reader, writer))
+
+    loop.run_until_complete(asyncio.start_server(handle, '127.0.0.1', listen))
+    loop.run_forever()
+
+def loss_latency(python2, base, transport, loss, delay, streams, size, duration):
+    """
+        streams echoing size byte messages for duration seconds through
+        a pair whose tunnel crosses a lossy path. Returns messages/s and
+        round trip p50/p99/p999 in ms.
+        Ports: echo base, proxy base + 1, p2p base + 2, path base + 3
+    """
+    echo, proxy, p2p, path = base, base + 1, base + 2, base + 3
+    procs = []
+    try:
+        procs.append(subprocess.Popen([sys.executable, __file__, '-echo=%d' % echo]))
+        procs.append(subprocess.Popen([sys.executable, __file__, 
+            '-lossy=%s:%d:%d:%f:%f' % (transport, path, p2p, loss, delay)]))
+        for mode, p2p_port, host in (('s', p2p, proxy), ('c', path, echo)):
+            procs.append(subprocess.Popen(engine_command('gevent', python2) + ['-log=off', '-' + mode, 
+                '-p2p=127.0.0.1:%d' % p2p_port, '-server=127.0.0.1:%d' % host, 
+                '-transport=' + transport], stdout = subprocess.DEVNULL))
+        wait_echo(proxy)
+
+        # the first message waits for the stream to open as well
+        moved, messages, times, connects, errors, elapsed = load_run(proxy, 'echo', streams, 
+            size, 0, duration, 1)
+        return (messages / elapsed,) + tuple(percentile(times, p) * 1e3 for p in (.5, .99, .999))
+    finally:
+        for p in procs:
+            p.kill()
+            p.wait()
+
+def loss_main(python2, losses, delay, streams, size, duration, base):
+    print('%6s %9s %8s %8s %8s %8s' % ('loss %', 'transport', 'msgs/s', 'p50 ms', 'p99 ms', 'p999 ms'))
+    i = 0
+    for loss in losses:
+        for transport in ('tcp', 'udp'):
+            result = loss_latency(python2, base + i * 10, transport, loss / 100.0, delay, 
+                streams, size, duration)
+            i += 1
+            print('%6s %9s %8.1f %8.1f %8.1f %8.1f' % ((loss, transport) + result))
+            sys.stdout.flush()
+
+def httpd_main(port, objects, size):
+    """
+        HTTP/1.1 stand-in for a static asset server: /o/N for N below 
+        objects, size bytes each. By N % 10: 0 no-store, 1 max-age=0 so
+        every use revalidates, 2 chunked, the rest max-age=60. All but
+        the no-store ones carry an ETag and answer If-None-Match with 304
+    """
+    import asyncio
+
+    body = b'x' * size
+
+    async def serve(reader, writer):
+        try:
+            while True:
+                head = await reader.readuntil(b'\r\n\r\n')
+                lines = head.decode('latin-1').split('\r\n')
+                path = lines[0].split(' ')[1]
+                headers = dict(l.lower().split(': ', 1) for l in lines[1:] if ': ' in l)
+                n = int(path.rsplit('/', 1)[1]) if path.startswith('/o/') else -1
+                if not 0 <= n < objects:
+                    writer.write(b'HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\n\r\n')
+                    continue
+                etag = '"%d"' % n
+                cache = 'no-store' if n % 10 == 0 else 'max-age=0' if n % 10 == 1 else 'max-age=60'
+                out = ['HTTP/1.1 %s', 'Cache-Control: ' + cache]
+                if n % 10 != 0:
+                    out.append('ETag: ' + etag)
+                if n % 10 != 0 and headers.get('if-none-match') == etag.lower():
+                    out[0] %= '304 Not Modified'
+                    writer.write(('\r\n'.join(out) + '\r\n\r\n').encode())
+                elif n % 10 == 2:
+                    out[0] %= '200 OK'
+                    out.append('Transfer-Encoding: chunked')
+                    half = size // 2
+                    writer.write(('\r\n'.join(out) + '\r\n\r\n').encode() + 
+                        b'%x\r\n' % half + body[:half] + b'\r\n' + 
+                        b'%x\r\n' % (size - half) + body[half:] + b'\r\n0\r\n\r\n')
+                else:
+                    out[0] %= '200 OK'
+                    out.append('Content-Length: %d' % size)
+                    writer.write(('\r\n'.join(out) + '\r\n\r\n').encode() + body)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(asyncio.start_server(serve, '127.0.0.1', port))
+    loop.run_forever()
+
+class HttpClient:
+    """ keep-alive GETs over a blocking socket """
+    def __init__(self, port):
+        self.sock = socket.create_connection(('127.0.0.1', port))
+        self.sock.settimeout(10)
+        self.buf = b''
+
+    def fill(self):
+        data = self.sock.recv(262144)
+        if not data:
+            raise IOError('connection closed')
+        self.buf += data
+
+    def line(self, end = b'\r\n'):
+        while end not in self.buf:
+            self.fill()
+        line, self.buf = self.buf.split(end, 1)
+        return line
+
+    def take(self, count):
+        while len(self.buf) < count:
+            self.fill()
+        self.buf = self.buf[count:]
+
+    def get(self, path):
+        """ status code and body bytes """
+        self.sock.sendall(('GET %s HTTP/1.1\r\nHost: bench\r\n\r\n' % path).encode())
+        lines = self.line(b'\r\n\r\n').decode('latin-1').split('\r\n')
+        code = int(lines[0].split(' ')[1])
+        headers = dict(l.lower().split(': ', 1) for l in lines[1:])
+        if headers.get('transfer-encoding') == 'chunked':
+            total = 0
+            while True:
+                size = int(self.line(), 16)
+                self.take(size + 2)
+                total += size
+                if size == 0:
+                    return code, total
+        size = int(headers.get('content-length', 0))
+        self.take(size)
+        return code, size
+
+    def close(self):
+        self.sock.close()
+
+def http_latency(python2, base, cache, objects, size, concurrency, duration, delay):
+    """
+        concurrency keep-alive connections GETting objects of an httpd
+        backend for duration seconds, the popular ones far more often,
+        through a pair whose tunnel path has delay seconds each way.
+        Returns requests/s, round trip p50/p99 in ms and the cache's
+        hit and revalidated shares, None without the cache.
+        Ports: httpd base, proxy base + 1, p2p base + 2, path base + 3,
+        server stats base + 4
+    """
+    import random
+
+    httpd, proxy, p2p, path, stats = base, base + 1, base + 2, base + 3, base + 4
+    procs = []
+    try:
+        procs.append(subprocess.Popen([sys.executable, __file__, 
+            '-httpd=%d:%d:%d' % (httpd, objects, size)]))
+        procs.append(subprocess.Popen([sys.executable, __file__, 
+            '-lossy=tcp:%d:%d:0:%f' % (path, p2p, delay)]))
+        server = ['-s', '-p2p=127.0.0.1:%d' % p2p, '-server=127.0.0.1:%d' % proxy, 
+            '-stats=127.0.0.1:%d' % stats] + (['-http=-'] if cache else [])
+        client = ['-c', '-p2p=127.0.0.1:%d' % path, '-server=127.0.0.1:%d' % httpd]
+        for args in (server, client):
+            procs.append(subprocess.Popen(engine_command('gevent', python2) + ['-log=off'] + args, 
+                stdout = subprocess.DEVNULL))
+        wait_port(proxy)
+        deadline = time.time() + 20
+        while True:
+            try:
+                HttpClient(proxy).get('/o/0')
+                break
+            except (socket.error, IOError, ValueError):
+                if time.time() > deadline:
+                    raise
+                time.sleep(0.2)
+
+        times = []
+        errors = []
+        stop = time.time() + duration
+
+        def worker(i):
+            rng = random.Random(i)
+            conn = HttpClient(proxy)
+            try:
+                while time.time() < stop:
+                    # a few objects get most of the requests
+                    path = '/o/%d' % int(objects * rng.random() ** 3)
+                    started = time.time()
+                    code, got = conn.get(path)
+                    times.append(time.time() - started)
+                    if code != 200 or got != size:
+                        errors.append(path)
+            finally:
+                conn.close()
+
+        threads = [threading.Thread(target = worker, args = (i,)) for i in range(concurrency)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        if errors:
+            raise IOError('%d bad responses, first %s' % (len(errors), errors[0]))
+
+        hit = revalidated = None
+        if cache:
+            results = [scrape(stats, 'p2p_http_cache_requests_total', 'result="%s"' % r) 
+                for r in ('hit', 'revalidated', 'miss')]
+            hit, revalidated = [100.0 * r / sum(results) for r in results[:2]]
+        return (len(times) / duration, percentile(times, .5) * 1e3, percentile(times, .99) * 1e3, 
+            hit, revalidated)
+    finally:
+        for p in procs:
+            p.kill()
+            p.wait()
+
+def http_main(python2, objects, size, concurrency, duration, delay, base):
+    print('%5s %8s %7s %11s %8s %8s %7s %12s' % ('cache', 'objects', 'size', 'concurrency', 
+        'req/s', 'p50 ms', 'p99 ms', 'hit+reval %'))
+    for i, cache in enumerate((False, True)):
+        result = http_latency(python2, base + i * 10, cache, objects, size, concurrency, 
+            duration, delay)
+        hit = '-' if result[3] is None else '%.1f+%.1f' % result[3:]
+        print('%5s %8d %7d %11d %8.1f %8.2f %7.2f %12s' % (cache and 'on' or 'off', objects, size, 
+            concurrency, result[0], result[1], result[2], hit))
+        sys.stdout.flush()
+
+def wait_source(port, timeout = 20):
+    """ until data from a source backend makes it through the proxy """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            sock = socket.create_connection(('127.0.0.1', port), 1)
+            sock.settimeout(2)
+            recv_exactly(sock, 1)
+            sock.close()
+            return
+        except (socket.error, IOError):
+            time.sleep(0.2)
+    raise IOError('no data through port %d' % port)
+
+def shaped_rates(ports, streams, warmup, duration):
+    """
+        streams[i] connections reading from proxy port ports[i] as fast
+        as they can. Returns the MB/s each one got over duration seconds
+        after warmup, which drains the buckets' bursts.
+    """
+    socks = [socket.create_connection(('127.0.0.1', port)) for port, count in zip(ports, streams) 
+        for i in range(count)]
+    counts = [0] * len(socks)
+    stop = threading.Event()
+
+    def reader(i):
+        sock = socks[i]
+        sock.settimeout(1)
+        while not stop.is_set():
+            try:
+                data = sock.recv(262144)
+            except socket.timeout:
+                continue
+            except socket.error:
+                return
+            if not data:
+                return
+            counts[i] += len(data)
+
+    threads = [threading.Thread(target = reader, args = (i,)) for i in range(len(socks))]
+    for t in threads:
+        t.start()
+    try:
+        time.sleep(warmup)
+        started, before = time.time(), list(counts)
+        time.sleep(duration)
+        elapsed, after = time.time() - started, list(counts)
+        return [(a - b) / elapsed / (1 << 20) for a, b in zip(after, before)]
+    finally:
+        stop.set()
+        for t in threads:
+            t.join()
+        for sock in socks:
+            sock.close()
+
+# limits file, streams per service, what to check: stream, service or total MB/s
+SHAPE_CASES = (
+    ('stream 1m', (4, 0), 'stream', 1.0),
+    ('service svc0 2m\nstream 1m', (4, 0), 'service', 2.0),
+    ('service svc0 4m 256k\nservice svc1 1m', (3, 3), 'service', 4.0),
+    ('total 3m', (3, 3), 'total', 3.0),
+    ('total 6m\nstream 1m', (4, 4), 'total', 6.0),
+)
+
+def shape_main(python2, warmup, duration, base):
+    """
+        one pair whose client shapes what it reads from two source
+        backends with -ratelimit. Every case rewrites the limits file
+        and sends SIGHUP, so each one is a change at runtime as well.
+        Ports: source base + i, proxy base + 100 + i, p2p base + 200
+    """
+    source_ports = [base, base + 1]
+    proxy_ports = [base + 100, base + 101]
+    tmp = tempfile.mkdtemp()
+    limits = os.path.join(tmp, 'limits')
+    with open(limits, 'w') as f:
+        f.write('stream 1g\n')
+    procs = [subprocess.Popen([sys.executable, __file__, '-source=%d,%d' % tuple(source_ports)])]
+    try:
+        for port in source_ports:
+            wait_port(port)
+        for mode, ports in (('s', proxy_ports), ('c', source_ports)):
+            path = os.path.join(tmp, mode)
+            write_services(path, ports)
+            extra = ['-ratelimit=' + limits] if mode == 'c' else []
+            procs.append(subprocess.Popen(engine_command('gevent', python2) + ['-log=off', '-' + mode, 
+                '-services=' + path, '-p2p=127.0.0.1:%d' % (base + 200)] + extra, 
+                stdout = subprocess.DEVNULL))
+        client = procs[-1]
+        for port in proxy_ports:
+            wait_source(port)
+
+        print('%-36s %8s %6s %10s %10s %8s' % ('limits', 'streams', 'check', 'limit MB/s', 
+            'got MB/s', 'error %'))
+        worst = 0
+        for text, streams, check, limit in SHAPE_CASES:
+            with open(limits, 'w') as f:
+                f.write(text + '\n')
+            client.send_signal(signal.SIGHUP)
+            time.sleep(0.2)
+            rates = shaped_rates(proxy_ports, streams, warmup, duration)
+            if check == 'stream':
+                got = rates
+            elif check == 'service':
+                got = [sum(rates[:streams[0]])]
+            else:
+                got = [sum(rates)]
+            for g in got:
+                error = (g - limit) / limit * 100
+                worst = max(worst, abs(error))
+                print('%-36s %8s %6s %10.2f %10.2f %+8.1f' % (text.replace('\n', '; '), 
+                    '+'.join(map(str, streams)), check, limit, g, error))
+                sys.stdout.flush()
+        print('worst error %.1f %%' % worst)
+    finally:
+        for p in procs:
+            p.kill()
+            p.wait()
+        shutil.rmtree(tmp)
+
+CAPTURE_HEADER = struct.Struct('<8s8sd')
+CAPTURE_RECORD = struct.Struct('<dBiiII')
+# replayed chunks: length with this header, send time
+REPLAY_CHUNK = struct.Struct('<Id')
+# a replayed connection names its stream first, PROBE asks for a byte back
+REPLAY_INDEX = struct.Struct('<I')
+REPLAY_PROBE = 0xffffffff
+
+def read_capture(path):
+    """
+        the streams of a p2pproxy.py -capture file in the order they
+        opened, dicts of 'open', seconds into the capture, and 'events',
+        (seconds, up, bytes, payload kept) of each DATA frame, up from 
+        the proxy's client to its backend
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    magic, role, started = CAPTURE_HEADER.unpack_from(data)
+    if magic != b'P2PCAP1\n':
+        sys.exit('%s is not a capture' % path)
+    server = role.rstrip(b'\0') == b'server'
+    streams = []
+    current = {}
+    offset = CAPTURE_HEADER.size
+    while offset + CAPTURE_RECORD.size <= len(data):
+        ts, direction, clientid, cmd, count, stored = CAPTURE_RECORD.unpack_from(data, offset)
+        if ts == 0:
+            # the rest of the last segment of a killed process
+            break
+        offset += CAPTURE_RECORD.size
+        payload = data[offset:offset + stored]
+        offset += stored
+        cmd &= ~0x100
+        if cmd == 1 or (cmd == 2 and clientid not in current):
+            # LOGIN, or DATA of a stream opened before the capture began
+            current[clientid] = {'open': ts - started, 'events': []}
+            streams.append(current[clientid])
+        if cmd == 2:
+            # the server writes what clients sent, the client what backends sent
+            up = (direction == 1) == server
+            current[clientid]['events'].append((ts - started, up, count, payload))
+        elif cmd == 3:
+            current.pop(clientid, None)
+    return streams
+
+def replay_run(server, client, python2, base, streams, speed):
+    """
+        the streams of a capture through a server:client pair, each one
+        a connection opened at its time, its DATA written at theirs, 
+        speed times faster, 0 for no waits. The backend plays the other
+        direction. Returns MB moved, MB/s, the chunk latency p50/p99/
+        p999 in ms, how far behind its time the worst write went in ms,
+        and the streams that failed.
+        Ports: backend base, proxy base + 1, p2p base + 2
+    """
+    import asyncio
+
+    backend, proxy, p2p = base, base + 1, base + 2
+    procs = []
+
+    def expected(events, up):
+        return sum(max(count, REPLAY_CHUNK.size) for t, u, count, payload in events if u == up)
+
+    async def replay():
+        loop = asyncio.get_running_loop()
+        latencies = []
+        lag = [0.0]
+        moved = [0]
+
+        async def play(writer, events, up, epoch):
+            for t, u, count, payload in events:
+                if u != up:
+                    continue
+                delay = epoch + (t / speed if speed else 0) - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                else:
+                    lag[0] = max(lag[0], -delay)
+                # every chunk carries its length and send time, short ones grow
+                n = max(count, REPLAY_CHUNK.size)
+                body = payload[:n - REPLAY_CHUNK.size]
+                writer.write(REPLAY_CHUNK.pack(n, time.time()) + body + 
+                    bytes(n - REPLAY_CHUNK.size - len(body)))
+                await writer.drain()
+                moved[0] += n
+
+        async def take(reader, count):
+            while count > 0:
+                n, sent = REPLAY_CHUNK.unpack(await reader.readexactly(REPLAY_CHUNK.size))
+                await reader.readexactly(n - REPLAY_CHUNK.size)
+                latencies.append(time.time() - sent)
+                count -= n
+
+        async def serve(reader, writer):
+            try:
+                index, = REPLAY_INDEX.unpack(await reader.readexactly(REPLAY_INDEX.size))
+                if index == REPLAY_PROBE:
+                    writer.write(b'k')
+                    return
+                events = streams[index]['events']
+                await asyncio.gather(play(writer, events, False, epoch), 
+                    take(reader, expected(events, True)))
+            except (asyncio.IncompleteReadError, ConnectionError):
+                pass
+            finally:
+                writer.close()
+
+        async def stream(index):
+            events = streams[index]['events']
+            delay = epoch + (streams[index]['open'] / speed if speed else 0) - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            reader, writer = await asyncio.open_connection('127.0.0.1', proxy)
+            try:
+                writer.write(REPLAY_INDEX.pack(index))
+                await asyncio.gather(play(writer, events, True, epoch), 
+                    take(reader, expected(events, False)))
+            finally:
+                writer.close()
+
+        await asyncio.start_server(serve, '127.0.0.1', backend)
+        deadline = time.time() + 20
+        while True:
+            try:
+                reader, writer = await asyncio.open_connection('127.0.0.1', proxy)
+                writer.write(REPLAY_INDEX.pack(REPLAY_PROBE))
+                await asyncio.wait_for(reader.readexactly(1), 2)
+                writer.close()
+                break
+            except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+                if time.time() > deadline:
+                    raise IOError('no probe through port %d' % proxy)
+                await asyncio.sleep(0.2)
+
+        # the first stream opens at the start of the replay, not of the capture
+        epoch = loop.time() - (streams[0]['open'] / speed if speed else 0)
+        started = time.time()
+        results = await asyncio.gather(*[stream(i) for i in range(len(streams))], 
+            return_exceptions = True)
+        elapsed = time.time() - started
+        failed = sum(1 for r in results if isinstance(r, Exception))
+        return moved[0], elapsed, latencies, lag[0], failed
+
+    try:
+        procs.append(subprocess.Popen(engine_command(server, python2) + ['-log=off', '-s', 
+            '-p2p=127.0.0.1:%d' % p2p, '-server=127.0.0.1:%d' % proxy], stdout = subprocess.DEVNULL))
+        procs.append(subprocess.Popen(engine_command(client, python2) + ['-log=off', '-c', 
+            '-p2p=127.0.0.1:%d' % p2p, '-server=127.0.0.1:%d' % backend], stdout = subprocess.DEVNULL))
+        moved, elapsed, latencies, lag, failed = asyncio.run(replay())
+        latencies = latencies or [0]
+        return (moved / 1e6, moved / elapsed / 1e6) + tuple(percentile(latencies, p) * 1e3 
+            for p in (.5, .99, .999)) + (lag * 1e3, failed)
+    finally:
+        for p in procs:
+            p.kill()
+            p.wait()
+
+def replay_main(python2, path, pairs, speed, base):
+    streams = [s for s in read_capture(path) if s['events']]
+    if not streams:
+        sys.exit('%s has no stream data' % path)
+    frames = sum(len(s['events']) for s in streams)
+    span = max(e[0] for s in streams for e in s['events']) - streams[0]['open']
+    print('%s: %d streams, %d DATA frames, %.1f MB over %.1f s, replayed at %s' % (path, 
+        len(streams), frames, sum(e[2] for s in streams for e in s['events']) / 1e6, span, 
+        speed and '%gx' % speed or 'full speed'))
+    width = max([17] + [len(pair) for pair in pairs])
+    print('%-*s %8s %7s %8s %8s %9s %7s %6s' % (width, 'server:client', 'MB', 'MB/s', 'p50 ms', 
+        'p99 ms', 'p999 ms', 'lag ms', 'failed'))
+    for i, pair in enumerate(pairs):
+        server, client = pair.split(':')
+        result = replay_run(server, client, python2, base + i * 10, streams, speed)
+        print('%-*s %8.1f %7.1f %8.2f %8.2f %9.2f %7.1f %6d' % ((width, pair) + result))
+        sys.stdout.flush()
+
+LOAD_COLUMNS = (('pair', '%-17s'), ('backend', '%7s'), ('concurrency', '%11s'), ('size', '%7s'), 
+    ('churn', '%5s'), ('mb_per_s', '%8s'), ('msgs_per_s', '%10s'), ('p50_ms', '%7s'), 
+    ('p99_ms', '%7s'), ('p999_ms', '%7s'), ('conns_per_s', '%11s'), ('errors', '%6s'), 
+    ('server_cpu_pct', '%14s'), ('client_cpu_pct', '%14s'), ('server_rss_mb', '%13s'), 
+    ('client_rss_mb', '%13s'))
+
+def load_main(python2, pairs, kinds, concurrency, sizes, churn, duration, output, base):
+    """ a run for every combination, a json line each with output json """
+    if output == 'table':
+        print(' '.join(fmt % name for name, fmt in LOAD_COLUMNS))
+    i = 0
+    for pair in pairs:
+        server, client = pair.split(':')
+        for kind in kinds:
+            for count in concurrency:
+                for size in sizes:
+                    # fresh ports per run, the last run's may still be in TIME_WAIT
+                    result = run_load(server, client, python2, base + i * 10, kind, count, size, 
+                        churn, duration)
+                    i += 1
+                    if output == 'json':
+                        print(json.dumps(result, sort_keys = True))
+                    else:
+                        print(' '.join(fmt % ('-' if result[name] is None else result[name]) 
+                            for name, fmt in LOAD_COLUMNS))
+                    sys.stdout.flush()
+
+def main():
+    s = """
+            Usage: p2pbench [-pairs=server:client,...] [-python2=path] [-count=N]
+                            [-size=MB] [-port=N]
+                   p2pbench -latency=B,... [-pairs=...] [-count=N] [-python2=path] [-port=N]
+                   p2pbench -tunnels=N,... [-pairs=...] [-streams=N] [-size=MB] [-python2=path]
+                            [-port=N]
+                   p2pbench -workers=N,... [-pairs=...] [-streams=N] [-size=MB] [-python2=path]
+                            [-port=N]
+                   p2pbench -compress=codec,... [-pairs=...] [-corpus=json,random] [-size=MB]
+                            [-rate=MB] [-python2=path] [-port=N]
+                   p2pbench -logging=sinks [-pairs=...] [-lograte=N,...] [-concurrency=N]
+                            [-duration=S] [-python2=path] [-port=N]
+                   p2pbench -decoder=B,... [-python2=path] [-size=MB]
+                   p2pbench -fair=N,... [-rate=MB] [-pings=N] [-python2=path]
+                   p2pbench -slow [-pairs=...] [-streams=N] [-duration=S] [-python2=path]
+                            [-port=N]
+                   p2pbench -services=N [-streams=N] [-python2=path] [-size=KB] [-port=N]
+                   p2pbench -idle=N,... [-python2=path] [-port=N]
+                   p2pbench -timers=N,... [-streamidle=S] [-python2=path] [-port=N]
+                   p2pbench -flap=N [-resume=S] [-python2=path] [-size=MB] [-port=N]
+                   p2pbench -load=kinds [-pairs=...] [-concurrency=N,...] [-msgsize=B,...]
+                            [-churn=N] [-duration=S] [-output=table|json] [-python2=path]
+                            [-port=N]
+                   p2pbench -loss=P,... [-delay=MS] [-streams=N] [-msgsize=B] [-duration=S]
+                            [-python2=path] [-port=N]
+                   p2pbench -http [-objects=N] [-msgsize=B] [-concurrency=N] [-duration=S]
+                            [-delay=MS] [-python2=path] [-port=N]
+                   p2pbench -replay=path [-pairs=...] [-speed=N] [-python2=path] [-port=N]
+                   p2pbench -shape [-warmup=S] [-duration=S] [-python2=path] [-port=N]
+
+            pairs: engines of the proxy server and client, gevent runs
+                   p2pproxy.py, asyncio and uvloop run p2pproxy3.py.
+                   +option passes -option to that side, gevent+splice=on.
+                   Separate the pairs with spaces when an option has commas.
+                   Default gevent:gevent,asyncio:asyncio,uvloop:uvloop
+                   (when installed),gevent:asyncio,asyncio:gevent
+            python2: interpreter with gevent for p2pproxy.py, default python2
+            count: round trips timed for latency, default 2000
+            size: MB echoed for throughput, default 64
+            port: first of the loopback ports used, default 21000
+
+            latency: p50, p99, p999 and the longest of count round trips,
+                     one connection per pair, for messages of each size,
+                     default 64
+
+            tunnels: streams echoes, default 4, of size MB each, default
+                     25, at once through a pair with -tunnels=N on both 
+                     sides, a run for each N. Default pair gevent:gevent.
+
+            workers: the same as tunnels with -workers=N on both sides,
+                     cpu counts every worker. Only p2pproxy.py has it.
+
+            compress: off or a codec the client offers, default 
+                      off,zlib, zstd and lz4 need their module on both 
+                      sides. size MB, default 20, of each corpus is echoed
+                      once per codec, the tunnel goes through a relay 
+                      moving rate MB/s each way, default 0, no limit.
+                      wire is the tunnel bytes per payload byte, intact 
+                      whether all of it came back unchanged. Default 
+                      pair gevent:gevent.
+
+            logging: concurrency connections, default 16, each opening,
+                     echoing 64 bytes and closing over and over for 
+                     duration seconds, default 10, through a pair with 
+                     -log at a file, at a fifo read at 20 KB/s (pipe) or
+                     off, a run for each. lograte is passed to the 
+                     p2pproxy.py sides, a run for each, default theirs.
+                     Default pair gevent:gevent.
+
+            decoder: frames/s of FrameDecoder.frames() and of the reads
+                     per header and payload it replaced, on size MB,
+                     default 64, of B byte frames sent over a socketpair
+                     in 64 KB writes, default 64,512,2048,65536
+
+            fair: delay of a 64 byte ping frame queued every 20 ms, 
+                  pings of them, default 150, on a tunnel session whose
+                  N bulk streams keep their windows full, default 1,4, 
+                  draining at rate MB/s, default 5, through 16 KB socket
+                  buffers. The write queue is the FairQueue, a fifo in
+                  its place, and the FairQueue with the bulk streams a
+                  priority level below the ping.
+
+            slow: streams uploads, default 4, sending as fast as they
+                  can into a backend that takes 400 KB/s of each, for 
+                  duration seconds, default 12. The resident memory of
+                  both sides is taken every second and must not grow 
+                  after the third by more than the streams' 256 KB 
+                  windows, the run fails when it does. Default pair 
+                  gevent:gevent.
+
+            services: runs the services comparison instead. streams 
+                      connections at once, default 300, echo size KB 
+                      each, default 256, spread over the services
+
+            idle: memory per idle stream, a run for each count, default
+                  10000,50000,100000
+
+            timers: timer wheel wakeups, callbacks and cpu of both sides
+                    while N streams sit idle, then the streams closed by 
+                    -streamidle=S, default 30, and the longest one lived
+                    after its last data. Opening them must take less 
+                    than S - 5 seconds.
+
+            flap: a stream echoing size MB, default 64, while its tunnel
+                  is cut N times at even intervals, once with -resume=S,
+                  default 10, and once without. Reports what came back 
+                  intact and the longest the stream stalled.
+
+            load: comma separated backends, echo times every message's
+                  round trip, sink only takes data and source only sends
+                  it. concurrency connections at once, default 16, 
+                  msgsize bytes a message, default 16384, a run for 
+                  every pair, kind, concurrency and msgsize. Each 
+                  connection closes and reconnects after churn messages,
+                  default 0, never, for duration seconds, default 10. 
+                  Default pair gevent:gevent. output json prints a json
+                  object per run.
+
+            loss: percentages of packets lost on the tunnel's path, 
+                  delay MS each way, default 10. streams connections,
+                  default 16, echo msgsize bytes, default 1024, one 
+                  after the other for duration seconds, default 10, over
+                  a tcp and then a udp tunnel. udp datagrams are dropped,
+                  tcp is modelled, see lossy_main().
+
+            http: concurrency keep-alive connections, default 16, GET 
+                  objects, default 1000, of msgsize bytes, default 
+                  16384, from httpd_main() for duration seconds, default
+                  10, over a tunnel path with delay MS each way, default
+                  10. Once without and once with -http on the server, 
+                  which reports the share of requests answered from the
+                  cache and revalidated with a 304.
+
+            replay: a -capture file of either side. Each stream becomes
+                    a connection opened at its LOGIN and its DATA frames
+                    chunks written at their times, speed times faster,
+                    default 1, 0 for no waits, the backend writing the
+                    other direction. Chunks carry a 12 byte length and
+                    send time, shorter ones grow to that, and compressed
+                    frames are replayed at their compressed size. lag is
+                    how late the worst write went out. Default pair
+                    gevent:gevent.
+
+            shape: per stream, per service and total limits, see 
+                   SHAPE_CASES, each read by the client on SIGHUP. 
+                   Streams read for warmup seconds, default 2, then
+                   the rate is taken over duration seconds, default 10.
+
+            frames/MB and hdr % count the tunnel frames of the throughput
+            run and their header bytes against the payload, gevent:gevent
+            only. Sweep the read size with gevent+chunk=MIN,MAX pairs.
+        """
+    params = {}
+    for arg in sys.argv[1:]:
+        arr = arg.lstrip('-').split('=', 1)
+        if not arg.startswith('-'):
+            sys.exit(s)
+        # a bare -name switches a mode on
+        params[arr[0]] = arr[1] if len(arr) == 2 else ''
+
+    for kind in ('echo', 'sink', 'slowsink', 'source'):
+        if kind in params:
+            backend_main(kind, [int(port) for port in params[kind].split(',')])
+            return
+    if 'relay' in params:
+        relay_main(*[int(n) for n in params['relay'].split(':')])
+        return
+    if 'httpd' in params:
+        httpd_main(*[int(n) for n in params['httpd'].split(':')])
+        return
+    if 'lossy' in params:
+        kind, listen, target, loss, delay = params['lossy'].split(':')
+        lossy_main(kind, int(listen), int(target), float(loss), float(delay))
+        return
+
+    python2 = params.get('python2', 'python2')
+    base = int(params.get('port', 21000))
+    if 'fair' in params:
+        fair_main(python2, [int(n) for n in (params['fair'] or '1,4').split(',')], 
+            float(params.get('rate', 5)) * 1e6, int(params.get('pings', 150)))
+        return
+    if 'decoder' in params:
+        decoder_main(python2, [int(n) for n in (params['decoder'] or '64,512,2048,65536').split(',')], 
+            int(params.get('size', 64)) << 20)
+        return
+    if 'http' in params:
+        http_main(python2, int(params.get('objects', 1000)), int(params.get('msgsize', 16384)), 
+            int(params.get('concurrency', 16)), float(params.get('duration', 10)), 
+            float(params.get('delay', 10)) / 1e3, base)
+        return
+    if 'shape' in params:
+        shape_main(python2, float(params.get('warmup', 2)), float(params.get('duration', 10)), base)
+        return
+    if 'loss' in params:
+        loss_main(python2, [float(n) for n in params['loss'].split(',')], 
+            float(params.get('delay', 10)) / 1e3, int(params.get('streams', 16)), 
+            int(params.get('msgsize', 1024)), float(params.get('duration', 10)), base)
+        return
+    if 'flap' in params:
+        flap_main(python2, int(params['flap']), int(params.get('size', 64)) << 20, 
+            int(params.get('resume', 10)), base)
+        return
+    if 'timers' in params:
+        timers_main(python2, [int(n) for n in params['timers'].split(',')], 
+            int(params.get('streamidle', 30)), base)
+        return
+    if 'idle' in params:
+        idle_main(python2, [int(n) for n in params['idle'].split(',')], base)
+        return
+    if 'services' in params:
+        services_main(python2, int(params['services']), int(params.get('streams', 300)), 
+            int(params.get('size', 256)) << 10, base)
+        return
+
+    pairs = params.get('pairs')
+    if pairs is None and any(mode in params for mode in ('load', 'replay', 'slow', 'tunnels', 'workers', 
+            'compress', 'logging')):
+        pairs = ['gevent:gevent']
+    elif pairs is None:
+        pairs = ['gevent:gevent', 'asyncio:asyncio', 'gevent:asyncio', 'asyncio:gevent']
+        if importlib.util.find_spec('uvloop') is not None:
+            pairs.insert(2, 'uvloop:uvloop')
+    elif ' ' in pairs:
+        # options with commas in them, -chunk=2048,65536
+        pairs = pairs.split()
+    else:
+        pairs = pairs.split(',')
+
+    if 'logging' in params:
+        rates = [int(n) for n in params['lograte'].split(',')] if 'lograte' in params else [None]
+        logging_main(python2, pairs, (params['logging'] or 'file,pipe,off').split(','), rates, 
+            int(params.get('concurrency', 16)), float(params.get('duration', 10)), base)
+        return
+    if 'compress' in params:
+        compress_main(python2, pairs, (params['compress'] or 'off,zlib').split(','), 
+            params.get('corpus', 'json,random').split(','), int(params.get('size', 20)) << 20, 
+            float(params.get('rate', 0)) * 1e6, base)
+        return
+    for option in ('tunnels', 'workers'):
+        if option in params:
+            sweep_main(python2, pairs, option, [int(n) for n in params[option].split(',')], 
+                int(params.get('streams', 4)), int(params.get('size', 25)) << 20, base)
+            return
+    if 'slow' in params:
+        slow_main(python2, pairs, int(params.get('streams', 4)), float(params.get('duration', 12)), 
+            base)
+        return
+    if 'latency' in params:
+        latency_main(python2, pairs, [int(n) for n in (params['latency'] or '64').split(',')], 
+            int(params.get('count', 2000)), base)
+        return
+    if 'replay' in params:
+        replay_main(python2, params['replay'], pairs, float(params.get('speed', 1)), base)
+        return
+    if 'load' in params:
+        output = params.get('output', 'table')
+        if output not in ('table', 'json'):
+            sys.exit(s)
+        load_main(python2, pairs, params['load'].split(','), 
+            [int(n) for n in params.get('concurrency', '16').split(',')], 
+            [int(n) for n in params.get('msgsize', '16384').split(',')], 
+            int(params.get('churn', 0)), float(params.get('duration', 10)), output, base)
+        return
+
+    count = int(params.get('count', 2000))
+    total = int(params.get('size', 64)) << 20
+
+    width = max([17] + [len(pair) for pair in pairs])
+    print('%-*s %9s %11s %11s %7s %12s %10s %6s' % (width, 'server:client', 'setup ms', 'rtt p50 ms', 
+        'rtt p99 ms', 'MB/s', 'cpu s/100MB', 'frames/MB', 'hdr %'))
+    for pair in pairs:
+        server, client = pair.split(':')
+        result = run_pair(server, client, python2, base, count, total)
+        # fresh ports per pair, the last pair's may still be in TIME_WAIT
+        base += 10 + pair_ports(server, client)
+        result = result[:5] + tuple(r or '-' for r in result[5:])
+        print('%-*s %9.2f %11.3f %11.3f %7.1f %12.2f %10s %6s' % ((width, pair) + result))
+        sys.stdout.flush()
+
+if __name__ == '__main__':
+    main()
@@ -2,29 +2,184 @@
 
 import socket
 import errno
+import fcntl
+import os
 import sys
 import signal
+import threading
 import time
 import struct
 import array
+import functools
+import random
+import bisect
+import zlib
+import mmap
+import atexit
+import gc
+import types
+import traceback
+import hashlib
+import email.utils
+import json
+from collections import deque, OrderedDict
+import greenlet
 import gevent
-from gevent.queue import Queue
+import gevent.socket
+from gevent.event import Event
+from gevent.queue import Empty, Queue
 from gevent.server import StreamServer
+from gevent.pywsgi import WSGIServer
 from gevent.socket import create_connection, gethostbyname
 import logging
 
-logging.basicConfig(
-    filename='p2pproxy.log',
-    format='%(asctime)s <%(name)s> [%(levelname)s]:%(message)s',
-    level=logging.INFO)
-    
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.block
+except ImportError:
+    lz4 = None
+
 P2P_CMD_LOGIN = 1
 P2P_CMD_DATA = 2
 P2P_CMD_LOGOUT = 3
 P2P_CMD_CLIENT = 4
 P2P_CMD_TIMER = 5
+P2P_CMD_WINDOW = 6
+P2P_CMD_OPEN_OK = 7
+P2P_CMD_OPEN_FAIL = 8
+P2P_CMD_ACK = 9
+# set on P2P_CMD_DATA when the payload went through the stream compressor
+P2P_FLAG_COMPRESSED = 0x100
 
 P2P_BUFFER_MAX = 2048
+# a stream reads P2P_BUFFER_MAX at first, the read size doubles while
+# reads come back full, up to this, and halves when they come back short
+P2P_CHUNK_MAX = 128*1024
+P2P_RECV_BUFFER = 64*1024
+P2P_FRAME_MAX = 1024*1024
+P2P_WRITE_BATCH = 64*1024
+# per stream credit, bytes in flight through the tunnel before the
+# reader waits for a P2P_CMD_WINDOW update from the peer
+P2P_STREAM_WINDOW = 256*1024
+# client data read ahead while the backend connects, the rest of the
+# window is granted by P2P_CMD_OPEN_OK
+P2P_OPEN_BUFFER = 64*1024
+P2P_OPEN_TIMEOUT = 30
+# reads shorter than this go out as they are
+P2P_COMPRESS_MIN = 128
+# a frame that did not shrink by 1/8 sends the next ones raw, the
+# number doubles up to the max while the stream keeps not compressing
+P2P_COMPRESS_SKIP = 16
+P2P_COMPRESS_SKIP_MAX = 1024
+# pooled backend connections idle longer than this are replaced
+P2P_POOL_IDLE_TIMEOUT = 30
+# client: P2P_CMD_TIMER after this many seconds without a frame from the server
+P2P_KEEPALIVE = 30
+# a tunnel silent this long is closed
+P2P_TUNNEL_TIMEOUT = 120
+# client: a stream whose backend closed goes this long without data
+# from the server before it is closed
+P2P_HALFOPEN_TIMEOUT = 60
+# a stream the peer logged out writes what it still has queued, giving
+# up once a write took longer than this
+P2P_LINGER_TIMEOUT = 30
+# a clientid is a stream table slot in the low bits and the slot's
+# generation above them, 2**20 streams at once
+P2P_SLOT_BITS = 20
+# one second ticks, 64 slots a level, three levels reach 64**3 ticks
+P2P_TIMER_BITS = 6
+P2P_TIMER_LEVELS = 3
+# histogram buckets in seconds
+P2P_SETUP_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+P2P_LIFETIME_BUCKETS = (0.1, 1, 10, 60, 300, 1800, 3600)
+# tunnel payloads shorter than this are read into the frame buffer
+P2P_SPLICE_MIN = 4*P2P_BUFFER_MAX
+# tunnel bytes kept for a resumable session until the peer acknowledges them
+P2P_REPLAY_BUFFER = 8*1024*1024
+# client: seconds before the first reconnect, doubled up to the max while
+# connecting fails, half of it random
+P2P_RECONNECT_MIN = 0.5
+P2P_RECONNECT_MAX = 30
+# udp tunnels: payload bytes in a datagram, small enough for any path
+P2P_UDP_MSS = 1200
+# acks wait this long for a second datagram to acknowledge along
+P2P_UDP_ACK_DELAY = 0.01
+# packet number ranges an ack carries, newest first
+P2P_UDP_ACK_RANGES = 32
+# retransmission timeout before the first rtt sample, its bounds, and 
+# the timeouts in a row after which the peer is taken for gone
+P2P_UDP_RTO = 0.5
+P2P_UDP_RTO_MIN = 0.05
+P2P_UDP_RTO_MAX = 8
+P2P_UDP_RETRIES = 8
+# seconds the segments of a closed clientid are still taken for late copies
+P2P_UDP_LINGER = 60
+P2P_UDP_SOCKET_BUFFER = 4*1024*1024
+# -http: request and response heads bigger than this go raw
+P2P_HTTP_HEAD_MAX = 64*1024
+P2P_HTTP_CACHE = 64*1024*1024
+# responses without an expiry stay fresh for this share of their age
+# since Last-Modified, RFC 7234 4.2.2, up to a day
+P2P_HTTP_HEURISTIC = 0.1
+P2P_HTTP_HEURISTIC_MAX = 24*3600
+# headers of a connection rather than of the response, not stored
+P2P_HTTP_HOP = frozenset(['connection', 'keep-alive', 'proxy-connection', 'te', 'trailer', 
+    'transfer-encoding', 'upgrade', 'content-length', 'age'])
+# -capture file: a header, then a record per tunnel frame, each one
+# followed by the payload bytes it kept. dir 0 read, 1 written
+P2P_CAPTURE_MAGIC = 'P2PCAP1\n'
+P2P_CAPTURE_HEADER = struct.Struct('<8s8sd')
+P2P_CAPTURE_RECORD = struct.Struct('<dBiiII')
+# the file grows and is mapped this much at a time
+P2P_CAPTURE_SEGMENT = 8*1024*1024
+# -diagnostics: a hub held this many seconds is a block, and the main
+# thread is sampled this often
+P2P_DIAG_BLOCK = 0.1
+P2P_DIAG_SAMPLE = 0.01
+# blocks kept for the dump, frames of a sampled stack kept
+P2P_DIAG_BLOCKS = 32
+P2P_DIAG_DEPTH = 24
+# greenlet loops samples are counted under, rather than what spawned them
+P2P_DIAG_ROLES = frozenset(['onread', 'onwrite', 'onclientread', 'write_loop', 'read_loop', 
+    'serve_http'])
+# records per second let through for each message format
+P2P_LOG_RATE = 20
+# records waiting for the writer thread before new ones are dropped
+P2P_LOG_QUEUE = 10000
+
+# count, clientid, cmd
+P2P_HEADER = struct.Struct('iii')
+# P2P_CMD_WINDOW payload: credit in bytes
+P2P_WINDOW = struct.Struct('i')
+# lz4 compressed stream data: compressed and plain size of each block
+P2P_LZ4_BLOCK = struct.Struct('<II')
+# P2P_CMD_ACK payload: tunnel bytes read since the session began
+P2P_ACK = struct.Struct('Q')
+# udp tunnel datagrams start with kind and connection id
+P2P_UDP_DATA = 1
+P2P_UDP_ACKS = 2
+P2P_UDP_RESET = 3
+P2P_UDP_KIND = struct.Struct('!BI')
+# kind, connid, packet number, clientid, sequence number within the clientid
+P2P_UDP_SEGMENT = struct.Struct('!BIIiI')
+# kind, connid, number of ranges, then first and last packet number of each
+P2P_UDP_ACK = struct.Struct('!BIB')
+P2P_UDP_RANGE = struct.Struct('!II')
+# only window updates follow these on a clientid, a udp tunnel forgets
+# the clientid once its own went out and the peer's came in
+P2P_UDP_LAST = (P2P_CMD_LOGOUT, P2P_CMD_OPEN_FAIL)
+
+# not exported by the python 2 modules, linux values
+SPLICE_F_MOVE = 1
+SPLICE_F_NONBLOCK = 2
+SPLICE_F_MORE = 4
+F_SETPIPE_SZ = 1031
+F_GETPIPE_SZ = 1032
+MSG_MORE = getattr(socket, 'MSG_MORE', 0x8000)
     
 def parse_address(address):
     try:
@@ -34,488 +189,3993 @@ def parse_address(address):
         sys.exit('Expected HOST:PORT: %r' % address)
     return gethostbyname(hostname), port
     
+def load_services(path):
+    """
+        service table, one 'name host:port [priority]' per line, # starts
+        a comment. The server listens on host:port and carries the name
+        in P2P_CMD_LOGIN, the client connects the name to its host:port.
+        priority is the tunnel scheduling level of the service's streams,
+        server side only, default 0.
+    """
+    services = []
+    names = set()
+    with open(path) as f:
+        for lineno, line in enumerate(f, 1):
+            fields = line.split('#', 1)[0].split()
+            if not fields:
+                continue
+                
+            if len(fields) not in (2, 3) or fields[0] in names:
+                sys.exit('%s:%d: expected a new name, host:port and an optional priority' % (path, lineno))
+                
+            names.add(fields[0])
+            priority = int(fields[2]) if len(fields) == 3 else 0
+            services.append((fields[0], fields[1], priority))
+            
+    return services
+    
+class AsyncLogHandler(logging.Handler):
+    """
+        formats and writes records on a thread of its own, a greenlet
+        that logs never waits for the disk. Each message format gets
+        rate records per second and a run of identical records is
+        folded into one line. Records are dropped, and counted, when
+        the writer falls behind.
+    """
+    def __init__(self, target, rate = P2P_LOG_RATE, size = P2P_LOG_QUEUE):
+        """
+            target : handler the writer thread passes records to
+            rate : records per second per message format, 0 for no limit
+            size : most records waiting for the writer
+        """
+        logging.Handler.__init__(self)
+        self.target = target
+        self.rate = rate
+        self.size = size
+        self.pid = None
+        self.records = deque()
+        self.event = None
+        self.dropped = 0
+        # rate limit window and the message formats seen in it
+        self.second = 0
+        self.counts = {}
+        self.suppressed = {}
+        self.last = None
+        self.repeated = 0
+        
+    def start(self):
+        # the writer thread does not survive a fork, every worker runs its own
+        self.pid = os.getpid()
+        self.records = deque()
+        self.event = threading.Event()
+        writer = threading.Thread(target = self.write_loop)
+        writer.daemon = True
+        writer.start()
+        
+    def emit(self, record):
+        if self.pid != os.getpid():
+            self.start()
+            
+        second = int(record.created)
+        if second != self.second:
+            self.second = second
+            self.counts.clear()
+            for msg, count in self.suppressed.items():
+                self.note(logging.WARNING, '%d more like "%s" suppressed', count, msg)
+            self.suppressed.clear()
+            
+        key = (record.levelno, record.msg, record.args)
+        if key == self.last:
+            self.repeated += 1
+            return
+            
+        if self.repeated:
+            self.note(self.last[0], 'last message repeated %d times', self.repeated)
+            self.repeated = 0
+            
+        count = self.counts.get(record.msg, 0) + 1
+        self.counts[record.msg] = count
+        if self.rate and count > self.rate:
+            self.suppressed[record.msg] = self.suppressed.get(record.msg, 0) + 1
+            return
+            
+        self.last = key
+        self.put(record)
+        
+    def note(self, level, msg, *args):
+        self.put(logging.makeLogRecord({'name': 'root', 'levelno': level, 
+            'levelname': logging.getLevelName(level), 'msg': msg, 'args': args}))
+        
+    def put(self, record):
+        if len(self.records) >= self.size:
+            self.dropped += 1
+            return
+            
+        if self.dropped:
+            dropped, self.dropped = self.dropped, 0
+            self.note(logging.WARNING, '%d records dropped, log writer behind', dropped)
+            
+        self.records.append(record)
+        self.event.set()
+        
+    def write_loop(self):
+        while True:
+            self.event.wait()
+            self.event.clear()
+            self.drain()
+            
+    def drain(self):
+        records = self.records
+        while records:
+            try:
+                record = records.popleft()
+            except IndexError:
+                break
+                
+            self.target.handle(record)
+            
+        self.target.flush()
+        
+    def close(self):
+        # at exit whatever is still queued goes out
+        self.drain()
+        self.target.close()
+        logging.Handler.close(self)
+        
+def setup_logging(path = 'p2pproxy.log', level = logging.INFO, rate = P2P_LOG_RATE):
+    """ path '-' logs to stderr, 'off' turns logging off """
+    if path == 'off':
+        logging.disable(logging.CRITICAL)
+        return
+        
+    if path == '-':
+        target = logging.StreamHandler()
+    else:
+        target = logging.FileHandler(path)
+        
+    target.setFormatter(logging.Formatter('%(asctime)s <%(name)s> [%(levelname)s]:%(message)s'))
+    root = logging.getLogger()
+    root.addHandler(AsyncLogHandler(target, rate))
+    root.setLevel(level)
+    
+def reuseport_listener(address, backlog = 128):
+    """ listening socket that other worker processes can bind as well """
+    sock = gevent.socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    # not exported by the python 2 socket module, 15 on linux
+    sock.setsockopt(socket.SOL_SOCKET, getattr(socket, 'SO_REUSEPORT', 15), 1)
+    sock.bind(address)
+    sock.listen(backlog)
+    return sock
+    
+def set_parent_death_signal(signum):
+    """ linux only: have the kernel signal us when the parent dies """
+    try:
+        import ctypes
+        libc = ctypes.CDLL(None)
+        # PR_SET_PDEATHSIG
+        libc.prctl(1, signum)
+    except (OSError, AttributeError):
+        pass
+        
+def fork_workers(workers, p2phost, stats = None):
+    """
+        fork workers - 1 child processes. Worker i talks over the tunnel
+        port p2p + i and serves -stats on port + i, so the two ranges
+        must not overlap. Returns the worker index of the calling
+        process, 0 in the parent, the child pids and the worker's 
+        tunnel and stats addresses.
+    """
+    if stats and abs(stats[1] - p2phost[1]) < workers:
+        sys.exit('-stats ports %d-%d overlap the -p2p ports %d-%d of -workers=%d' % (stats[1], 
+            stats[1] + workers - 1, p2phost[1], p2phost[1] + workers - 1, workers))
+        
+    children = []
+    for i in range(1, workers):
+        pid = gevent.fork()
+        if pid == 0:
+            set_parent_death_signal(signal.SIGTERM)
+            children = []
+            break
+            
+        children.append(pid)
+    else:
+        i = 0
+        
+    p2phost = (p2phost[0], p2phost[1] + i)
+    if stats:
+        stats = (stats[0], stats[1] + i)
+    return i, children, p2phost, stats
+    
+def stop_workers(children):
+    """ SIGTERM handler of a worker, the parent takes its children along """
+    for pid in children:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError:
+            pass
+            
+    sys.exit(0)
+    
+    
+class SocketOptions:
+    """ kernel buffer sizes and Nagle for one kind of socket """
+    def __init__(self, rcvbuf = 0, sndbuf = 0, nodelay = False):
+        """
+            rcvbuf, sndbuf : SO_RCVBUF and SO_SNDBUF, 0 leaves the kernel's autotuning
+            nodelay : TCP_NODELAY, small writes go out without waiting
+        """
+        self.rcvbuf = rcvbuf
+        self.sndbuf = sndbuf
+        self.nodelay = nodelay
+        
+    def apply(self, sock):
+        if self.rcvbuf:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.rcvbuf)
+        if self.sndbuf:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.sndbuf)
+        if self.nodelay:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            
+class Timeouts:
+    """ seconds of silence before the proxy gives up on something, 0 for never """
+    def __init__(self, keepalive = P2P_KEEPALIVE, tunnel = P2P_TUNNEL_TIMEOUT, idle = 0, 
+            halfopen = P2P_HALFOPEN_TIMEOUT):
+        """
+            keepalive : client: P2P_CMD_TIMER once the server was silent this long
+            tunnel : close the tunnel once the peer was silent this long
+            idle : close a stream once no data moved either way this long
+            halfopen : client: close a stream whose backend closed once
+                       the server sent nothing this long, 0 for idle
+        """
+        self.keepalive = keepalive
+        self.tunnel = tunnel
+        self.idle = idle
+        self.halfopen = halfopen
+        
+def parse_size(text):
+    """ bytes, with an optional k, m or g suffix for powers of 1024 """
+    text = text.lower()
+    scale = 1
+    if text and text[-1] in 'kmg':
+        scale = 1024 ** ('kmg'.index(text[-1]) + 1)
+        text = text[:-1]
+    return int(float(text) * scale)
+    
+class TokenBucket:
+    """ rate bytes a second on average, up to burst at once after a quiet spell """
+    def __init__(self, rate, burst = 0):
+        self.rate = self.burst = self.tokens = 0
+        self.stamp = time.time()
+        self.configure(rate, burst)
+        self.tokens = self.burst
+        
+    def configure(self, rate, burst = 0):
+        """ burst 0 for a tenth of a second's worth, at least a full read """
+        self.refill(time.time())
+        self.rate = float(rate)
+        self.burst = burst or max(rate / 10, P2P_CHUNK_MAX)
+        self.tokens = min(self.tokens, self.burst)
+        
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        
+    def delay(self, now):
+        """ seconds until what was taken beyond the tokens is paid back """
+        self.refill(now)
+        return -self.tokens / self.rate if self.tokens < 0 else 0
+        
+class RateLimits:
+    """
+        the token buckets of -ratelimit, read again on SIGHUP. One file
+        line per limit, # starts a comment, rates and bursts in bytes a
+        second with k, m or g:
+            total RATE [BURST]           all streams of the process together
+            service NAME RATE [BURST]    the streams of a service, '-' for the default
+            stream RATE [BURST]          each stream on its own
+            clientid ID RATE [BURST]     one stream, instead of the stream line
+        Each side shapes the data it reads from its own sockets, each
+        worker on its own.
+    """
+    def __init__(self):
+        self.path = None
+        # streams compare it to theirs and pick up a reload on their next read
+        self.version = 0
+        self.total = None
+        # service name -> TokenBucket
+        self.services = {}
+        # (rate, burst) of each stream, and of single clientids
+        self.stream = None
+        self.clientids = {}
+        
+    def load(self, path):
+        """ IOError or ValueError, and the limits as they were, when the file is wrong """
+        total, services, stream, clientids = None, {}, None, {}
+        with open(path) as f:
+            for lineno, line in enumerate(f, 1):
+                fields = line.split('#', 1)[0].split()
+                if not fields:
+                    continue
+                    
+                kind, args = fields[0], fields[1:]
+                named = kind in ('service', 'clientid')
+                if kind not in ('total', 'service', 'stream', 'clientid') or \
+                        not 1 + named <= len(args) <= 2 + named:
+                    raise ValueError('%s:%d: expected total, service NAME, stream or '
+                        'clientid ID, then RATE [BURST]' % (path, lineno))
+                    
+                name = args.pop(0) if named else None
+                try:
+                    limit = tuple(parse_size(a) for a in args) + (0,)
+                    if kind == 'clientid':
+                        name = int(name)
+                except ValueError:
+                    raise ValueError('%s:%d: expected numbers: %s' % (path, lineno, line.strip()))
+                if limit[0] <= 0:
+                    raise ValueError('%s:%d: rate must be above 0' % (path, lineno))
+                    
+                if kind == 'total':
+                    total = limit[:2]
+                elif kind == 'service':
+                    services['' if name == '-' else name] = limit[:2]
+                elif kind == 'stream':
+                    stream = limit[:2]
+                else:
+                    clientids[name] = limit[:2]
+            
+        # buckets that stay keep their tokens
+        self.total = self.rebucket(self.total, total)
+        self.services = dict((name, self.rebucket(self.services.get(name), limit)) 
+            for name, limit in services.items())
+        self.stream = stream
+        self.clientids = clientids
+        self.path = path
+        self.version += 1
+        logging.info('RateLimits loaded from %s', path)
+        
+    def reload(self, children = ()):
+        """ SIGHUP handler, a worker passes it on to its children """
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGHUP)
+            except OSError:
+                pass
+                
+        try:
+            self.load(self.path)
+        except (IOError, ValueError) as ex:
+            logging.error('RateLimits %s, the old limits stay', ex)
+        
+    def rebucket(self, bucket, limit):
+        if limit is None:
+            return None
+        if bucket is None:
+            return TokenBucket(*limit)
+        bucket.configure(*limit)
+        return bucket
+        
+    def shaper(self, clientid, service):
+        """ a new stream's Shaper, None while no file is loaded """
+        if self.path is None:
+            return None
+        return Shaper(self, clientid, service)
+        
+class Shaper(object):
+    """ the token buckets a stream's reads go through """
+    __slots__ = ('limits', 'clientid', 'service', 'own', 'buckets', 'version')
+    
+    def __init__(self, limits, clientid, service):
+        self.limits = limits
+        self.clientid = clientid
+        self.service = service
+        self.own = None
+        self.buckets = ()
+        self.version = None
+        
+    def refresh(self):
+        limits = self.limits
+        limit = limits.clientids.get(self.clientid, limits.stream)
+        self.own = limits.rebucket(self.own, limit)
+        self.buckets = [b for b in (self.own, limits.services.get(self.service), limits.total) 
+            if b is not None]
+        self.version = limits.version
+        
+    def delay(self):
+        """ seconds to wait before the next read, 0 for none """
+        if self.version != self.limits.version:
+            self.refresh()
+        now = time.time()
+        return max([b.delay(now) for b in self.buckets] or [0])
+        
+    def limit(self, count):
+        """ a read no bigger than the smallest burst """
+        for b in self.buckets:
+            count = min(count, int(b.burst))
+        return count
+        
+    def consume(self, count):
+        for b in self.buckets:
+            b.tokens -= count
+            
+limits = RateLimits()
+
+def load_splice():
+    """ splice(2) through ctypes, None where libc has none """
+    try:
+        import ctypes
+        libc = ctypes.CDLL(None, use_errno = True)
+        func = libc.splice
+    except (OSError, AttributeError):
+        return None
+        
+    func.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p, 
+        ctypes.c_size_t, ctypes.c_uint]
+    func.restype = ctypes.c_ssize_t
+    
+    def splice(fd_in, fd_out, count, flags):
+        n = func(fd_in, None, fd_out, None, count, flags)
+        if n < 0:
+            # failures are the sockets', handled where recv and send errors are
+            e = ctypes.get_errno()
+            raise socket.error(e, os.strerror(e))
+        return n
+        
+    return splice
+    
+splice = load_splice()
+
+class Pipe:
+    """
+        kernel pipe that stream data passes through on its way from one
+        socket to another, moved with splice(2) it never comes up into
+        python. The fds are closed when the last reference goes, so a
+        PipeChunk still queued somewhere keeps its pipe open
+    """
+    def __init__(self, size = P2P_STREAM_WINDOW):
+        self.r, self.w = os.pipe()
+        for fd in (self.r, self.w):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+            
+        try:
+            # a whole stream window fits, the pipe never fills up on us
+            fcntl.fcntl(self.w, F_SETPIPE_SZ, size)
+            self.size = fcntl.fcntl(self.w, F_GETPIPE_SZ)
+        except IOError:
+            self.size = 64*1024
+            
+        # bytes in the pipe
+        self.count = 0
+        
+    def __del__(self):
+        os.close(self.r)
+        os.close(self.w)
+        
+    def room(self):
+        return self.size - self.count
+        
+    def fill(self, fd, count):
+        """ splice up to count bytes from fd, 0 at eof, None when nothing moved """
+        try:
+            n = splice(fd, self.w, min(count, self.room()), SPLICE_F_MOVE | SPLICE_F_NONBLOCK)
+        except socket.error as e:
+            if e.args[0] == errno.EAGAIN:
+                return None
+            raise
+            
+        self.count += n
+        return n
+        
+    def drain(self, fd, count, more = False):
+        """ splice up to count bytes into fd, None when fd would block """
+        flags = SPLICE_F_MOVE | SPLICE_F_NONBLOCK
+        if more:
+            flags |= SPLICE_F_MORE
+            
+        try:
+            n = splice(self.r, fd, count, flags)
+        except socket.error as e:
+            if e.args[0] == errno.EAGAIN:
+                return None
+            raise
+            
+        self.count -= n
+        return n
+        
+class PipeChunk:
+    """ count bytes waiting in a Pipe, queued where a str would be """
+    def __init__(self, pipe, count):
+        self.pipe = pipe
+        self.count = count
+        
+    def __len__(self):
+        return self.count
+        
+def zlib_codec():
+    c = zlib.compressobj(1)
+    d = zlib.decompressobj()
+    return lambda data: c.compress(data) + c.flush(zlib.Z_SYNC_FLUSH), d.decompress
+    
+def zstd_codec():
+    c = zstandard.ZstdCompressor(level = 1).compressobj()
+    d = zstandard.ZstdDecompressor().decompressobj()
+    return lambda data: c.compress(data) + c.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK), d.decompress
+    
+def lz4_codec():
+    # python-lz4's frame decompressor holds decoded blocks back when
+    # they come in pieces, so every frame is an lz4 block of its own
+    # behind its sizes. Blocks carry no dictionary over, lz4 is there
+    # for speed
+    pending = bytearray()
+    
+    def compress(data):
+        out = lz4.block.compress(data, store_size = False)
+        return P2P_LZ4_BLOCK.pack(len(out), len(data)) + out
+        
+    def decompress(data):
+        pending.extend(data)
+        out = []
+        while len(pending) >= P2P_LZ4_BLOCK.size:
+            count, size = P2P_LZ4_BLOCK.unpack_from(pending)
+            # a block is one read of the peer's, the size is not
+            # allocated on its word alone
+            if size > P2P_STREAM_WINDOW or count > P2P_FRAME_MAX:
+                raise ValueError('lz4 block of %d bytes, %d plain' % (count, size))
+            end = P2P_LZ4_BLOCK.size + count
+            if len(pending) < end:
+                break
+                
+            out.append(lz4.block.decompress(bytes(pending[P2P_LZ4_BLOCK.size:end]), 
+                uncompressed_size = size))
+            del pending[:end]
+            
+        return b''.join(out)
+        
+    return compress, decompress
+    
+# name -> (compress, decompress) factory, client offers are tried in order
+P2P_CODECS = {'zlib': zlib_codec}
+if zstandard is not None:
+    P2P_CODECS['zstd'] = zstd_codec
+if lz4 is not None:
+    P2P_CODECS['lz4'] = lz4_codec
+    
+class StreamCodec:
+    """
+        compression state of one stream, a compressor for what we send
+        and a decompressor for what the peer sends. Each frame is
+        flushed so the peer can decode it on arrival, the dictionary
+        carries over between frames.
+    """
+    def __init__(self, name):
+        self.compressor, self.decompressor = P2P_CODECS[name]()
+        self.skip = 0
+        self.backoff = P2P_COMPRESS_SKIP
+        
+    def compress(self, data):
+        """ returns the cmd and payload of the DATA frame for data """
+        if len(data) < P2P_COMPRESS_MIN:
+            return P2P_CMD_DATA, data
+            
+        if self.skip > 0:
+            self.skip -= 1
+            return P2P_CMD_DATA, data
+            
+        out = self.compressor(data)
+        if len(out) * 8 > len(data) * 7:
+            # already compressed or encrypted, the peer's context has
+            # seen it so it still goes out compressed, the next don't
+            self.skip = self.backoff
+            self.backoff = min(self.backoff * 2, P2P_COMPRESS_SKIP_MAX)
+        else:
+            self.backoff = P2P_COMPRESS_SKIP
+            
+        return P2P_CMD_DATA | P2P_FLAG_COMPRESSED, out
+        
+    def decompress(self, data):
+        return self.decompressor(data.tobytes())
+        
+class Histogram:
+    """ cumulative buckets, prometheus style """
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        
+    def lines(self, name, labels):
+        lines = []
+        total = 0
+        for le, count in zip(self.buckets, self.counts):
+            total += count
+            lines.append('%s_bucket{%s,le="%g"} %d' % (name, labels, le, total))
+            
+        total += self.counts[-1]
+        lines.append('%s_bucket{%s,le="+Inf"} %d' % (name, labels, total))
+        lines.append('%s_sum{%s} %f' % (name, labels, self.sum))
+        lines.append('%s_count{%s} %d' % (name, labels, total))
+        return lines
+        
+class Metrics:
+    """
+        traffic counters of this process. Open sessions count on their
+        own attributes, which are folded into the totals when they close,
+        so the data path only pays for an attribute add
+    """
+    FIELDS = ('bytes_in', 'bytes_out', 'frames_in', 'frames_out', 'stall_time', 'send_time')
+    
+    def __init__(self):
+        self.role = 'client'
+        # session -> (kind, clientid), kind is 'tunnel' or 'stream'
+        self.sessions = {}
+        self.totals = {'tunnel': [0] * len(self.FIELDS), 'stream': [0] * len(self.FIELDS)}
+        # server: LOGIN to OPEN_OK, client: backend connect
+        self.setup = Histogram(P2P_SETUP_BUCKETS)
+        self.lifetime = Histogram(P2P_LIFETIME_BUCKETS)
+        self.opened = 0
+        self.failed = 0
+        self.retransmits = 0
+        self.shaped = 0
+        # -http requests by what the cache did with them, and the cache
+        self.http = dict.fromkeys(('hit', 'revalidated', 'miss', 'raw'), 0)
+        self.cache = None
+        
+    def add(self, session, kind, clientid = 0):
+        self.sessions[session] = (kind, clientid)
+        if kind == 'stream':
+            self.opened += 1
+            
+    def remove(self, session):
+        if session not in self.sessions:
+            return
+            
+        kind, clientid = self.sessions.pop(session)
+        totals = self.totals[kind]
+        for i, field in enumerate(self.FIELDS):
+            totals[i] += getattr(session, field)
+            
+        if kind == 'stream':
+            self.lifetime.observe(time.time() - session.created)
+            
+    def render(self):
+        """ prometheus text format """
+        totals = dict((kind, list(t)) for kind, t in self.totals.items())
+        streams = []
+        tunnels = []
+        for session, (kind, clientid) in self.sessions.items():
+            t = totals[kind]
+            for i, field in enumerate(self.FIELDS):
+                t[i] += getattr(session, field)
+                
+            if kind == 'stream':
+                streams.append((clientid, session))
+            else:
+                tunnels.append(session)
+        streams.sort()
+                
+        role = 'role="%s"' % self.role
+        lines = []
+        def add(name, kind, help, samples):
+            lines.append('# HELP p2p_%s %s' % (name, help))
+            lines.append('# TYPE p2p_%s %s' % (name, kind))
+            for labels, value in samples:
+                lines.append('p2p_%s{%s} %s' % (name, ','.join([role] + labels), value))
+                
+        def by_kind(i, dirs = True):
+            if not dirs:
+                return [(['kind="%s"' % k], '%f' % totals[k][i]) for k in ('tunnel', 'stream')]
+            return [(['kind="%s"' % k, 'dir="%s"' % d], totals[k][i + j]) 
+                for k in ('tunnel', 'stream') for j, d in enumerate(('in', 'out'))]
+                
+        add('bytes_total', 'counter', 'bytes received from and sent to the sockets', by_kind(0))
+        add('frames_total', 'counter', 'tunnel frames, stream socket reads and writes', by_kind(2))
+        add('window_stall_seconds_total', 'counter', 'time waited for peer credit', by_kind(4, False))
+        add('send_seconds_total', 'counter', 'time in socket sends, blocked time included', by_kind(5, False))
+        add('tunnels', 'gauge', 'open tunnel connections', [([], len(tunnels))])
+        add('streams', 'gauge', 'open streams', [([], len(streams))])
+        add('streams_opened_total', 'counter', 'streams opened', [([], self.opened)])
+        add('streams_failed_total', 'counter', 'streams whose setup failed', [([], self.failed)])
+        add('udp_retransmits_total', 'counter', 'udp tunnel segments sent again after a loss', 
+            [([], self.retransmits)])
+        add('ratelimit_seconds_total', 'counter', 'time streams waited for -ratelimit tokens', 
+            [([], self.shaped)])
+        if self.cache is not None:
+            add('http_cache_requests_total', 'counter', 'http requests by what the cache did, '
+                'raw ones turned their connection into a plain stream', 
+                [(['result="%s"' % k], v) for k, v in sorted(self.http.items())])
+            add('http_cache_bytes', 'gauge', 'responses held by the http cache', 
+                [(['tier="memory"'], self.cache.size), (['tier="disk"'], self.cache.disk_size)])
+        if diagnostics.active:
+            add('hub_blocks_total', 'counter', 'times one greenlet held the hub past -diagnostics', 
+                [([], diagnostics.block_count)])
+            add('hub_blocked_seconds_total', 'counter', 'time the hub was held in those blocks', 
+                [([], '%f' % diagnostics.block_time)])
+        add('tunnel_queue_frames', 'gauge', 'frames waiting in a tunnel write queue', 
+            [(['tunnel="%d"' % i], tunnel.queue.qsize()) for i, tunnel in enumerate(tunnels)])
+        add('tunnel_pending_bytes', 'gauge', 'bytes queued for a tunnel socket', 
+            [(['tunnel="%d"' % i], tunnel.pending) for i, tunnel in enumerate(tunnels)])
+        add('stream_bytes', 'gauge', 'bytes moved by an open stream', 
+            [(['clientid="%d"' % c, 'dir="in"'], ss.bytes_in) for c, ss in streams] + 
+            [(['clientid="%d"' % c, 'dir="out"'], ss.bytes_out) for c, ss in streams])
+        add('timers', 'gauge', 'timers on the timer wheel, cancelled ones until dropped', 
+            [([], timers.count)])
+        add('timer_wakeups_total', 'counter', 'ticks of the timer wheel', [([], timers.wakeups)])
+        add('timer_callbacks_total', 'counter', 'timers that fired', [([], timers.fired)])
+            
+        for name, hist, help in [
+                ('stream_setup_seconds', self.setup, 'server: LOGIN to OPEN_OK, client: backend connect'),
+                ('stream_lifetime_seconds', self.lifetime, 'lifetime of closed streams')]:
+            lines.append('# HELP p2p_%s %s' % (name, help))
+            lines.append('# TYPE p2p_%s histogram' % name)
+            lines.extend(hist.lines('p2p_' + name, role))
+                
+        return '\n'.join(lines) + '\n'
+        
+metrics = Metrics()
+
+def stats_app(environ, start_response):
+    start_response('200 OK', [('Content-Type', 'text/plain; version=0.0.4')])
+    return [metrics.render()]
+    
+def start_stats(address):
+    """ serve the metrics over http at address, any path """
+    server = WSGIServer(address, stats_app, log = None)
+    server.start()
+    return server
+    
+class Capture:
+    """
+        -capture: a record of every frame a tunnel reads or queues, 
+        time, clientid, cmd and length, with the first payload bytes of
+        its payload. The file grows a mapped segment at a time, a record
+        is a copy into the map and the kernel writes the pages back, so
+        the hub only waits on the file when it maps the next segment
+    """
+    IN = 0
+    OUT = 1
+    
+    def __init__(self):
+        self.active = False
+        self.payload = 0
+        self.fd = None
+        self.map = None
+        # file offset of the mapped segment, and the next byte in it
+        self.base = 0
+        self.offset = 0
+        
+    def open(self, path, payload, role):
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0644)
+        self.payload = payload
+        self.next_segment()
+        self.put(P2P_CAPTURE_HEADER.pack(P2P_CAPTURE_MAGIC, role, time.time()))
+        self.active = True
+        atexit.register(self.close)
+        
+    def next_segment(self):
+        if self.map is not None:
+            self.base += len(self.map)
+            self.map.close()
+        os.ftruncate(self.fd, self.base + P2P_CAPTURE_SEGMENT)
+        self.map = mmap.mmap(self.fd, P2P_CAPTURE_SEGMENT, offset = self.base)
+        self.offset = 0
+        
+    def put(self, data):
+        while data:
+            n = min(len(data), len(self.map) - self.offset)
+            self.map[self.offset:self.offset + n] = data[:n]
+            self.offset += n
+            data = data[n:]
+            if self.offset == len(self.map):
+                self.next_segment()
+                
+    def record(self, direction, clientid, cmd, count, payload = ''):
+        """ payload : what there is of it, str, bytearray, memoryview or PipeChunk """
+        if not self.payload or payload.__class__ is PipeChunk:
+            payload = ''
+        elif payload.__class__ is memoryview:
+            payload = payload[:self.payload].tobytes()
+        else:
+            payload = str(payload[:self.payload])
+        self.put(P2P_CAPTURE_RECORD.pack(time.time(), direction, clientid, cmd, count, 
+            len(payload)) + payload)
+        
+    def close(self):
+        """ cut the file down to what was written """
+        if not self.active:
+            return
+        self.active = False
+        length = self.base + self.offset
+        self.map.close()
+        os.ftruncate(self.fd, length)
+        os.close(self.fd)
+        
+capture = Capture()
+
+class Diagnostics:
+    """
+        -diagnostics: a monitor thread that watches the hub and samples
+        the main thread. A heartbeat greenlet stamps the time four times
+        per block threshold, a stamp older than that means one greenlet
+        holds the hub, and the stack it holds it with is kept. Samples
+        are counted by role, the outermost P2P_DIAG_ROLES loop on the 
+        stack or else the method the greenlet was spawned with, and hub
+        while the loop itself runs. Nothing is added to the greenlets'
+        own path. The dump goes to the log on SIGUSR1 and answers any
+        line sent to the command socket, from a thread of its own so a
+        blocked hub does not keep it
+    """
+    def __init__(self):
+        self.active = False
+        self.block = P2P_DIAG_BLOCK
+        self.sample = P2P_DIAG_SAMPLE
+        self.thread_id = None
+        self.beat = 0
+        # code object -> Class.method of this module
+        self.names = {}
+        # the block going on, those that ended and those still to be logged
+        self.blocked = None
+        self.blocks = deque(maxlen = P2P_DIAG_BLOCKS)
+        self.ended = deque()
+        self.block_count = 0
+        self.block_time = 0.0
+        # role -> samples, (role, stack) -> samples
+        self.roles = {}
+        self.stacks = {}
+        self.started = 0
+        
+    def start(self, block, sample, path = None):
+        """ seconds, sample 0 for no sampling, path of the command socket """
+        self.block = block
+        self.sample = sample
+        self.thread_id = threading.current_thread().ident
+        for name, value in globals().items():
+            if isinstance(value, (type, types.ClassType)):
+                for attr, f in vars(value).items():
+                    if isinstance(f, types.FunctionType):
+                        self.names[f.__code__] = '%s.%s' % (name, attr)
+            elif isinstance(value, types.FunctionType):
+                self.names[value.__code__] = name
+                
+        self.reset()
+        self.beat = time.time()
+        self.active = True
+        gevent.spawn(self.heartbeat)
+        gevent.signal(signal.SIGUSR1, lambda: 
+            logging.warning('Diagnostics dump\n%s', self.dump()))
+        threads = [self.monitor]
+        if path:
+            threads.append(functools.partial(self.serve, path))
+        for target in threads:
+            t = threading.Thread(target = target)
+            t.daemon = True
+            t.start()
+            
+    def reset(self):
+        self.roles = {}
+        self.stacks = {}
+        self.started = time.time()
+        
+    def heartbeat(self):
+        while True:
+            gevent.sleep(self.block / 4)
+            self.beat = time.time()
+            while self.ended:
+                record = self.ended.popleft()
+                logging.warning('Diagnostics hub blocked %.0f ms by %s at %s', 
+                    record['seconds'] * 1e3, record['role'], record['stack'][-1].strip())
+                    
+    def monitor(self):
+        try:
+            self.watch()
+        except Exception:
+            # module globals are gone under a daemon thread at exit
+            if sys is not None:
+                raise
+                
+    def watch(self):
+        period = min(self.block / 4, self.sample or self.block)
+        while True:
+            time.sleep(period)
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+                
+            # the heartbeat is due every block / 4
+            held = time.time() - self.beat - self.block / 4
+            if held > self.block:
+                if self.blocked is None:
+                    role, stack = self.describe(frame)
+                    self.blocked = {'time': self.beat, 'seconds': held, 'role': role, 
+                        'stack': traceback.format_stack(frame, P2P_DIAG_DEPTH)}
+                self.blocked['seconds'] = held
+            elif self.blocked is not None:
+                record, self.blocked = self.blocked, None
+                self.block_count += 1
+                self.block_time += record['seconds']
+                self.blocks.append(record)
+                self.ended.append(record)
+                
+            if self.sample:
+                role, stack = self.describe(frame)
+                self.roles[role] = self.roles.get(role, 0) + 1
+                key = (role, stack)
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+                
+    def describe(self, frame):
+        """ role and the outermost first stack of a frame's greenlet """
+        names = []
+        codes = []
+        while frame is not None:
+            code = frame.f_code
+            codes.append(code)
+            names.append(self.names.get(code) or '%s:%s' % (os.path.basename(code.co_filename), 
+                code.co_name))
+            frame = frame.f_back
+        names.reverse()
+        codes.reverse()
+        
+        role = None
+        for code, name in zip(codes, names):
+            if code.co_name in P2P_DIAG_ROLES:
+                role = name
+                break
+            if role is None and code in self.names:
+                role = name
+        if role is None:
+            # the hub runs its loop, or a greenlet from outside this module
+            role = 'hub' if names[0] == 'hub.py:run' else names[0]
+        return role, ';'.join(names[-P2P_DIAG_DEPTH:])
+        
+    def greenlets(self):
+        """ (count, role, where it waits) of every greenlet """
+        counts = {}
+        for g in gc.get_objects():
+            if isinstance(g, greenlet.greenlet) and g.gr_frame is not None:
+                role, stack = self.describe(g.gr_frame)
+                key = (role, stack.rsplit(';', 1)[-1])
+                counts[key] = counts.get(key, 0) + 1
+        return sorted(((n,) + key for key, n in counts.items()), reverse = True)
+        
+    def dump(self):
+        now = time.time()
+        lines = ['hub blocks over %.0f ms: %d, %.3f s in all' % (self.block * 1e3, 
+            self.block_count, self.block_time)]
+        blocks = list(self.blocks) + ([self.blocked] if self.blocked else [])
+        for record in blocks:
+            lines.append('  %s %.0f ms by %s%s' % (time.strftime('%H:%M:%S', 
+                time.localtime(record['time'])), record['seconds'] * 1e3, record['role'], 
+                record is self.blocked and ', still blocked' or ''))
+            lines.extend('    ' + l.rstrip().replace('\n', '\n    ') for l in record['stack'])
+            
+        total = sum(self.roles.values())
+        if total:
+            lines.append('samples every %.0f ms over %.1f s: %d, by role' % (self.sample * 1e3, 
+                now - self.started, total))
+            for role, n in sorted(self.roles.items(), key = lambda r: -r[1]):
+                lines.append('  %5.1f%% %s' % (100.0 * n / total, role))
+            lines.append('top stacks, outermost first')
+            for (role, stack), n in sorted(self.stacks.items(), key = lambda s: -s[1])[:20]:
+                lines.append('  %6d %s' % (n, stack))
+                
+        lines.append('greenlets by role and where they wait')
+        for n, role, where in self.greenlets()[:30]:
+            lines.append('  %6d %s at %s' % (n, role, where))
+        return '\n'.join(lines) + '\n'
+        
+    def serve(self, path):
+        """ command socket thread, plain blocking sockets: reset, else the dump """
+        if os.path.exists(path):
+            os.unlink(path)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(path)
+        listener.listen(4)
+        while True:
+            sock, address = listener.accept()
+            try:
+                sock.settimeout(5)
+                command = sock.recv(256).strip()
+                if command == 'reset':
+                    self.reset()
+                    sock.sendall('ok\n')
+                else:
+                    sock.sendall(self.dump())
+            except Exception as ex:
+                logging.error('Diagnostics command failed: %s', ex)
+            finally:
+                sock.close()
+                
+diagnostics = Diagnostics()
+
+class FairQueue:
+    """
+        write queue of a tunnel session. Frames of one clientid keep
+        their order, clientids are served deficit round robin so a bulk
+        stream cannot starve the others. Lower priority levels go first,
+        a level is only served when every level before it is empty.
+    """
+    def __init__(self, quantum = 4*P2P_BUFFER_MAX):
+        self.quantum = quantum
+        self.count = 0
+        self.event = Event()
+        # frames that may overtake stream data (window updates, keepalive)
+        self.urgent = deque()
+        self.streams = {}
+        self.deficit = {}
+        # level -> clientids with queued frames, in round robin order
+        self.levels = {}
+        self.priority = {}
+        
+    def set_priority(self, key, level):
+        if level == 0:
+            self.priority.pop(key, None)
+        else:
+            self.priority[key] = level
+            
+    def put(self, item, key = 0, urgent = False):
+        if urgent:
+            self.urgent.append(item)
+        else:
+            q = self.streams.get(key)
+            if q is None:
+                q = self.streams[key] = deque()
+                self.deficit[key] = 0
+                self.levels.setdefault(self.priority.get(key, 0), deque()).append(key)
+                
+            q.append(item)
+            
+        self.count += 1
+        self.event.set()
+        
+    def empty(self):
+        return self.count == 0
+        
+    def qsize(self):
+        return self.count
+        
+    def get(self):
+        while self.count == 0:
+            self.event.clear()
+            self.event.wait()
+            
+        return self.get_nowait()
+        
+    def get_nowait(self):
+        if self.count == 0:
+            raise Empty
+            
+        self.count -= 1
+        if self.urgent:
+            return self.urgent.popleft()
+            
+        level = min(self.levels)
+        active = self.levels[level]
+        key = active[0]
+        q = self.streams[key]
+        if len(active) > 1:
+            size = sum(map(len, q[0]))
+            while self.deficit[key] < size:
+                # used up its share this round, next stream
+                self.deficit[key] += self.quantum
+                active.rotate(-1)
+                key = active[0]
+                q = self.streams[key]
+                size = sum(map(len, q[0]))
+                
+            self.deficit[key] -= size
+            
+        item = q.popleft()
+        if not q:
+            del self.streams[key]
+            del self.deficit[key]
+            active.popleft()
+            if not active:
+                del self.levels[level]
+                
+        return item
+        
+class Timer(object):
+    __slots__ = ('callback', 'args', 'expires')
+    
+    def __init__(self, callback, args, expires):
+        self.callback = callback
+        self.args = args
+        # tick of the wheel it is due at
+        self.expires = expires
+        
+    def cancel(self):
+        # left in its slot, dropped when the slot comes up
+        self.callback = self.args = None
+        
+class TimerWheel:
+    """
+        timeouts and periodic checks of every session on one greenlet,
+        instead of a sleeping greenlet each. Level 0 has a slot per tick,
+        a slot of each level above spans a whole turn of the one below
+        and is spread over it when that turn begins. Scheduling and
+        cancelling are O(1), a tick only touches the timers due in it
+        and those moving down a level. Resolution is one tick.
+    """
+    def __init__(self, bits = P2P_TIMER_BITS, levels = P2P_TIMER_LEVELS, tick = 1.0):
+        self.bits = bits
+        self.mask = (1 << bits) - 1
+        self.levels = [[[] for i in range(1 << bits)] for j in range(levels)]
+        # timers further out are due at the end of the last level
+        self.span = (1 << bits * levels) - 1
+        self.tick = tick
+        self.ticks = 0
+        # time of the last tick, for callers fine with that resolution
+        self.now = time.time()
+        self.runner = None
+        # timers in the slots, cancelled ones included until dropped
+        self.count = 0
+        # ticks run and callbacks made, read by metrics
+        self.wakeups = 0
+        self.fired = 0
+        
+    def schedule(self, delay, callback, *args):
+        """ callback(*args) in delay seconds, rounded up to a tick """
+        ticks = max(1, int(delay / self.tick + 0.999))
+        timer = Timer(callback, args, self.ticks + min(ticks, self.span))
+        self._place(timer)
+        self.count += 1
+        if self.runner is None:
+            # started on first use, after fork_workers, and stops
+            # when the wheel runs empty
+            self.now = time.time()
+            self.runner = gevent.spawn(self.run)
+        return timer
+        
+    def _place(self, timer):
+        delta = max(0, timer.expires - self.ticks)
+        level = 0
+        while level + 1 < len(self.levels) and delta >> self.bits * (level + 1):
+            level += 1
+            
+        slot = (timer.expires >> self.bits * level) & self.mask
+        self.levels[level][slot].append(timer)
+        
+    def _cascade(self):
+        """ spread the slots whose turn begins over the levels below """
+        for level in range(1, len(self.levels)):
+            shift = self.bits * level
+            if self.ticks & ((1 << shift) - 1):
+                break
+                
+            slots = self.levels[level]
+            index = (self.ticks >> shift) & self.mask
+            due, slots[index] = slots[index], []
+            for timer in due:
+                if timer.callback is None:
+                    self.count -= 1
+                else:
+                    self._place(timer)
+        
+    def run(self):
+        deadline = time.time()
+        while self.count:
+            deadline += self.tick
+            gevent.sleep(max(0, deadline - time.time()))
+            self.now = time.time()
+            self.ticks += 1
+            self.wakeups += 1
+            self._cascade()
+            
+            slots = self.levels[0]
+            index = self.ticks & self.mask
+            # timers scheduled by the callbacks go into a fresh list
+            due, slots[index] = slots[index], []
+            self.count -= len(due)
+            for timer in due:
+                callback, args = timer.callback, timer.args
+                if callback is None:
+                    continue
+                    
+                timer.cancel()
+                self.fired += 1
+                try:
+                    callback(*args)
+                except:
+                    logging.exception('TimerWheel callback failed')
+                    
+        self.runner = None
+        
+timers = TimerWheel()
+
+class StreamTable:
+    """
+        clientid -> stream session. Freed slots are reused oldest first
+        and get the next generation, so a frame still in flight for a
+        closed stream cannot reach the one that took over its slot.
+    """
+    def __init__(self, bits = P2P_SLOT_BITS):
+        self.bits = bits
+        # slot 0 is never used, clientid 0 belongs to the tunnel
+        self.sessions = [None]
+        self.ids = array.array('i', [0])
+        self.free = deque()
+        self.count = 0
+        
+    def add(self, session):
+        """ new clientid for session, None when all slots are taken """
+        if self.free:
+            slot = self.free.popleft()
+            generation = ((self.ids[slot] >> self.bits) + 1) % (1 << (31 - self.bits))
+        elif len(self.sessions) < 1 << self.bits:
+            slot = len(self.sessions)
+            generation = 0
+            self.sessions.append(None)
+            self.ids.append(0)
+        else:
+            return None
+            
+        clientid = generation << self.bits | slot
+        self.sessions[slot] = session
+        self.ids[slot] = clientid
+        self.count += 1
+        return clientid
+        
+    def _slot(self, clientid):
+        slot = clientid & ((1 << self.bits) - 1)
+        if slot < len(self.ids) and self.ids[slot] == clientid and self.sessions[slot] is not None:
+            return slot
+        return None
+        
+    def __contains__(self, clientid):
+        return self._slot(clientid) is not None
+        
+    def __getitem__(self, clientid):
+        slot = self._slot(clientid)
+        if slot is None:
+            raise KeyError(clientid)
+        return self.sessions[slot]
+        
+    def __delitem__(self, clientid):
+        slot = self._slot(clientid)
+        if slot is None:
+            raise KeyError(clientid)
+        self.sessions[slot] = None
+        self.free.append(slot)
+        self.count -= 1
+        
+    def __len__(self):
+        return self.count
+        
+    def keys(self):
+        return [self.ids[i] for i, s in enumerate(self.sessions) if s is not None]
+        
+class StreamQueue(deque):
+    """ write queue of a stream, the writer greenlet only runs while it has data """
+    def empty(self):
+        return not self
+        
+    get = get_nowait = deque.popleft
+        
+class P2pSession(object):
+    __slots__ = ('sock', 'queue', 'lazy', 'writer', 'event', 'timer', 'resume', 'loop', 
+        'last_read_time', 'last_write_time', 'window', 'limit', 'pending', 'consumed', 'window_update', 'compression', 'codec', 
+        'chunk', 'chunk_min', 'chunk_max', 'splice', 'bulk', 'read_pipe', 'write_pipe', 
+        'spliced', 'fileno', 'created', 'bytes_in', 'bytes_out', 'frames_in', 'frames_out', 
+        'stall_time', 'send_time', 'shaper', 'closing')
+        
+    def __init__(self, sock, window = 0, queue = None):
+        """
+            sock : connected socket
+            window : flow control window of a proxied stream, 0 for none
+            queue : write queue, a FairQueue for tunnel sessions. Streams
+                    get theirs and a writer greenlet on the first write
+        """
+        self.sock = sock
+        self.queue = queue
+        self.lazy = queue is None
+        self.writer = None
+        # set by add_window, break_loop and close, made on first wait
+        self.event = None
+        # the owner's TimerWheel entry
+        self.timer = None
+        # tunnels: Resumption when the session survives a reconnect
+        self.resume = None
+        self.loop = True 
+        # not timers.now, which stands still while the wheel is empty
+        self.last_read_time = self.last_write_time = time.time()
+        
+        # bytes this stream may still send to the peer
+        self.window = window
+        # bytes queued for the socket, capped at the window for streams
+        self.limit = window
+        self.pending = 0
+        # bytes written out since the last credit went back to the peer
+        self.consumed = 0
+        self.window_update = None
+        # tunnels: codec name agreed at login, streams: their StreamCodec
+        self.compression = None
+        self.codec = None
+        # streams: read size, grows between chunk_min and chunk_max
+        # while reads fill it, set up by the owner
+        self.chunk = self.chunk_min = self.chunk_max = P2P_BUFFER_MAX
+        # streams: move bulk reads with splice(2), set up by the owner
+        self.splice = False
+        self.bulk = False
+        # socket -> tunnel and tunnel -> socket pipes, made on first use
+        self.read_pipe = None
+        self.write_pipe = None
+        # a PipeChunk went into the write queue
+        self.spliced = False
+        # streams: the Shaper of -ratelimit, set up by the owner
+        self.shaper = None
+        # streams: finish() was called, close once the queue is written
+        self.closing = False
+        self.fileno = sock.fileno()
+        # counters read by metrics
+        self.created = time.time()
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.frames_in = 0
+        self.frames_out = 0
+        self.stall_time = 0.0
+        self.send_time = 0.0
+        # cooperative blocking: recv/send park the greenlet on the hub's
+        # io watcher until the socket is ready, no polling
+        self.sock.settimeout(None)
+        
+    def is_timeout(self, seconds):
+        return timers.now - self.last_read_time > seconds
+        
+    def idle_time(self):
+        """ seconds since data last moved either way, to a tick """
+        return timers.now - max(self.last_read_time, self.last_write_time)
+        
+    def expire_after(self, seconds, callback, *args):
+        """ callback(*args) once the session was idle for seconds, 0 for never """
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+            
+        if seconds > 0 and self.sock is not None:
+            self.timer = timers.schedule(seconds, self._expire, seconds, callback, args)
+            
+    def _expire(self, seconds, callback, args):
+        # reads and writes only stamp the time, the timer moves on here
+        left = seconds - self.idle_time()
+        if left > 0:
+            self.timer = timers.schedule(left, self._expire, seconds, callback, args)
+        else:
+            self.timer = None
+            callback(*args)
+            
+    def is_loop(self):
+        return self.loop
+    
+    def break_loop(self):
+        self.loop = False  
+        self.wake()
+        
+    def wake(self):
+        if self.event is not None:
+            self.event.set()
+            
+    def park(self, timeout = None):
+        """ wait for the next wake(), or timeout seconds """
+        if self.event is None:
+            self.event = Event()
+        self.event.clear()
+        self.event.wait(timeout)
+        
+    def join(self):
+        """ streams: until the session is closed or its writer gave up """
+        while self.loop:
+            self.park()
+        
+    def _read_try(self, count):
+        try:
+            data = self.sock.recv(count)
+        except socket.error, e:
+            logging.error('sock recv error：%d', e.args[0])
+            raise
+                    
+        if data is None or len(data) == 0:
+            return None
+            
+        self.last_read_time = timers.now
+        self.bytes_in += len(data)
+        
+        return data
+        
+    def read_into(self, view):
+        try:
+            count = self.sock.recv_into(view)
+        except socket.error, e:
+            logging.error('sock recv error：%d', e.args[0])
+            raise
+            
+        if count > 0:
+            self.last_read_time = timers.now
+            self.bytes_in += count
+            
+        return count
+        
+    def set_chunk(self, chunk_min, chunk_max):
+        self.chunk = self.chunk_min = chunk_min
+        self.chunk_max = chunk_max
+        
+    def read(self, count):
+        if count < 0:
+            return self._read_try(self.chunk)
+        
+        data = []
+        need_read = count
+        while True:
+            chunk = self._read_try(need_read)
+            if chunk is None:
+                return None
+            else:
+                data.append(chunk)
+                need_read = need_read - len(chunk)
+                if need_read == 0:
+                    break
+        
+        return ''.join(data)
+        
+    def read_window(self):
+        """ read as much as the send window allows, waiting for credit """
+        if self.window <= 0:
+            stalled = time.time()
+            while self.window <= 0:
+                if not self.is_loop():
+                    return None
+                    
+                self.park()
+                
+            self.stall_time += time.time() - stalled
+            
+        count = min(self.chunk, self.window)
+        if self.shaper is not None:
+            # over a rate limit: asleep until the tokens are back, 
+            # close() still wakes us
+            delay = self.shaper.delay()
+            if delay > 0:
+                shaped = time.time()
+                while delay > 0:
+                    if not self.is_loop():
+                        return None
+                    self.park(delay)
+                    delay = self.shaper.delay()
+                metrics.shaped += time.time() - shaped
+            count = self.shaper.limit(count)
+            
+        if self.bulk:
+            if self.read_pipe is None:
+                self.read_pipe = Pipe()
+                
+            moved = None
+            if self.read_pipe.room() > 0:
+                size = min(self.chunk_max, self.window)
+                if self.shaper is not None:
+                    size = self.shaper.limit(size)
+                moved = self.splice_from(self.read_pipe, size)
+                if moved == 0:
+                    return None
+                    
+            # nothing came, wait for it below
+            if moved is not None:
+                count = moved
+                self.window -= count
+                self.frames_in += 1
+                if self.shaper is not None:
+                    self.shaper.consume(count)
+                # a short read, the stream has gone interactive
+                self.bulk = count >= P2P_BUFFER_MAX
+                return PipeChunk(self.read_pipe, count)
+            
+        data = self._read_try(count)
+        if data:
+            self.window -= len(data)
+            self.frames_in += 1
+            if self.shaper is not None:
+                self.shaper.consume(len(data))
+            if len(data) == self.chunk:
+                # the socket had more, fewer and bigger frames from now on
+                self.chunk = min(self.chunk * 2, self.chunk_max)
+            elif len(data) * 4 <= self.chunk:
+                # interactive again, small reads allocate small strings
+                self.chunk = max(self.chunk / 2, self.chunk_min)
+                
+            # a full read, more is waiting: the next ones go by splice
+            self.bulk = self.splice and len(data) == count
+            
+        return data
+        
+    def get_write_pipe(self):
+        """ pipe the tunnel can splice data for our socket into, None when full """
+        if self.sock is None:
+            return None
+            
+        if self.write_pipe is None:
+            self.write_pipe = Pipe()
+            
+        if self.write_pipe.room() < P2P_SPLICE_MIN:
+            return None
+            
+        return self.write_pipe
+        
+    def _wait(self, wait):
+        """ park until the socket is ready, False once the session is closed """
+        while self.sock is not None:
+            try:
+                # not the socket's own watcher, which close() would wake,
+                # so look again every second
+                wait(self.fileno, timeout = 1)
+                return self.sock is not None
+            except socket.timeout:
+                pass
+                
+        return False
+        
+    def splice_from(self, pipe, count):
+        """
+            move up to count bytes from the socket into pipe, 0 at eof.
+            None when nothing is waiting, or the pipe ran out of buffers
+            before bytes, the caller waits in a plain read instead
+        """
+        n = pipe.fill(self.fileno, count)
+        if n:
+            self.last_read_time = timers.now
+            self.bytes_in += n
+            
+        return n
+        
+    def _splice_to(self, chunk, more):
+        """ write the bytes of a PipeChunk to the socket """
+        count = len(chunk)
+        started = time.time()
+        while count > 0:
+            n = chunk.pipe.drain(self.fileno, count, more)
+            if n is None:
+                if not self._wait(gevent.socket.wait_write):
+                    return False
+                continue
+                
+            count -= n
+            
+        self.send_time += time.time() - started
+        self.bytes_out += len(chunk)
+        return True
+        
+    def add_window(self, count):
+        self.window += count
+        self.wake()
+        
+
+    def write(self, data):
+        if self.limit > 0 and self.pending + len(data) > self.limit:
+            return False
+            
+        self.pending += len(data)
+        self.frames_out += 1
+        if data.__class__ is PipeChunk:
+            self.spliced = True
+        self._put((data,))
+        return True
+        
+    def write_frame(self, clientid, cmd, data = ''):
+        # header and payload go through the queue as one item
+        self.pending += P2P_HEADER.size + len(data)
+        self.frames_out += 1
+        if capture.active:
+            capture.record(Capture.OUT, clientid, cmd, len(data), data)
+        if data.__class__ is PipeChunk:
+            self.spliced = True
+        self._put((P2P_HEADER.pack(len(data), clientid, cmd), data), 
+            clientid, cmd == P2P_CMD_WINDOW or clientid == 0)
+        
+    def _put(self, item, key = 0, urgent = False):
+        if not self.lazy:
+            self.queue.put(item, key, urgent)
+            return
+            
+        if self.queue is None:
+            self.queue = StreamQueue()
+        self.queue.append(item)
+        if self.writer is None and self.loop:
+            self.writer = gevent.spawn(self.write_loop)
+        
+    def _sent(self, count):
+        self.pending -= count
+        self.last_write_time = timers.now
+        if self.window_update is None:
+            return
+            
+        self.consumed += count
+        if self.consumed >= self.limit / 4:
+            self.window_update(self.consumed)
+            self.consumed = 0
+        
+    def _send_all(self, msg, flags = 0):        
+        msglen = len(msg)
+        if msglen == 0:
+            return False
+        
+        view = memoryview(msg)
+        totalsent = 0   
+        started = time.time()
+        while totalsent < msglen:
+            try:
+                sent = self.sock.send(view[totalsent:], flags)
+                if sent == 0:
+                    return False     
+                
+                totalsent = totalsent + sent
+                
+            except socket.error, e:
+                if e.args[0] != errno.EAGAIN and e.args[0] != errno.EWOULDBLOCK:
+                    logging.error('sock sendall error：%d', e.args[0])
+                    return False    
+                
+        self.send_time += time.time() - started
+        self.bytes_out += msglen
+        return True
+        
+    def _send_chunks(self, chunks):
+        """ runs of str go out in one send, PipeChunks are spliced in between """
+        run = bytearray()
+        for i, c in enumerate(chunks):
+            if c.__class__ is PipeChunk:
+                # the header waits for the payload, not a segment of its own
+                if run and not self._send_all(run, MSG_MORE):
+                    return False
+                    
+                run = bytearray()
+                if not self._splice_to(c, i + 1 < len(chunks)):
+                    return False
+            else:
+                run += c
+                
+        return not run or self._send_all(run)
+                
+    def write_loop(self):
+        """ tunnels: until closed, streams: until the queue runs dry """
+        ret = False        
+        try:
+            while True:
+                if self.lazy and not self.queue:
+                    if self.closing:
+                        self.close()
+                    break
+                    
+                chunks = self.queue.get()
+                if not self.is_loop():
+                    if chunks and self.resume is not None:
+                        # taken as the connection went, the next one sends it
+                        data = bytearray()
+                        for c in chunks:
+                            data += c
+                        self.resume.record(data)
+                    break
+                    
+                if not chunks:
+                    # left by the detach() of an earlier connection
+                    continue
+                    
+                # drain whatever else is queued into one send
+                size = sum(len(c) for c in chunks)
+                chunks = list(chunks)
+                while size < P2P_WRITE_BATCH and not self.queue.empty():
+                    more = self.queue.get_nowait()
+                    chunks.extend(more)
+                    size += sum(len(c) for c in more)
+                    
+                if self.spliced:
+                    sent = self._send_chunks(chunks)
+                else:
+                    if len(chunks) == 1:
+                        data = chunks[0]
+                    else:
+                        data = bytearray()
+                        for c in chunks:
+                            data += c
+                            
+                    if self.resume is not None:
+                        self.resume.record(data)
+                    sent = self._send_all(data)
+                        
+                if not sent:
+                    self.break_loop()
+                    break
+                    
+                self._sent(size)
+                    
+            ret = True
+        except:        
+            self.break_loop()
+        finally:
+            self.writer = None
+        
+        return ret
+        
+    def close(self):
+        self.loop = False        
+        if self.sock != None:            
+            metrics.remove(self)
+            self.sock.close()            
+            if self.lazy:
+                self.queue = None
+            else:
+                self.queue.put(()) # break queue.get()
+            self.wake() # break read_window() and join()
+            if self.timer is not None:
+                self.timer.cancel()
+            
+            self.sock = None
+            # queued PipeChunks hold on to their pipe until written
+            self.read_pipe = None
+            self.write_pipe = None
+            
+    def finish(self):
+        """ streams: close once what is queued for the socket has been written """
+        if self.writer is None and not self.queue:
+            self.close()
+            return
+            
+        self.closing = True
+        self.expire_after(P2P_LINGER_TIMEOUT, self.close)
+        
+    def detach(self):
+        """
+            tunnels that can resume: close the connection, keep the queue,
+            the counters and the streams for attach()
+        """
+        self.loop = False
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+            
+        if self.sock != None:
+            self.sock.close()
+            self.sock = None
+            self.queue.put(()) # break queue.get()
+            
+    def attach(self, sock):
+        """ carry on over a new connection after detach() """
+        if self.timer is not None:
+            # the one that would have given up on us
+            self.timer.cancel()
+            self.timer = None
+        self.sock = sock
+        self.fileno = sock.fileno()
+        self.loop = True
+        self.last_read_time = self.last_write_time = time.time()
+        self.sock.settimeout(None)
+        
+    def drop(self):
+        """ tunnels: the connection failed or timed out """
+        if self.resume is not None:
+            self.detach()
+        else:
+            self.close()
+        
+class Resumption:
+    """
+        what lets a tunnel session carry on over a new connection. The
+        tunnel bytes each way are numbered from the start of the session
+        and the sender keeps them until the peer acknowledges them with
+        P2P_CMD_ACK. On reconnect each side says how far it read and the
+        other sends the rest again. The decoder stays with the session,
+        with what it read but did not hand out yet, half a frame included
+    """
+    def __init__(self, token, limit = P2P_REPLAY_BUFFER):
+        self.token = token
+        self.limit = limit
+        self.chunks = deque()
+        # offsets of the first byte kept and of the next one sent
+        self.start = 0
+        self.end = 0
+        # bytes read when the last P2P_CMD_ACK went out
+        self.acked = 0
+        self.decoder = None
+        # greenlet of the connection running the session, None between them
+        self.owner = None
+        
+    def record(self, data):
+        """ data went out, str or a bytearray nobody writes to again """
+        self.chunks.append(data)
+        self.end += len(data)
+        while self.end - self.start > self.limit:
+            # the peer is too far behind, it cannot resume from before here
+            self.start += len(self.chunks.popleft())
+            
+    def trim(self, offset):
+        """ the peer read everything before offset """
+        while self.chunks and self.start + len(self.chunks[0]) <= offset:
+            self.start += len(self.chunks.popleft())
+            
+    def since(self, offset):
+        """ what to send again to a peer that read up to offset, None when it is gone """
+        if not self.start <= offset <= self.end:
+            return None
+            
+        chunks = []
+        skip = offset - self.start
+        for c in self.chunks:
+            if skip >= len(c):
+                skip -= len(c)
+            else:
+                chunks.append(c[skip:] if skip else c)
+                skip = 0
+                
+        return chunks
+        
+    def acknowledge(self, session, force = False):
+        """ P2P_CMD_ACK once a quarter of the peer's buffer was read, or anything when forced """
+        count = session.bytes_in - self.acked
+        if count >= self.limit / 4 or (force and count > 0):
+            self.acked = session.bytes_in
+            session.write_frame(0, P2P_CMD_ACK, P2P_ACK.pack(self.acked))
+            
+def send_frame(sock, clientid, cmd, data = ''):
+    """ a frame straight to the socket, the login goes ahead of any queue """
+    sock.sendall(P2P_HEADER.pack(len(data), clientid, cmd) + data)
+    
+def recv_frame(sock):
+    """ the next frame on the socket and not a byte more, IOError at eof """
+    def recv_exactly(count):
+        data = ''
+        while len(data) < count:
+            chunk = sock.recv(count - len(data))
+            if not chunk:
+                raise IOError('connection closed')
+            data += chunk
+        return data
+        
+    count, clientid, cmd = P2P_HEADER.unpack(recv_exactly(P2P_HEADER.size))
+    if not 0 <= count <= P2P_FRAME_MAX:
+        raise IOError('frame cmd[%d] count[%d] is error' % (cmd, count))
+        
+    return clientid, cmd, recv_exactly(count)
+    
+def new_token():
+    return os.urandom(8).encode('hex')
+        
+class FrameDecoder:
+    def __init__(self, session, size = P2P_RECV_BUFFER, sink = None):
+        """
+            session : tunnel session the frames are read from
+            size : initial receive buffer size
+            sink : sink(clientid, cmd) returns a Pipe a DATA payload may
+                   be spliced into instead of read, or None
+        """
+        self.session = session
+        self.sink = sink
+        self.size = size
+        self.buf = bytearray(size)
+        self.view = memoryview(self.buf)
+        self.start = 0
+        self.end = 0
+        # a DATA payload view into buf is still held by someone
+        self.lent = False
+        # the last payload went to a sink, read no further than the
+        # next header so the one after can go the same way
+        self.exact = False
+        # the frame being read, kept here rather than in frames() so a
+        # resumed tunnel's next frames() picks up in the middle of it
+        self.frame = None
+        
+    def _reserve(self, count):
+        """ make room for count bytes after self.start """
+        if self.start == self.end and not self.lent:
+            self.start = self.end = 0
+            
+        if len(self.buf) - self.start >= count and self.end < len(self.buf):
+            return
+            
+        pending = self.end - self.start
+        if self.lent or len(self.buf) < count:
+            # views handed out still point at the old buffer, move to a new one
+            buf = bytearray(max(self.size, count))
+            buf[:pending] = self.view[self.start:self.end]
+            self.buf = buf
+            self.view = memoryview(buf)
+            self.lent = False
+        else:
+            self.buf[:pending] = self.buf[self.start:self.end]
+            
+        self.start = 0
+        self.end = pending
+        
+    def _fill(self, count):
+        """ read until count bytes are buffered, False on eof """
+        if self.end - self.start >= count:
+            return True
+            
+        self._reserve(count)
+        while self.end - self.start < count:
+            if self.exact:
+                n = self.session.read_into(self.view[self.end:self.start + count])
+            else:
+                n = self.session.read_into(self.view[self.end:])
+            if not n:
+                return False
+            self.end += n
+            
+        return True
+        
+    def frames(self):
+        """
+            yield (clientid, cmd, data) for every frame on the session.
+            DATA payloads are yielded as memoryview pieces of the receive
+            buffer as soon as they arrive, or as PipeChunks when the sink
+            takes them, cmd keeps P2P_FLAG_COMPRESSED. Other commands
+            come with their whole payload as str
+        """
+        while True:
+            if self.frame is None:
+                if not self._fill(P2P_HEADER.size):
+                    return
+                    
+                count, clientid, cmd = P2P_HEADER.unpack_from(self.buf, self.start)
+                self.start += P2P_HEADER.size
+                self.session.frames_in += 1
+                
+                is_data = (cmd & ~P2P_FLAG_COMPRESSED) == P2P_CMD_DATA
+                if count < 0 or (not is_data and count > P2P_FRAME_MAX):
+                    raise IOError('frame cmd[%d] count[%d] is error' % (cmd, count))
+                if is_data and capture.active:
+                    # the payload that came with the header
+                    capture.record(Capture.IN, clientid, cmd, count, 
+                        self.view[self.start:min(self.end, self.start + count)])
+                    
+                self.frame = [count, clientid, cmd]
+                
+            count, clientid, cmd = self.frame
+            if (cmd & ~P2P_FLAG_COMPRESSED) == P2P_CMD_DATA:
+                while count > 0:
+                    if self.start == self.end:
+                        pipe = None
+                        if self.sink is not None and count >= P2P_SPLICE_MIN:
+                            pipe = self.sink(clientid, cmd)
+                            
+                        n = None
+                        if pipe is not None:
+                            n = self.session.splice_from(pipe, count)
+                            if n == 0:
+                                return
+                                
+                        if n is not None:
+                            count -= n
+                            self.frame[0] = count
+                            self.exact = True
+                            yield clientid, cmd, PipeChunk(pipe, n)
+                            continue
+                            
+                        self.exact = False
+                        if not self._fill(1):
+                            return
+                        
+                    n = min(count, self.end - self.start)
+                    data = self.view[self.start:self.start + n]
+                    self.start += n
+                    self.lent = True
+                    count -= n
+                    self.frame[0] = count
+                    
+                    yield clientid, cmd, data
+                    
+                self.frame = None
+            else:
+                if not self._fill(count):
+                    return
+                    
+                data = str(self.buf[self.start:self.start + count])
+                self.start += count
+                self.frame = None
+                if capture.active:
+                    capture.record(Capture.IN, clientid, cmd, count, data)
+                
+                yield clientid, cmd, data
+        
+def udp_socket(address = ('', 0)):
+    sock = gevent.socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    for option in (socket.SO_RCVBUF, socket.SO_SNDBUF):
+        sock.setsockopt(socket.SOL_SOCKET, option, P2P_UDP_SOCKET_BUFFER)
+    sock.bind(address)
+    return sock
     
-class P2pSession:
-    def __init__(self, sock):
+class UdpTunnel:
+    """
+        a tunnel session over udp. Frames keep their P2P_CMD_* meaning,
+        but the frames of each clientid are a sequence of their own: cut
+        into datagrams numbered within the clientid, sent again alone
+        when lost and put back in order on the other side, so a loss
+        holds up the stream it hit and no other. Every datagram sent
+        takes a new packet number, acks carry ranges of them. The
+        congestion window grows as NewReno's, slow start and then a
+        datagram a round trip, and is cut to 0.7 of itself as CUBIC's 
+        once for the losses of a round trip, to two datagrams after 
+        timeouts in a row
+    """
+    def __init__(self, sock, address, connid, registry = None):
+        """
+            sock : udp socket, the server's is shared by all its tunnels
+            address : the peer
+            connid : tells the tunnels on one server socket apart
+            registry : connid -> tunnel of the server, None on the client
+        """
         self.sock = sock
-        self.queue = Queue()
-        self.loop = True 
-        self.last_read_time = time.time() 
-        # set timeout
-        # self.sock.settimeout(5)
-        # no block
-        self.sock.setblocking(0)
+        self.address = address
+        self.connid = connid
+        self.registry = registry
+        self.loop = True
+        self.queue = FairQueue()
+        self.wakeup = Event()
+        # frames read, None once closed
+        self.inbox = Queue()
+        self.timer = None
+        self.resume = None
+        self.compression = None
+        self.pending = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.frames_in = 0
+        self.frames_out = 0
+        self.stall_time = 0
+        self.send_time = 0
+        self.last_read_time = self.last_write_time = time.time()
         
-    def is_timeout(self, seconds):
-        return time.time() - self.last_read_time > seconds
+        # clientid -> next sequence number
+        self.sequence = {}
+        # segments are [clientid, seq, payload, acked], cut from frames
+        # and waiting for the window, then lost ones to send again
+        self.segments = deque()
+        self.lost = deque()
+        # packet number -> (segment, sent time, size), oldest first
+        self.flight = OrderedDict()
+        self.in_flight = 0
+        self.number = 0
+        self.largest_acked = -1
+        self.cwnd = 10.0 * P2P_UDP_MSS
+        self.ssthresh = float('inf')
+        # losses of datagrams sent before this do not shrink the window again
+        self.recovery = 0
+        self.srtt = None
+        self.rttvar = 0
+        self.latest_rtt = 0
+        self.rto = P2P_UDP_RTO
+        self.rto_start = 0
+        self.backoff = 0
+        self.loss_time = None
+        
+        # [first, last] packet numbers received, newest first
+        self.received = []
+        self.unacked = 0
+        self.ack_time = None
+        # clientid -> [next seq, {seq: payload}, bytes of a frame not complete yet]
+        self.channels = {}
+        # clientid -> 1 once its last frame went out, | 2 once the peer's came in
+        self.logouts = {}
+        # clientid -> time its segments stop being dropped, oldest first
+        self.closed = OrderedDict()
+        
+    def start(self):
+        """ client: the socket is ours to read """
+        gevent.spawn(self.read_loop)
+        
+    def read_loop(self):
+        try:
+            while self.loop:
+                data, address = self.sock.recvfrom(65536)
+                if address == self.address:
+                    self.datagram_received(data)
+        except:
+            pass
+        finally:
+            self.close()
             
     def is_loop(self):
         return self.loop
-    
+        
     def break_loop(self):
-        self.loop = False  
+        self.loop = False
+        self.wakeup.set()
         
-    def _read_try(self, count):
-        data = None
+    def write_frame(self, clientid, cmd, data = ''):
+        self.pending += P2P_HEADER.size + len(data)
+        self.frames_out += 1
+        if capture.active:
+            capture.record(Capture.OUT, clientid, cmd, len(data), data)
+        self.queue.put((P2P_HEADER.pack(len(data), clientid, cmd), data), 
+            clientid, cmd == P2P_CMD_WINDOW or clientid == 0)
+        self.wakeup.set()
+        
+    def frames(self):
+        """ (clientid, cmd, data) of every frame, data as str """
         while True:
-            try:
-                data = self.sock.recv(count)  
-                break                        
-            except socket.error, e:
-                if e.args[0] != errno.EAGAIN and e.args[0] != errno.EWOULDBLOCK:
-                    #print(e)
-                    logging.error('sock recv error：%d' % e.args[0])
-                    raise 1
-                else:
-                    gevent.sleep(0.1)
-                    
-        if data is None or len(data) == 0:
-            return None
+            frame = self.inbox.get()
+            if frame is None:
+                # for whoever reads next
+                self.inbox.put(None)
+                return
+                
+            if capture.active:
+                capture.record(Capture.IN, frame[0], frame[1], len(frame[2]), frame[2])
+            yield frame
+            
+    def send(self, packet):
+        started = time.time()
+        try:
+            self.sock.sendto(packet, self.address)
+        except (socket.error, AttributeError):
+            # as good as lost on the way, or closed already
+            return
             
-        self.last_read_time = time.time()
+        self.send_time += time.time() - started
+        self.bytes_out += len(packet)
+        self.last_write_time = timers.now
         
-        return data
+    def write_loop(self):
+        """ sends what the window lets through, acks, and resends on the timers """
+        try:
+            while self.loop:
+                self.wakeup.clear()
+                now = time.time()
+                if self.loss_time is not None and now >= self.loss_time:
+                    self.detect_lost(now)
+                if self.flight and now >= self.rto_start + self.rto * (1 << self.backoff):
+                    self.on_timeout(now)
+                if self.ack_time is not None and now >= self.ack_time:
+                    self.send_ack()
+                    
+                self.send_window(now)
+                
+                deadline = [t for t in (self.loss_time, self.ack_time) if t is not None]
+                if self.flight:
+                    deadline.append(self.rto_start + self.rto * (1 << self.backoff))
+                self.wakeup.wait(max(0, min(deadline) - time.time()) if deadline else None)
+        except:
+            logging.error('UdpTunnel write_loop exception')
+        finally:
+            self.close()
+            
+    def send_window(self, now):
+        while self.in_flight < self.cwnd and self.loop:
+            if self.lost:
+                segment = self.lost.popleft()
+                if segment[3]:
+                    # the first one made it after all
+                    continue
+            elif self.segments:
+                segment = self.segments.popleft()
+            elif not self.queue.empty():
+                self.cut(*self.queue.get_nowait())
+                continue
+            else:
+                break
+                
+            if not self.flight:
+                self.rto_start = now
+            number = self.number
+            self.number += 1
+            packet = P2P_UDP_SEGMENT.pack(P2P_UDP_DATA, self.connid, number, 
+                segment[0], segment[1]) + segment[2]
+            self.flight[number] = (segment, now, len(packet))
+            self.in_flight += len(packet)
+            self.send(packet)
+            
+    def cut(self, header, data):
+        """ a frame into segments of its clientid """
+        frame = bytearray(header)
+        frame += data
+        self.pending -= len(frame)
+        clientid, cmd = P2P_HEADER.unpack_from(header)[1:]
+        if clientid in self.closed:
+            # a window update of the stream finishing, the peer is done with it
+            return
+        seq = self.sequence.get(clientid, 0)
+        for i in range(0, len(frame), P2P_UDP_MSS):
+            self.segments.append([clientid, seq, str(frame[i:i + P2P_UDP_MSS]), False])
+            seq += 1
+        self.sequence[clientid] = seq
+        if cmd in P2P_UDP_LAST:
+            self.logout(clientid, 1)
+            
+    def logout(self, clientid, side):
+        """ forget clientid once the last frames went both ways """
+        done = self.logouts.get(clientid, 0) | side
+        if done != 3:
+            self.logouts[clientid] = done
+            return
+            
+        del self.logouts[clientid]
+        self.sequence.pop(clientid, None)
+        self.channels.pop(clientid, None)
         
-    def read(self, count):
-        if count < 0:
-            return self._read_try(P2P_BUFFER_MAX)
+        now = time.time()
+        while self.closed and next(iter(self.closed.values())) < now:
+            self.closed.popitem(False)
+        self.closed[clientid] = now + P2P_UDP_LINGER
         
-        data = []
-        need_read = count
-        while True:
-            chunk = self._read_try(need_read)
-            if chunk is None:
-                return None
+    def on_acks(self, data, now):
+        count = P2P_UDP_ACK.unpack_from(data)[2]
+        ranges = [P2P_UDP_RANGE.unpack_from(data, P2P_UDP_ACK.size + i * P2P_UDP_RANGE.size) 
+            for i in range(count)]
+        if not ranges:
+            return
+            
+        largest = ranges[0][1]
+        # both oldest first from here
+        ranges.reverse()
+        acked = []
+        i = 0
+        for number in self.flight:
+            while i < len(ranges) and ranges[i][1] < number:
+                i += 1
+            if i == len(ranges):
+                break
+            if ranges[i][0] <= number:
+                acked.append(number)
+                
+        for number in acked:
+            segment, sent, size = self.flight.pop(number)
+            self.in_flight -= size
+            segment[3] = True
+            if number == largest:
+                self.update_rtt(now - sent)
+            if sent <= self.recovery:
+                continue
+            if self.cwnd < self.ssthresh:
+                self.cwnd += size
             else:
-                data.append(chunk)
-                need_read = need_read - len(chunk)
-                if need_read == 0:
-                    break
+                self.cwnd += P2P_UDP_MSS * size / self.cwnd
+                
+        if acked:
+            self.backoff = 0
+            self.rto_start = now
+            self.largest_acked = max(self.largest_acked, largest)
+            self.detect_lost(now)
+            self.wakeup.set()
+            
+    def update_rtt(self, rtt):
+        self.latest_rtt = rtt
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        # the peer may hold an ack back for P2P_UDP_ACK_DELAY
+        self.rto = min(P2P_UDP_RTO_MAX, max(P2P_UDP_RTO_MIN, 
+            self.srtt + 4 * self.rttvar + P2P_UDP_ACK_DELAY))
         
-        return ''.join(data)
+    def detect_lost(self, now):
+        """ lost: three later datagrams were acked, or one was and 9/8 rtt went by """
+        self.loss_time = None
+        delay = 1.125 * max(self.srtt or 0, self.latest_rtt)
+        lost = []
+        for number, (segment, sent, size) in self.flight.iteritems():
+            if number > self.largest_acked:
+                break
+            if self.largest_acked - number < 3 and now - sent < delay:
+                # so are all after it, check again when it is due
+                self.loss_time = sent + delay
+                break
+            lost.append(number)
+            
+        for number in lost:
+            self.on_lost(number, now)
+            
+    def on_lost(self, number, now):
+        segment, sent, size = self.flight.pop(number)
+        self.in_flight -= size
+        if not segment[3]:
+            self.lost.append(segment)
+            metrics.retransmits += 1
+        if sent > self.recovery:
+            self.recovery = now
+            self.ssthresh = self.cwnd = max(self.cwnd * 0.7, 2.0 * P2P_UDP_MSS)
+            
+    def on_timeout(self, now):
+        """ 
+            nothing acked for a whole rto, often a lost tail nothing came
+            after to tell of. The window starts over on the second in a row
+        """
+        self.backoff += 1
+        if self.backoff > P2P_UDP_RETRIES:
+            logging.warning('UdpTunnel %08x peer is gone', self.connid)
+            self.close()
+            return
+            
+        for number in list(self.flight):
+            self.on_lost(number, now)
+        if self.backoff > 1:
+            self.cwnd = 2.0 * P2P_UDP_MSS
+        self.rto_start = now
+        self.loss_time = None
         
-
-    def write(self, data):
-        self.queue.put(data)
+    def datagram_received(self, data):
+        self.bytes_in += len(data)
+        self.last_read_time = timers.now
+        try:
+            kind, connid = P2P_UDP_KIND.unpack_from(data)
+            if connid != self.connid:
+                return
+                
+            if kind == P2P_UDP_DATA:
+                self.on_segment(data)
+            elif kind == P2P_UDP_ACKS:
+                self.on_acks(data, time.time())
+            elif kind == P2P_UDP_RESET:
+                logging.warning('UdpTunnel %08x reset by the peer', self.connid)
+                self.close()
+        except (struct.error, IOError) as ex:
+            logging.error('UdpTunnel %08x bad datagram: %s', self.connid, ex)
+            self.close()
+            
+    def on_segment(self, data):
+        kind, connid, number, clientid, seq = P2P_UDP_SEGMENT.unpack_from(data)
+        self.unacked += 1
+        if not self.note_received(number) or self.unacked >= 2:
+            # out of order acks go at once, they tell of a loss
+            self.send_ack()
+        elif self.ack_time is None:
+            self.ack_time = time.time() + P2P_UDP_ACK_DELAY
+            self.wakeup.set()
+            
+        if clientid in self.closed:
+            # sent again before the ack of the first copy got through
+            return
+        channel = self.channels.get(clientid)
+        if channel is None:
+            channel = self.channels[clientid] = [0, {}, bytearray()]
+        if seq < channel[0] or seq in channel[1]:
+            return
+            
+        channel[1][seq] = data[P2P_UDP_SEGMENT.size:]
+        buf = channel[2]
+        while channel[0] in channel[1]:
+            buf += channel[1].pop(channel[0])
+            channel[0] += 1
+            
+        while len(buf) >= P2P_HEADER.size:
+            count, clientid, cmd = P2P_HEADER.unpack_from(buf)
+            if not 0 <= count <= P2P_FRAME_MAX:
+                raise IOError('frame cmd[%d] count[%d] is error' % (cmd, count))
+            if len(buf) < P2P_HEADER.size + count:
+                break
+                
+            self.frames_in += 1
+            self.inbox.put((clientid, cmd, str(buf[P2P_HEADER.size:P2P_HEADER.size + count])))
+            del buf[:P2P_HEADER.size + count]
+            if cmd in P2P_UDP_LAST:
+                self.logout(clientid, 2)
+            
+    def note_received(self, number):
+        """ add number to the ranges, False unless it is the next one expected """
+        r = self.received
+        if r and number == r[0][1] + 1:
+            r[0][1] = number
+            return True
+            
+        i = 0
+        while i < len(r) and r[i][1] >= number:
+            if r[i][0] <= number:
+                # a duplicate, our ack got lost
+                return False
+            i += 1
+            
+        above = i > 0 and r[i - 1][0] == number + 1
+        below = i < len(r) and r[i][1] == number - 1
+        if above and below:
+            r[i - 1][0] = r[i][0]
+            del r[i]
+        elif above:
+            r[i - 1][0] = number
+        elif below:
+            r[i][1] = number
+        else:
+            r.insert(i, [number, number])
+        del r[P2P_UDP_ACK_RANGES:]
+        return not r[1:] and number == 0
         
-    def _send_all(self, msg):        
-        msglen = len(msg)
-        if msglen == 0:
-            return False
+    def send_ack(self):
+        self.unacked = 0
+        self.ack_time = None
+        self.send(P2P_UDP_ACK.pack(P2P_UDP_ACKS, self.connid, len(self.received)) + 
+            ''.join(P2P_UDP_RANGE.pack(*r) for r in self.received))
+            
+    def close(self):
+        if self.sock is None:
+            return
+            
+        self.loop = False
+        if self.registry is None:
+            self.sock.close()
+        else:
+            self.registry.pop(self.connid, None)
+        self.sock = None
+        if self.timer is not None:
+            self.timer.cancel()
+        self.inbox.put(None)
+        self.wakeup.set()
+        metrics.remove(self)
         
-        totalsent = 0   
-        while totalsent < msglen:
+    def drop(self):
+        self.close()
+        
+class UdpServer:
+    """ the udp tunnels of a P2pServer, one socket for all of them """
+    def __init__(self, address, p2pserver):
+        self.address = address
+        self.p2pserver = p2pserver
+        self.sock = None
+        # connid -> UdpTunnel
+        self.tunnels = {}
+        self.loop = True
+        
+    def start(self):
+        self.sock = udp_socket(self.address)
+        gevent.spawn(self.serve)
+        
+    def serve(self):
+        while self.loop:
             try:
-                sent = self.sock.send(msg[totalsent:])
-                if sent == 0:
-                    return False     
-                
-                totalsent = totalsent + sent
+                data, address = self.sock.recvfrom(65536)
+                kind, connid = P2P_UDP_KIND.unpack_from(data)
+                # a tunnel starts with the login, the first segment of clientid 0
+                login = kind == P2P_UDP_DATA and P2P_UDP_SEGMENT.unpack_from(data)[3:] == (0, 0)
+            except (socket.error, struct.error):
+                continue
                 
-            except socket.error, e:
-                if e.args[0] != errno.EAGAIN and e.args[0] != errno.EWOULDBLOCK:
-                    logging.error('sock sendall error：%d' % e.args[0])
-                    return False    
+            tunnel = self.tunnels.get(connid)
+            if tunnel is None:
+                if kind == P2P_UDP_RESET:
+                    continue
+                if not login:
+                    # left over from a tunnel we closed, or from before a restart
+                    self.sock.sendto(P2P_UDP_KIND.pack(P2P_UDP_RESET, connid), address)
+                    continue
+                    
+                tunnel = self.tunnels[connid] = UdpTunnel(self.sock, address, connid, self.tunnels)
+                gevent.spawn(self.p2pserver.handle_datagram, tunnel, address)
                 
-        return True
+            # the client may come from a new address behind a nat
+            tunnel.address = address
+            tunnel.datagram_received(data)
+            
+    def close(self):
+        self.loop = False
+        for tunnel in self.tunnels.values():
+            tunnel.close()
+        if self.sock is not None:
+            self.sock.close()
+        
+class BackendPool:
+    """
+        connections to the real server opened ahead of P2P_CMD_LOGIN,
+        so a new stream does not wait for the backend handshake
+    """
+    def __init__(self, address, min_idle, max_idle):
+        """
+            address : real server host
+            min_idle : connections kept ready at all times
+            max_idle : upper bound while logins come in faster
+        """
+        self.address = address
+        self.min_idle = min_idle
+        self.max_idle = max(min_idle, max_idle)
+        # (sock, connect time), newest on the right
+        self.idle = deque()
+        self.connecting = 0
+        # logins served recently, halved every second
+        self.demand = 0
+        self.loop = True
+        self.wakeup = Event()
+        
+    def start(self):
+        gevent.spawn(self.refill_loop)
+        
+    def get(self):
+        """ a connected socket, straight from the pool when it has one """
+        self.demand += 1
+        self.wakeup.set()
+        while self.idle:
+            sock, since = self.idle.pop()
+            if self.is_alive(sock):
+                return sock
                 
-    def write_loop(self):
-        ret = False        
-        try:
-            while True:
-                data = self.queue.get()
-                if not self.is_loop():
-                    break
-                    
-                if not self._send_all(data):
-                    self.break_loop()
-                    break
-                    
-            ret = True
-        except:        
-            self.break_loop()
+            sock.close()
+            
+        return create_connection(self.address)
         
-        return ret
+    def is_alive(self, sock):
+        """ no eof or error waiting on an idle socket """
+        sock.settimeout(0.0)
+        try:
+            # a server that speaks first leaves its greeting here
+            return sock.recv(1, socket.MSG_PEEK) != ''
+        except socket.error, e:
+            return e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK)
+        finally:
+            sock.settimeout(None)
+            
+    def evict(self, target):
+        now = time.time()
+        idle = deque()
+        for sock, since in self.idle:
+            if now - since < P2P_POOL_IDLE_TIMEOUT and self.is_alive(sock):
+                idle.append((sock, since))
+            else:
+                sock.close()
+                
+        # oldest go first when demand has dropped
+        while len(idle) > target:
+            idle.popleft()[0].close()
+            
+        self.idle = idle
         
-    def close(self):
-        self.loop = False        
-        if self.sock != None:            
-            self.sock.close()            
-            self.queue.put(1) # break queue.get()
+    def refill_loop(self):
+        tick = 0
+        while self.loop:
+            target = min(self.max_idle, max(self.min_idle, self.demand))
+            if time.time() - tick >= 1:
+                # once a second, not on every login
+                tick = time.time()
+                self.demand /= 2
+                self.evict(target)
+                
+            for i in range(target - len(self.idle) - self.connecting):
+                self.connecting += 1
+                gevent.spawn(self.open_one)
+                
+            self.wakeup.clear()
+            self.wakeup.wait(1)
+                
+    def open_one(self):
+        try:
+            sock = create_connection(self.address)
+        except IOError as ex:
+            logging.error('BackendPool failed to connect to %s: %s', self.address, ex)
+            # retried on the next round, not in a tight loop
+            gevent.sleep(1)
+            return
+        finally:
+            self.connecting -= 1
             
-            self.sock = None
+        if self.loop and len(self.idle) < self.max_idle:
+            self.idle.append((sock, time.time()))
+        else:
+            sock.close()
+            
+    def close(self):
+        self.loop = False
+        self.wakeup.set()
+        while self.idle:
+            self.idle.pop()[0].close()
         
 class P2pClient:
-    def __init__(self, src, dst):
+    def __init__(self, src, services, codecs = (), pool = (0, 0), splice = False, 
+            chunk = (P2P_BUFFER_MAX, P2P_CHUNK_MAX), tunnel_opts = None, stream_opts = None, 
+            timeouts = None, resume = 0, transport = 'tcp'):
         """
             src : p2p server host
-            dst : real server host
+            services : service name -> resolved real server host, the 
+                       name '' serves logins that carry none
+            codecs : compression offered to the server, preferred first
+            pool : min and max idle connections per backend, (0, 0) for none
+            splice : move bulk stream data with splice(2)
+            chunk : smallest and largest read from a backend connection
+            tunnel_opts, stream_opts : SocketOptions of the tunnel and 
+                                       the backend connections
+            timeouts : Timeouts of the tunnel and its streams
+            resume : seconds the streams wait for a dropped tunnel to 
+                     resume, 0 to let them go with it
+            transport : 'tcp', or 'udp' for a UdpTunnel
         """
         self.src = src
-        self.dst = dst
+        self.services = services
+        self.codecs = codecs
+        self.splice = splice
+        self.chunk = chunk
+        # small control frames go back and forth during stream setup,
+        # write_loop already batches, so keep Nagle out of the way
+        self.tunnel_opts = tunnel_opts or SocketOptions(nodelay = True)
+        self.stream_opts = stream_opts or SocketOptions()
+        self.pool_size = pool
+        # service name -> BackendPool
+        self.pools = {}
         
         self.clients = {}
+        # clientids whose backend connection is in progress
+        self.opening = set()
         self.session = None
+        self.timeouts = timeouts or Timeouts()
+        self.resume = resume
+        self.transport = transport
+        self.stopped = False
         
     def start(self):
-        gevent.spawn(self.connect)  
+        return gevent.spawn(self.run)  
+        
+    def run(self):
+        """ connect, and again whenever the tunnel drops, until close() """
+        delay = P2P_RECONNECT_MIN
+        while not self.stopped:
+            if self.connect():
+                delay = P2P_RECONNECT_MIN
+            if self.stopped:
+                break
+                
+            # tunnels that dropped together do not all come back at once
+            gevent.sleep(delay / 2 + random.uniform(0, delay / 2))
+            delay = min(delay * 2, P2P_RECONNECT_MAX)
     
     def connect(self):
-        try:
-            sock = create_connection(self.src)
-        except IOError as ex:
-            logging.error('P2pClient failed to connect to %s' % str(self.src))
-            return  
-        
-        logging.info('P2pClient connect to server %s' % str(self.src))
+        """ one tunnel connection, True when the server took it """
+        if self.transport == 'udp':
+            # nothing to connect, the login is the first datagram
+            logging.info('P2pClient udp tunnel to server %s', self.src)
+            self.reset()
+            self.session = UdpTunnel(udp_socket(), self.src, random.getrandbits(32))
+            self.session.start()
+            metrics.add(self.session, 'tunnel')
+        elif not self.connect_tcp():
+            return False
         
-        self.clients = {}
-        self.session = P2pSession(sock)
+        # the pools live as long as the tunnel, no idle backend
+        # connections are held while we are cut off from the server
+        if self.pool_size[1] > 0:
+            for name, dst in self.services.items():
+                self.pools[name] = BackendPool(dst, *self.pool_size)
+                self.pools[name].start()
         
+        self.session.timer = timers.schedule(1, self.ontimer, self.session)
         try:
             r = gevent.spawn(self.onread)
             w = gevent.spawn(self.onwrite)
-            t = gevent.spawn(self.ontimer)
 
-            gevent.joinall([r, w, t])
+            gevent.joinall([r, w])
             
         finally:
-            self.session = None 
+            if self.session is not None and self.session.resume is not None and not self.stopped:
+                # the streams wait for the next connection to resume
+                self.session.timer = timers.schedule(self.resume, self.expire, self.session)
+            else:
+                self.session = None 
+            for pool in self.pools.values():
+                pool.close()
+            self.pools = {}
+            
+        logging.info('P2pClient disconnect to server %s', self.src)
+        return True
+        
+    def connect_tcp(self):
+        """ the tunnel connection and its session, False without """
+        try:
+            sock = create_connection(self.src)
+        except IOError as ex:
+            logging.error('P2pClient failed to connect to %s', self.src)
+            return False
+        
+        logging.info('P2pClient connect to server %s', self.src)
+        
+        self.tunnel_opts.apply(sock)
+        
+        if self.resume:
+            try:
+                if not self.login(sock):
+                    sock.close()
+                    return False
+            except (IOError, ValueError) as ex:
+                logging.error('P2pClient login failed: %s', ex)
+                sock.close()
+                return False
+        else:
+            self.reset()
+            self.session = P2pSession(sock, queue = FairQueue())
+            metrics.add(self.session, 'tunnel')
+        return True
+        
+    def login(self, sock):
+        """
+            resumable tunnels log in on the socket, ahead of the queue.
+            The server picks up the session we had if it still can, else
+            the streams of that one go and a new session starts
+        """
+        session = self.session
+        resume = session.resume if session is not None else Resumption(new_token())
+        login_info = 'test_p2p'
+        if self.codecs:
+            login_info += ' ' + ','.join(self.codecs)
+        login_info += ' resume=%s:%d' % (resume.token, session.bytes_in if session else 0)
+        send_frame(sock, 0, P2P_CMD_CLIENT, login_info)
+        
+        sock.settimeout(self.timeouts.tunnel or None)
+        clientid, cmd, data = recv_frame(sock)
+        sock.settimeout(None)
+        # the server's pick out of our offer, then how it took the resume
+        fields = data.split(' ')
+        codec = fields[0] or None
+        if cmd != P2P_CMD_CLIENT or (codec and codec not in self.codecs):
+            raise ValueError('answer cmd[%d] %r is error' % (cmd, data))
+            
+        if session is not self.session:
+            # expired while we waited for the answer
+            return False
+            
+        if session is not None and fields[-1].startswith('resumed='):
+            replay = resume.since(int(fields[-1][8:]))
+            if replay is None or codec != session.compression:
+                # the server still has the session but we cannot carry on
+                # with it, it times out there
+                logging.warning('P2pClient tunnel cannot resume')
+                self.reset()
+                return False
+                
+            session.attach(sock)
+            for data in replay:
+                if not session._send_all(data):
+                    session.detach()
+                    session.timer = timers.schedule(self.resume, self.expire, session)
+                    return False
+                    
+            logging.info('P2pClient tunnel resumed, %d bytes sent again', 
+                sum(len(data) for data in replay))
+            return True
+            
+        # a new session, whatever streams the last one had are gone
+        self.reset()
+        self.session = P2pSession(sock, queue = FairQueue())
+        metrics.add(self.session, 'tunnel')
+        self.session.compression = codec
+        logging.info('P2pClient compression %s', codec or 'off')
+        if fields[-1] == 'resume=on':
+            self.session.resume = resume
+            resume.decoder = FrameDecoder(self.session, sink = self.pipe_for)
+        else:
+            logging.warning('P2pClient server does not resume tunnels')
+        return True
+        
+    def expire(self, session):
+        """ the tunnel did not resume in time """
+        if session is self.session and session.sock is None:
+            logging.warning('P2pClient tunnel did not come back in time')
+            self.reset()
+            
+    def reset(self):
+        """ the session and the streams of the last connection go """
+        for i in self.clients.keys():
+            self.remove_client(i)
             
-        logging.info('P2pClient disconnect to server %s' %  str(self.src))
+        self.clients = {}
+        self.opening = set()
+        if self.session is not None:
+            metrics.remove(self.session)
+            self.session.close()
+            self.session = None
     
     def onread(self):
+        session = self.session
         try:   
-            login_info = 'test_p2p'
-            self.session.write(struct.pack('iii', len(login_info), 0, P2P_CMD_CLIENT))
-            self.session.write(login_info)
-            gevent.sleep(1)            
-                  
-            count = 0
-            clientid = 0
-            cmd = 0
-            
-            while self.session.is_loop():
-                if count > 0:
-                    data = self.session.read(count)
-                    if not data:
-                        break   
-             
-                    count -= len(data)
-                    if cmd == P2P_CMD_DATA:                     
-                        self.request_data(clientid, data)
-                else:       
-                    ### parse header
-                    data = self.session.read(12)
-                    if not data:
-                        break                        
+            if session.resume is not None:
+                # logged in already, the decoder carries on where the
+                # last connection left it
+                decoder = session.resume.decoder
+            else:
+                login_info = 'test_p2p'
+                if self.codecs:
+                    login_info += ' ' + ','.join(self.codecs)
+                session.write_frame(0, P2P_CMD_CLIENT, login_info)
+                if session.__class__ is UdpTunnel:
+                    decoder = session
+                else:
+                    decoder = FrameDecoder(session, sink = self.pipe_for)
                   
-                    count, clientid, cmd = struct.unpack('iii', data)
-                    logging.debug('count[%d], clientid[%d], cmd[%d]' % (count, clientid, cmd))
+            for clientid, cmd, data in decoder.frames():
+                if not session.is_loop():
+                    break
                     
-                    if cmd == P2P_CMD_LOGIN:                    
-                        if count > 0:
-                            logging.error ("P2pClient onread login count[%d] is error" % count)
-                            break
-                            
-                        self.append_client(clientid)
-                    elif cmd == P2P_CMD_LOGOUT:
-                        if count > 0:
-                            logging.error ("P2pClient onread logout count[%d] is error" % count)
-                            break
-                            
-                        self.remove_client(clientid)
-                    elif cmd == P2P_CMD_TIMER:
-                        if count > 0:
-                            logging.error ("P2pClient onread timer count[%d] is error" % count)
-                            break
-                    else:
-                        if count >= 1024*1024:
-                            logging.error ("P2pClient onread count[%d] is too big" % count)
-                            break
-                        else:
-                            continue
+                logging.debug('count[%d], clientid[%d], cmd[%d]', len(data), clientid, cmd)
+                
+                if cmd == P2P_CMD_DATA:
+                    self.request_data(clientid, data)
+                elif cmd == P2P_CMD_DATA | P2P_FLAG_COMPRESSED:
+                    self.request_data(clientid, data, True)
+                elif cmd == P2P_CMD_CLIENT:
+                    # the server's pick out of our offer, empty for none
+                    if data and data not in self.codecs:
+                        logging.error ("P2pClient onread codec[%s] is error", data)
+                        break
+                        
+                    session.compression = data or None
+                    logging.info('P2pClient compression %s', data or 'off')
+                elif cmd == P2P_CMD_LOGIN:                    
+                    # the payload names the service, empty for the default
+                    self.append_client(clientid, data)
+                elif cmd == P2P_CMD_LOGOUT:
+                    if len(data) > 0:
+                        logging.error ("P2pClient onread logout count[%d] is error", len(data))
+                        break
+                        
+                    self.remove_client(clientid, True)
+                elif cmd == P2P_CMD_TIMER:
+                    if len(data) > 0:
+                        logging.error ("P2pClient onread timer count[%d] is error", len(data))
+                        break
+                elif cmd == P2P_CMD_WINDOW:
+                    if len(data) != P2P_WINDOW.size:
+                        logging.error ("P2pClient onread window count[%d] is error", len(data))
+                        break
+                        
+                    self.add_window(clientid, P2P_WINDOW.unpack(data)[0])
+                elif cmd == P2P_CMD_ACK and session.resume is not None:
+                    if len(data) != P2P_ACK.size:
+                        logging.error ("P2pClient onread ack count[%d] is error", len(data))
+                        break
+                        
+                    session.resume.trim(P2P_ACK.unpack(data)[0])
+                    
+                if session.resume is not None:
+                    session.resume.acknowledge(session)
         except IOError as ex:
-            logging.error('P2pClient onread exception' + str(ex))
+            logging.error('P2pClient onread exception %s', ex)
         except:
             logging.error ('P2pClient onread exception')
         finally:
-            self.session.close()
+            session.drop()
     
     def onwrite(self):
-        self.session.write_loop()
+        session = self.session
+        session.write_loop()
+        # a failed send ends the read as well
+        session.drop()
         
-    def ontimer(self):
-        try:  
-            count = 10            
-            while self.session.is_loop(): 
-                gevent.sleep(1)  
-                
-                if count > 0:
-                    count -= 1
-                    
-                if count == 0 and self.session.is_timeout(30):
-                    self.session.write(struct.pack('iii', 0, 0, P2P_CMD_TIMER))
-                    count = 10                 
-        except:
-            logging.error ('P2pClient ontimer error')        
+    def ontimer(self, session):
+        """ on the TimerWheel when a keepalive or the tunnel timeout is due """
+        if not session.is_loop():
+            return
+            
+        t = self.timeouts
+        silent = timers.now - session.last_read_time
+        if t.tunnel and silent >= t.tunnel:
+            session.drop()
+            logging.warning ('P2pClient server timeout')
+            return
+            
+        if session.resume is not None:
+            # the server's replay buffer drains while little comes in
+            session.resume.acknowledge(session, True)
+            
+        due = []
+        if t.keepalive:
+            if silent >= t.keepalive:
+                session.write_frame(0, P2P_CMD_TIMER)
+                # another one if the answer does not come
+                due.append(t.keepalive)
+            else:
+                due.append(t.keepalive - silent)
+        if t.tunnel:
+            due.append(t.tunnel - silent)
+            
+        if due:
+            session.timer = timers.schedule(min(due), self.ontimer, session)
      
-    def response_data(self, clientid, data):
+    def sendcmd(self, clientid, cmd):
+        if self.session is None:
+            return
+            
+        self.session.write_frame(clientid, cmd)
+        
+    def response_data(self, clientid, data, codec = None):
         if data is None:
             return
             
-        self.session.write(struct.pack('iii', len(data), clientid, P2P_CMD_DATA)) 
-        self.session.write(data)
+        cmd = P2P_CMD_DATA
+        if codec is not None:
+            cmd, data = codec.compress(data)
+            
+        self.session.write_frame(clientid, cmd, data)
+        
+    def sendwindow(self, clientid, count):
+        if self.session is None:
+            return
+            
+        self.session.write_frame(clientid, P2P_CMD_WINDOW, P2P_WINDOW.pack(count))
+        
+    def add_window(self, clientid, count):
+        if clientid in self.clients:
+            self.clients[clientid].add_window(count)
+            
+    def pipe_for(self, clientid, cmd):
+        """ FrameDecoder sink, only raw DATA can go straight to the backend """
+        if not self.splice or cmd != P2P_CMD_DATA or clientid not in self.clients:
+            return None
+            
+        return self.clients[clientid].get_write_pipe()
         
-    def request_data(self, clientid, data):    
+    def request_data(self, clientid, data, compressed = False):    
         if clientid in self.clients:
-            self.clients[clientid].write(data)
+            ss = self.clients[clientid]
+            if compressed:
+                if ss.codec is None:
+                    logging.error ('P2pClient client[%d] compression is off', clientid)
+                    self.remove_client(clientid)
+                    return
+                    
+                try:
+                    data = ss.codec.decompress(data)
+                except ValueError as ex:
+                    logging.error ('P2pClient client[%d] bad compressed data: %s', clientid, ex)
+                    self.remove_client(clientid)
+                    return
+                if not data:
+                    return
+                    
+            if not ss.write(data):
+                logging.error ('P2pClient client[%d] window overrun', clientid)
+                self.remove_client(clientid)
         else:
-            logging.warning ('P2pClient request_data client[%d] is missing' % clientid)
+            logging.warning ('P2pClient request_data client[%d] is missing', clientid)
             
-    def append_client(self, clientid):
-        logging.info('P2pClient client[%d] login' % clientid)
+    def append_client(self, clientid, service = ''):
+        logging.info('P2pClient client[%d] login %s', clientid, service)
         
-        gevent.spawn(self.connect_client, clientid)
+        self.opening.add(clientid)
+        gevent.spawn(self.connect_client, clientid, service)
     
-    def remove_client(self, clientid):
-        logging.info ('P2pClient client[%d] logout' % clientid)
+    def remove_client(self, clientid, finish = False):
+        """ finish : what the stream has queued is written first """
+        logging.info ('P2pClient client[%d] logout', clientid)
         
         try:
+            self.opening.discard(clientid)
             if clientid in self.clients:
                 ss = self.clients[clientid]                
                 del self.clients[clientid]
                 
-                ss.close()
+                if finish:
+                    ss.finish()
+                else:
+                    ss.close()
         except:
-            logging.error('P2pClient remove client[%d] falied' % clientid)
+            logging.error('P2pClient remove client[%d] falied', clientid)
         
-    def connect_client(self, clientid):
+    def connect_client(self, clientid, service = ''):
+        started = time.time()
+        dst = self.services.get(service)
         try:
-            sock = create_connection(self.dst)
+            if dst is None:
+                raise IOError('unknown service')
+            elif service in self.pools:
+                sock = self.pools[service].get()
+            else:
+                sock = create_connection(dst)
         except IOError as ex:
-            logging.error('P2pClient failed to connect to %s' % str(self.dst))
+            logging.error('P2pClient failed to connect to service %r at %s: %s', service, dst, ex)
+            metrics.failed += 1
+            self.opening.discard(clientid)
+            self.sendcmd(clientid, P2P_CMD_OPEN_FAIL)
+            return
+            
+        if clientid not in self.opening:
+            # logged out while connecting
+            sock.close()
             return
+            
+        self.opening.discard(clientid)
         
-        ss = P2pSession(sock)
+        metrics.setup.observe(time.time() - started)
+        self.stream_opts.apply(sock)
+        ss = P2pSession(sock, P2P_STREAM_WINDOW)
+        ss.set_chunk(*self.chunk)
+        ss.shaper = limits.shaper(clientid, service)
+        metrics.add(ss, 'stream', clientid)
+        ss.window_update = functools.partial(self.sendwindow, clientid)
+        if self.session.compression:
+            ss.codec = StreamCodec(self.session.compression)
+        # compressed streams need their data in python, so do the
+        # replay buffer of a resumable tunnel and a udp tunnel
+        ss.splice = (self.splice and ss.codec is None and self.session.resume is None 
+            and self.session.__class__ is P2pSession)
         self.clients[clientid] = ss
-        gevent.sleep(1)
+        self.sendcmd(clientid, P2P_CMD_OPEN_OK)
+        ss.expire_after(self.timeouts.idle, self.remove_client, clientid)
         
         try:
-            r = gevent.spawn(self.onclientread, ss, clientid)
-            w = gevent.spawn(self.onclientwrite, ss)
-
-            gevent.joinall([r,w])
-
+            # the writer comes and goes with the data, an idle stream
+            # holds on to this greenlet only
+            self.onclientread(ss, clientid)
+            # the backend is done sending, what the server still sends
+            # goes to it until the server logs the stream out
+            ss.expire_after(self.timeouts.halfopen or self.timeouts.idle, ss.close)
+            ss.join()
         finally:
             self.remove_client(clientid)
             
     def onclientread(self, ss, clientid):
         try:
             while ss.is_loop():
-                data = ss.read(-1)
+                data = ss.read_window()
                 if not data:
                     break
                     
-                self.response_data(clientid, data)   
+                self.response_data(clientid, data, ss.codec)   
                 
-            self.session.write(struct.pack('iii', 0, clientid, P2P_CMD_LOGOUT))   
-            
         except:
             ss.break_loop()
-            logging.error ('P2pClient client[%d] read failed' % clientid)  
+            logging.error ('P2pClient client[%d] read failed', clientid)  
+            
+        # a udp tunnel forgets the clientid once the logouts crossed
+        if self.session is not None:
+            self.session.write_frame(clientid, P2P_CMD_LOGOUT)
     
-    def onclientwrite(self, ss):
-        ss.write_loop()
-                        
     def close(self):
-        for i in self.clients.keys:
-            self.remove_client(i)
-        
-        if self.session != None:
-            self.session.close()
-            self.session = None
+        self.stopped = True
+        self.reset()
          
 class P2pServer(StreamServer):
-    def __init__(self, listener, **kwargs):
+    def __init__(self, listener, tunnels = 1, codecs = None, **kwargs):
+        """
+            listener : p2p server host
+            tunnels : number of tunnel connections accepted from the client
+            codecs : compression the client may pick from, None for all
+        """
         StreamServer.__init__(self, listener, **kwargs)
         
         self.netserver = None
-        self.client = None
+        self.codecs = P2P_CODECS.keys() if codecs is None else codecs
+        self.sockopts = SocketOptions(nodelay = True)
+        self.timeouts = Timeouts()
+        self.size = tunnels
+        self.tunnels = []
+        # clientid -> tunnel session carrying the stream
+        self.routes = {}
+        # tunnel session -> number of streams on it
+        self.load = {}
+        # seconds a dropped tunnel waits for the client, 0 for none
+        self.resume = 0
+        # resume token -> tunnel session
+        self.sessions = {}
+        
+    def assign(self, clientid):
+        """ put a new stream on the least loaded tunnel """
+        if not self.tunnels:
+            return False
+            
+        # tunnels waiting for the client to come back are the last resort
+        session = min(self.tunnels, key = lambda s: (s.sock is None, self.load[s], s.pending))
+        self.routes[clientid] = session
+        self.load[session] += 1
+        return True
+        
+    def release(self, clientid):
+        session = self.routes.pop(clientid, None)
+        if session in self.load:
+            self.load[session] -= 1
     
-    def sendcmd(self, clientid, cmd, length = 0):
-        if self.client is None:
+    def sendcmd(self, clientid, cmd, data = ''):
+        session = self.routes.get(clientid)
+        if session is None:
+            return
+            
+        session.write_frame(clientid, cmd, data)
+            
+    def senddata(self, clientid, data, codec = None):
+        session = self.routes.get(clientid)
+        if session is None:
             return
             
-        self.client.write(struct.pack('iii', length, clientid, cmd))    
+        cmd = P2P_CMD_DATA
+        if codec is not None:
+            cmd, data = codec.compress(data)
+            
+        session.write_frame(clientid, cmd, data)
+        
+    def new_codec(self, clientid):
+        """ compression context for a stream, None when its tunnel has none """
+        session = self.routes.get(clientid)
+        if session is None or session.compression is None:
+            return None
+            
+        return StreamCodec(session.compression)
+        
+    def sendwindow(self, clientid, count):
+        session = self.routes.get(clientid)
+        if session is None:
+            return
             
-    def senddata(self, clientid, data):
-        if self.client is None:
+        session.write_frame(clientid, P2P_CMD_WINDOW, P2P_WINDOW.pack(count))
+        
+    def set_priority(self, clientid, level):
+        session = self.routes.get(clientid)
+        if session is None:
             return
             
-        self.sendcmd(clientid, P2P_CMD_DATA, len(data))    
-        self.client.write(data)
+        session.queue.set_priority(clientid, level)
+
+    def spliceable(self, clientid):
+        """ 
+            the stream's tunnel takes spliced data: a tcp tunnel that does
+            not resume, the others need the data for their own buffers
+        """
+        session = self.routes.get(clientid)
+        return session.__class__ is P2pSession and session.resume is None
 
     def handle(self, sock, address): 
-        addr = '%s:%d' % ( address[0], address[1])
-        
-        logging.info("P2pServer client %s connect" % addr)
+        logging.info("P2pServer client %s:%d connect", address[0], address[1])
         
-        if (self.client != None):
+        self.sockopts.apply(sock)
+        try:
+            # the client has as long to log in as a tunnel may be silent
+            sock.settimeout(self.timeouts.tunnel or None)
+            session, replay = self.verify_client(sock)
+            sock.settimeout(None)
+        except (IOError, ValueError) as ex:
+            logging.warning("P2pServer verify_client failed: %s", ex)
+            session = None
+            
+        if session is None:
             sock.close()
-            logging.warning ('P2pServer client is not none.')
             return
-
-        session = P2pSession(sock)         
+            
+        self.run_tunnel(session, replay)
+        logging.info ('P2pServer client %s:%d disconnect.', address[0], address[1])
+        
+    def handle_datagram(self, tunnel, address):
+        """ UdpServer: a new udp tunnel, the login is its first frame """
+        logging.info("P2pServer udp client %s:%d connect", address[0], address[1])
+        
+        login = None
+        with gevent.Timeout(self.timeouts.tunnel or None, False):
+            clientid, cmd, data = next(tunnel.frames(), (None, None, None))
+            if cmd == P2P_CMD_CLIENT and clientid == 0:
+                login = self.parse_login(data)
+                
+        if login is None or not self.make_room():
+            logging.warning("P2pServer verify_client failed")
+            tunnel.close()
+            return
+            
+        # always answered, there is no connect to tell the client we are here
+        offer, token, received = login
+        tunnel.compression = offer[0] if offer else None
+        tunnel.write_frame(0, P2P_CMD_CLIENT, tunnel.compression or '')
+        logging.info ('P2pServer client compression %s', tunnel.compression or 'off')
+        metrics.add(tunnel, 'tunnel')
+        self.tunnels.append(tunnel)
+        self.load[tunnel] = 0
+        
+        self.run_tunnel(tunnel, ())
+        logging.info ('P2pServer udp client %s:%d disconnect.', address[0], address[1])
+        
+    def run_tunnel(self, session, replay):
+        """ the frames of a verified tunnel both ways until it drops """
+        if self.timeouts.tunnel:
+            session.timer = timers.schedule(self.timeouts.tunnel, self.ontimer, session)
+        if session.resume is not None:
+            session.resume.owner = gevent.getcurrent()
         try:
-            r = gevent.spawn(self.onread, session)
-            w = gevent.spawn(self.onwrite, session)
-            t = gevent.spawn(self.ontimer, session)
+            if all(session._send_all(data) for data in replay):
+                r = gevent.spawn(self.onread, session)
+                w = gevent.spawn(self.onwrite, session)
 
-            gevent.joinall([r,w,t])
+                gevent.joinall([r,w])
 
         finally:
-            if self.client == session:
-                self.client = None     
+            session.drop()
+            if session.resume is None:
+                self.remove_tunnel(session)
+            elif session.resume.owner is gevent.getcurrent():
+                # the streams wait for the client to come back
+                session.resume.owner = None
+                session.timer = timers.schedule(self.resume, self.expire, session)
+        
+    def remove_tunnel(self, session):
+        if session in self.tunnels:
+            self.tunnels.remove(session)
+            del self.load[session]
             
-        logging.info ('P2pServer client %s disconnect.' % addr)
+            # only the streams carried by this tunnel go down with it
+            for clientid, s in self.routes.items():
+                if s is session:
+                    self.netserver.shutdown_client(clientid)
+                    
+    def expire(self, session):
+        """ a suspended tunnel the client did not resume in time """
+        logging.info ('P2pServer tunnel %s expired', session.resume.token)
+        if session.timer is not None:
+            session.timer.cancel()
+        del self.sessions[session.resume.token]
+        session.resume = None
+        self.remove_tunnel(session)
+        metrics.remove(session)
+        session.close()
 
     def onread(self, session):
         try:
-            if self.verify_client(session):
-            
-                if self.client != None:
-                    logging.warning ('P2pServer client is not none.')
-                    return
-                    
-                #  verify is ok, set client 
-                self.client = session
+            if session.resume is not None:
+                # the decoder carries on where the last connection left it
+                frames = session.resume.decoder.frames()
+            elif session.__class__ is UdpTunnel:
+                frames = session.frames()
+            else:
+                frames = FrameDecoder(session, sink = self.netserver.pipe_for).frames()
                 
-                count, clientid, cmd = 0, 0, 0
-                while session.is_loop():
-                    if count > 0:
-                        data = session.read(count)
-                        if not data:
-                            break
-                            
-                        count -= len(data)
-                        if cmd == P2P_CMD_DATA:
-                            self.netserver.senddata(clientid, data)
-                    else:
-                        ### parse header
-                        data = session.read(12)
-                        if not data:
-                            break
-                            
-                        count, clientid, cmd = struct.unpack('iii', data)   
-                        self.last_recv_time = time.time()   
+            for clientid, cmd, data in frames:
+                if not session.is_loop():
+                    break
+                    
+                if cmd == P2P_CMD_DATA:
+                    self.netserver.senddata(clientid, data)
+                    
+                elif cmd == P2P_CMD_DATA | P2P_FLAG_COMPRESSED:
+                    self.netserver.senddata(clientid, data, True)
+                    
+                elif cmd == P2P_CMD_LOGOUT:                            
+                    if len(data) > 0:                                   
+                        logging.error ("P2pServer logout count[%d] is error", len(data))
+                        break
                         
-                        if cmd == P2P_CMD_LOGOUT:                            
-                            if count > 0:                                   
-                                logging.error ("P2pServer logout count[%d] is error" % count)
-                                break
-                                
-                            self.netserver.shutdown_client(clientid)
-                            
-                        elif cmd == P2P_CMD_TIMER:                            
-                            self.sendcmd(0, P2P_CMD_TIMER)
-                            if count > 0:                                   
-                                logging.error ("P2pServer timer count[%d] is error" % count)
-                                break
+                    self.netserver.finish_client(clientid)
+                    
+                elif cmd == P2P_CMD_TIMER:                            
+                    session.write_frame(0, P2P_CMD_TIMER)
+                    if len(data) > 0:                                   
+                        logging.error ("P2pServer timer count[%d] is error", len(data))
+                        break
+                        
+                elif cmd == P2P_CMD_WINDOW:
+                    if len(data) != P2P_WINDOW.size:
+                        logging.error ("P2pServer window count[%d] is error", len(data))
+                        break
+                        
+                    self.netserver.add_window(clientid, P2P_WINDOW.unpack(data)[0])
+                    
+                elif cmd == P2P_CMD_OPEN_OK or cmd == P2P_CMD_OPEN_FAIL:
+                    self.netserver.open_client(clientid, cmd == P2P_CMD_OPEN_OK)
+                    
+                elif cmd == P2P_CMD_ACK and session.resume is not None:
+                    if len(data) != P2P_ACK.size:
+                        logging.error ("P2pServer ack count[%d] is error", len(data))
+                        break
+                        
+                    session.resume.trim(P2P_ACK.unpack(data)[0])
+                    
+                if session.resume is not None:
+                    session.resume.acknowledge(session)
         except:
             logging.error ("P2pServer onread sock is exception")
             
         finally:
-            session.close()
+            session.drop()
 
     def onwrite(self, session):
         if session is None:
             return
 
         session.write_loop()
+        # a failed send ends the read as well
+        session.drop()
     
     def ontimer(self, session):
-        if session is None:
+        """ on the TimerWheel when the tunnel may have been silent too long """
+        if not session.is_loop():
             return
     
-        try:
-            while session.is_loop():          
-                gevent.sleep(1)   
-                if session.is_timeout(120):                  
-                    session.break_loop()
-                    logging.warning ('P2pServer client timeout')    
-        except:
-            logging.error ('P2pServer ontimer exception')           
+        silent = timers.now - session.last_read_time
+        if silent >= self.timeouts.tunnel:
+            # wakes the reader, break_loop() would leave it in recv
+            session.drop()
+            logging.warning ('P2pServer client timeout')    
+            return
+            
+        if session.resume is not None:
+            session.resume.acknowledge(session, True)
+            
+        session.timer = timers.schedule(self.timeouts.tunnel - silent, self.ontimer, session)
 
-    def verify_client(self, session):
-        try:
-            data = session.read(12)
-            if data != None:
-                count, clientid, cmd = struct.unpack('iii', data)
-                if count == 8 and cmd == P2P_CMD_CLIENT and clientid == 0:
-                    data = session.read(8)
-                    if data == 'test_p2p':
-                        logging.info ('P2pServer client login')
-                        return True
-        except:
-            pass
+    def verify_client(self, sock):
+        """
+            the login, read and answered on the socket ahead of any frame
+            the session queues. The session it starts or resumes and what
+            to send again on it, None when refused
+        """
+        clientid, cmd, data = recv_frame(sock)
+        login = self.parse_login(data) if cmd == P2P_CMD_CLIENT and clientid == 0 else None
+        if login is None:
+            logging.warning("P2pServer verify_client failed")
+            return None, None
+            
+        offer, token, received = login
+        compression = offer[0] if offer else None
+        if not self.resume:
+            token = None
+        
+        session = self.sessions.get(token)
+        if session is not None:
+            if session.resume.owner is not None:
+                # back before we noticed the last connection was gone
+                session.detach()
+                session.resume.owner.join()
+                
+            replay = session.resume.since(received)
+            if replay is not None and session.compression == compression:
+                send_frame(sock, 0, P2P_CMD_CLIENT, '%s resumed=%d' % (compression or '', session.bytes_in))
+                session.attach(sock)
+                logging.info ('P2pServer tunnel %s resumed, %d bytes sent again', 
+                    token, sum(len(data) for data in replay))
+                return session, replay
+                
+            # too far behind, the streams of that session are gone
+            self.expire(session)
+            
+        if not self.make_room():
+            return None, None
+            
+        # answered when the client asked for compression or resumption
+        if offer is not None or token is not None:
+            answer = compression or ''
+            if token is not None:
+                answer += ' resume=on'
+            send_frame(sock, 0, P2P_CMD_CLIENT, answer)
+        logging.info ('P2pServer client compression %s', compression or 'off')
+            
+        session = P2pSession(sock, queue = FairQueue())
+        session.compression = compression
+        metrics.add(session, 'tunnel')
+        if token is not None:
+            session.resume = Resumption(token)
+            session.resume.decoder = FrameDecoder(session, sink = self.netserver.pipe_for)
+            self.sessions[token] = session
+            
+        self.tunnels.append(session)
+        self.load[session] = 0
+        return session, ()
+        
+    def parse_login(self, data):
+        """
+            'test_p2p', then the codecs the client offers and resume=TOKEN:RECEIVED.
+            The codecs we take of the offer or None without one, the token
+            and received or None, None for a login that is not one
+        """
+        fields = data.split(' ')
+        if fields[0] != 'test_p2p':
+            return None
             
-        logging.warning("P2pServer verify_client failed")
+        logging.info ('P2pServer client login')
+        offer = token = received = None
+        for field in fields[1:]:
+            if field.startswith('resume='):
+                token, received = field[7:].split(':')
+                received = int(received)
+            else:
+                offer = [c for c in field.split(',') if c in self.codecs]
+        return offer, token, received
         
-        return False        
+    def make_room(self):
+        """ False when the tunnels are full """
+        if len(self.tunnels) < self.size:
+            return True
+            
+        # a tunnel the client left suspended makes room
+        suspended = [s for s in self.tunnels if s.sock is None and s.resume is not None]
+        if not suspended:
+            logging.warning ('P2pServer tunnels are full.')
+            return False
+            
+        self.expire(suspended[0])
+        return True
     
             
     def close(self):
-        if self.client != None:
-            self.client.break_loop()
+        for session in self.tunnels:
+            session.break_loop()
             
         StreamServer.close(self)            
   
+class HttpError(Exception):
+    """ a message the cache does not follow """
+    
+def http_header(headers, name, default = None):
+    """ the value of the first name header, name in lower case """
+    for key, value in headers:
+        if key.lower() == name:
+            return value
+    return default
+    
+def http_tokens(headers, name):
+    """ directives of all the name headers, token -> argument or '' """
+    tokens = {}
+    for key, value in headers:
+        if key.lower() == name:
+            for token in value.lower().split(','):
+                token, _, arg = token.strip().partition('=')
+                if token:
+                    tokens[token] = arg.strip('"')
+    return tokens
+    
+def http_date(value):
+    """ seconds since the epoch, None when missing or malformed """
+    if value:
+        parsed = email.utils.parsedate_tz(value)
+        if parsed is not None:
+            return email.utils.mktime_tz(parsed)
+    return None
+    
+def http_keepalive(version, headers):
+    tokens = http_tokens(headers, 'connection')
+    if version == 'HTTP/1.0':
+        return 'keep-alive' in tokens
+    return 'close' not in tokens
+    
+def http_length(headers):
+    """ body length from the headers, -1 for chunked, None when not given """
+    encoding = http_header(headers, 'transfer-encoding')
+    if encoding is not None:
+        if encoding.strip().lower() != 'chunked':
+            raise HttpError('transfer-encoding %s' % encoding)
+        return -1
+        
+    length = http_header(headers, 'content-length')
+    if length is None:
+        return None
+    try:
+        length = int(length)
+    except ValueError:
+        length = -1
+    if length < 0:
+        raise HttpError('content-length %s' % length)
+    return length
+    
+def http_lifetime(headers, now):
+    """ seconds a response stays fresh in a shared cache, None when it may not be stored """
+    tokens = http_tokens(headers, 'cache-control')
+    if 'no-store' in tokens or 'private' in tokens:
+        return None
+    if 'no-cache' in tokens:
+        return 0
+    for directive in ('s-maxage', 'max-age'):
+        if directive in tokens:
+            try:
+                return max(0, int(tokens[directive]))
+            except ValueError:
+                return 0
+                
+    date = http_date(http_header(headers, 'date')) or now
+    if http_header(headers, 'expires') is not None:
+        expires = http_date(http_header(headers, 'expires'))
+        return max(0, expires - date) if expires else 0
+        
+    modified = http_date(http_header(headers, 'last-modified'))
+    if modified:
+        return min(max(0, date - modified) * P2P_HTTP_HEURISTIC, P2P_HTTP_HEURISTIC_MAX)
+    return 0
+    
+def http_head(line, headers):
+    return '\r\n'.join([line] + ['%s: %s' % header for header in headers]) + '\r\n\r\n'
+    
+class HttpStream(object):
+    """ HTTP/1.x messages read from a socket, what comes after them stays in buf """
+    __slots__ = ('sock', 'buf')
+    
+    def __init__(self, sock):
+        self.sock = sock
+        self.buf = ''
+        
+    def fill(self):
+        data = self.sock.recv(P2P_CHUNK_MAX)
+        if not data:
+            return False
+        self.buf += data
+        return True
+        
+    def read_line(self):
+        while True:
+            end = self.buf.find('\r\n')
+            if end >= 0:
+                line, self.buf = self.buf[:end], self.buf[end + 2:]
+                return line
+            if len(self.buf) > P2P_HTTP_HEAD_MAX:
+                raise HttpError('line too long')
+            if not self.fill():
+                raise HttpError('closed in a line')
+                
+    def read_head(self):
+        """ 
+            (raw, start line, [(name, value)]) of the next message, None
+            when the peer closed before it. On HttpError buf still holds
+            the whole head
+        """
+        while True:
+            end = self.buf.find('\r\n\r\n')
+            if end >= 0:
+                break
+            if len(self.buf) > P2P_HTTP_HEAD_MAX:
+                raise HttpError('head too long')
+            if not self.fill():
+                if self.buf:
+                    raise HttpError('closed in a head')
+                return None
+                
+        lines = self.buf[:end].split('\r\n')
+        headers = []
+        for line in lines[1:]:
+            name, sep, value = line.partition(':')
+            # no obsolete line folding, no space before the colon
+            if not sep or not name or name != name.strip():
+                raise HttpError('bad header line %r' % line[:64])
+            headers.append((name, value.strip()))
+            
+        raw, self.buf = self.buf[:end + 4], self.buf[end + 4:]
+        return raw, lines[0], headers
+        
+    def read_body(self, length):
+        """ 
+            yields (raw, data) pieces of a body as sent and their payload,
+            length from http_length(), None reads to the end of the stream
+        """
+        if length is None:
+            while self.buf or self.fill():
+                data, self.buf = self.buf, ''
+                yield data, data
+        elif length >= 0:
+            while length > 0:
+                if not self.buf and not self.fill():
+                    raise HttpError('closed in a body')
+                data, self.buf = self.buf[:length], self.buf[length:]
+                length -= len(data)
+                yield data, data
+        else:
+            while True:
+                line = self.read_line()
+                try:
+                    size = int(line.split(';', 1)[0], 16)
+                except ValueError:
+                    raise HttpError('bad chunk size %r' % line[:64])
+                yield line + '\r\n', ''
+                if size == 0:
+                    break
+                for piece in self.read_body(size):
+                    yield piece
+                if self.read_line():
+                    raise HttpError('no line end after a chunk')
+                yield '\r\n', ''
+                
+            # trailers, up to the empty line
+            while True:
+                line = self.read_line()
+                yield line + '\r\n', ''
+                if not line:
+                    return
+                    
+class HttpEntry(object):
+    """ a response of HttpCache """
+    __slots__ = ('status', 'headers', 'body', 'vary', 'stored', 'age', 'lifetime', 'size')
+    
+    def __init__(self, status, headers, body, vary, now):
+        """ vary : the request's Accept-Encoding when the response varies on it, else None """
+        self.status = status
+        self.headers = [h for h in headers if h[0].lower() not in P2P_HTTP_HOP]
+        self.body = body
+        self.vary = vary
+        self.refresh(headers, now)
+        
+    def refresh(self, headers, now):
+        self.stored = now
+        try:
+            self.age = max(0, int(http_header(headers, 'age', 0)))
+        except ValueError:
+            self.age = 0
+        self.lifetime = http_lifetime(self.headers, now) or 0
+        self.size = len(self.body) + len(http_head(self.status, self.headers))
+        
+    def update(self, headers, now):
+        """ the headers of a 304 replace the stored ones of the same names """
+        fresh = [h for h in headers if h[0].lower() not in P2P_HTTP_HOP]
+        names = set(name.lower() for name, value in fresh)
+        self.headers = [h for h in self.headers if h[0].lower() not in names] + fresh
+        self.refresh(headers, now)
+        
+    def current_age(self, now):
+        return self.age + now - self.stored
+        
+    def fresh(self, now):
+        return self.current_age(now) < self.lifetime
+        
+    def matches(self, headers):
+        """ the client's conditional request is satisfied, it gets a 304 """
+        etag = http_header(self.headers, 'etag')
+        tags = http_header(headers, 'if-none-match')
+        if tags is not None:
+            # weak comparison, RFC 7232 2.3.2
+            tags = [t.strip().replace('W/', '', 1) for t in tags.split(',')]
+            return '*' in tags or etag is not None and etag.replace('W/', '', 1) in tags
+            
+        since = http_date(http_header(headers, 'if-modified-since'))
+        modified = http_date(http_header(self.headers, 'last-modified'))
+        return since is not None and modified is not None and modified <= since
+        
+    def validators(self):
+        """ conditional request headers to revalidate with, empty when there is nothing to compare """
+        headers = []
+        etag = http_header(self.headers, 'etag')
+        if etag is not None:
+            headers.append(('If-None-Match', etag))
+        modified = http_header(self.headers, 'last-modified')
+        if modified is not None:
+            headers.append(('If-Modified-Since', modified))
+        return headers
+        
+    def render(self, version, head_only, not_modified, keepalive, now):
+        headers = list(self.headers)
+        headers.append(('Age', '%d' % self.current_age(now)))
+        if not not_modified:
+            headers.append(('Content-Length', '%d' % len(self.body)))
+        if not keepalive:
+            headers.append(('Connection', 'close'))
+        elif version == 'HTTP/1.0':
+            headers.append(('Connection', 'keep-alive'))
+            
+        status = self.status
+        if not_modified:
+            status = status.split(' ', 1)[0] + ' 304 Not Modified'
+        head = http_head(status, headers)
+        return head if head_only or not_modified else head + self.body
+        
+class HttpCache:
+    """
+        LRU of GET responses for the -http services of NetServer. Up
+        to memory bytes are held in memory, with a directory up to disk
+        bytes more wait there in files, entries pushed out of memory go
+        to the disk and come back on a hit. Files are written and read
+        in the hub, the disk tier is meant for a local disk. A file of
+        the head in json goes with one of the body as it is
+    """
+    def __init__(self, memory = P2P_HTTP_CACHE, directory = None, disk = 0):
+        self.memory = memory
+        self.directory = directory
+        self.disk = disk if directory else 0
+        # key -> HttpEntry, least recently used first
+        self.entries = OrderedDict()
+        self.size = 0
+        # key -> size of its file
+        self.files = OrderedDict()
+        self.disk_size = 0
+        # bigger responses are relayed, not stored
+        self.object_max = memory / 8
+        if directory:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            # the index of the last run is gone with it
+            for name in os.listdir(directory):
+                if name.endswith(('.http', '.body')):
+                    os.unlink(os.path.join(directory, name))
+                    
+    def get(self, key):
+        """ the entry of key or None, it becomes the most recently used """
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry.size
+        elif key in self.files:
+            entry = self.load(key)
+            
+        if entry is not None:
+            self.put(key, entry)
+        return entry
+        
+    def put(self, key, entry):
+        self.discard(key)
+        self.entries[key] = entry
+        self.size += entry.size
+        while self.size > self.memory:
+            old, evicted = self.entries.popitem(last = False)
+            self.size -= evicted.size
+            if self.disk:
+                self.save(old, evicted)
+                
+    def discard(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry.size
+        if key in self.files:
+            self.disk_size -= self.files.pop(key)
+            self.unlink(key)
+            
+    def path(self, key, ext = '.http'):
+        return os.path.join(self.directory, hashlib.sha1(repr(key)).hexdigest() + ext)
+        
+    def unlink(self, key):
+        for ext in ('.http', '.body'):
+            try:
+                os.unlink(self.path(key, ext))
+            except OSError:
+                pass
+            
+    def save(self, key, entry):
+        if entry.size > self.disk:
+            return
+        # latin-1 takes header bytes of any value through json and back
+        head = {'status': entry.status, 'headers': entry.headers, 'vary': entry.vary, 
+            'stored': entry.stored, 'age': entry.age, 'lifetime': entry.lifetime}
+        try:
+            with open(self.path(key, '.body'), 'wb') as f:
+                f.write(entry.body)
+            with open(self.path(key), 'wb') as f:
+                json.dump(head, f, encoding = 'latin-1')
+        except (IOError, OSError) as ex:
+            logging.warning('HttpCache cannot write %s: %s', self.directory, ex)
+            self.unlink(key)
+            return
+            
+        self.files[key] = entry.size
+        self.disk_size += entry.size
+        while self.disk_size > self.disk:
+            old, size = self.files.popitem(last = False)
+            self.disk_size -= size
+            self.unlink(old)
+            
+    def load(self, key):
+        self.disk_size -= self.files.pop(key)
+        try:
+            with open(self.path(key), 'rb') as f:
+                head = json.load(f, encoding = 'latin-1')
+            with open(self.path(key, '.body'), 'rb') as f:
+                body = f.read()
+                
+            vary = head['vary']
+            entry = HttpEntry(head['status'].encode('latin-1'), 
+                [(name.encode('latin-1'), value.encode('latin-1')) for name, value in head['headers']], 
+                body, vary if vary is None else vary.encode('latin-1'), float(head['stored']))
+            entry.age = int(head['age'])
+            entry.lifetime = float(head['lifetime'])
+            return entry
+        except (IOError, OSError, ValueError, TypeError, KeyError, AttributeError) as ex:
+            logging.warning('HttpCache cannot read %s: %s', self.directory, ex)
+            return None
+        finally:
+            self.unlink(key)
+            
 class NetServer(StreamServer):
-    def __init__(self, listener, **kwargs):
+    def __init__(self, listener, service = '', **kwargs):
+        """
+            listener : proxy host of one service
+            service : name sent with P2P_CMD_LOGIN, '' for the client's default
+        """
         StreamServer.__init__(self, listener, **kwargs)
         
         self.p2pserver = None  
-        self.id = 0
-        self.clients = {}
+        self.service = service
+        # tunnel scheduling level of streams accepted here, 0 is the highest
+        self.priority = 0
+        # move bulk stream data with splice(2)
+        self.splice = False
+        # smallest and largest read from a client connection
+        self.chunk = (P2P_BUFFER_MAX, P2P_CHUNK_MAX)
+        self.sockopts = SocketOptions()
+        self.timeouts = Timeouts()
+        self.clients = StreamTable()
+        # clientid -> data read before P2P_CMD_OPEN_OK
+        self.opening = {}
+        # -http: the HttpCache answering GETs of this service
+        self.cache = None
+        
+    def share(self, other):
+        """ 
+            use the stream table of another service's NetServer, clientids
+            stay unique across the tunnel and P2pServer reaches every 
+            stream through either of them
+        """
+        self.clients = other.clients
+        self.opening = other.opening
 
     def handle(self, sock, address):
-        addr = '%s:%d' %( address[0], address[1])
-        
-        if (self.p2pserver.client == None):
+        if not self.p2pserver.tunnels:
             sock.close()
             return
         
-        logging.info ('NetServer %s connect.' % addr)
+        logging.info ('NetServer %s:%d connect.', address[0], address[1])
+        
+        self.sockopts.apply(sock)
+        if self.cache is None:
+            self.forward(sock)
+        else:
+            self.serve_http(sock)
         
-        session = P2pSession(sock)
+        logging.info ('NetServer %s:%d disconnect.', address[0], address[1])
+
+    def forward(self, sock, pending = ''):
+        """ a stream through the tunnel, pending : data read from sock already """
+        session = P2pSession(sock, P2P_OPEN_BUFFER)
+        session.limit = P2P_STREAM_WINDOW
+        session.set_chunk(*self.chunk)
         
-        self.id += 1
-        clientid = self.id
-        self.clients[clientid] = session
+        clientid = self.clients.add(session)
+        if clientid is None:
+            logging.warning ('NetServer stream table is full')
+            sock.close()
+            return
+            
+        # the last tunnel can drop while a -http request head is read
+        if not self.p2pserver.assign(clientid):
+            logging.warning ('NetServer client[%d] has no tunnel', clientid)
+            del self.clients[clientid]
+            sock.close()
+            return
+            
+        metrics.add(session, 'stream', clientid)
+        session.shaper = limits.shaper(clientid, self.service)
+        session.window_update = functools.partial(self.p2pserver.sendwindow, clientid)
+        session.codec = self.p2pserver.new_codec(clientid)
+        session.splice = (self.splice and session.codec is None 
+            and self.p2pserver.spliceable(clientid))
+        self.opening[clientid] = []
+        if pending:
+            self.opening[clientid].append(pending)
+            session.window -= len(pending)
+        if self.priority != 0:
+            self.p2pserver.set_priority(clientid, self.priority)
         
         try:
-            r = gevent.spawn(self.onread, session, clientid)
-            w = gevent.spawn(self.onwrite, session)
-
-            gevent.joinall([r,w])
-
+            # the writer comes and goes with the data, an idle stream
+            # holds on to this greenlet only
+            self.onread(session, clientid)
         finally:
             self.remove_client(clientid)            
         
-        logging.info ('NetServer %s disconnect.' % addr)
-
+    def serve_http(self, sock):
+        """
+            requests of a -http service, one at a time. Fresh cached GET
+            responses are answered here, the others go through a stream
+            of our own and come back relayed as they are, stored when
+            they may be. The first request that is not a plain GET or 
+            HEAD turns the connection into a normal stream
+        """
+        sock.settimeout(self.timeouts.idle or None)
+        client = HttpStream(sock)
+        upstream = None
+        try:
+            while True:
+                raw = ''
+                try:
+                    head = client.read_head()
+                    if head is None:
+                        break
+                    raw, line, headers = head
+                    method, target, version = line.split(' ')
+                    if method not in ('GET', 'HEAD') or not version.startswith('HTTP/1.') or \
+                            http_length(headers) or http_header(headers, 'upgrade') or \
+                            http_header(headers, 'expect'):
+                        raise HttpError('not a plain %s' % method)
+                except (HttpError, ValueError) as ex:
+                    logging.debug ('NetServer http goes raw: %s', ex)
+                    metrics.http['raw'] += 1
+                    if upstream is not None:
+                        upstream.sock.close()
+                        upstream = None
+                    sock.settimeout(None)
+                    self.forward(sock, raw + client.buf)
+                    return
+                    
+                if upstream is None:
+                    if not self.p2pserver.tunnels:
+                        break
+                    # the next misses of this connection reuse it
+                    ours, theirs = gevent.socket.socketpair()
+                    gevent.spawn(self.forward, theirs)
+                    ours.settimeout(self.timeouts.idle or None)
+                    upstream = HttpStream(ours)
+                    
+                keepalive, reuse = self.exchange(sock, upstream, raw, line, headers)
+                if not reuse:
+                    upstream.sock.close()
+                    upstream = None
+                if not keepalive:
+                    break
+        except (socket.error, HttpError) as ex:
+            logging.debug ('NetServer http closed: %s', ex)
+        finally:
+            if upstream is not None:
+                upstream.sock.close()
+            sock.close()
+            
+    def exchange(self, sock, upstream, raw, line, headers):
+        """ one request of serve_http, whether the client and the upstream stay open """
+        method, target, version = line.split(' ')
+        keepalive = http_keepalive(version, headers)
+        now = time.time()
+        tokens = http_tokens(headers, 'cache-control')
+        usable = 'no-store' not in tokens and http_header(headers, 'authorization') is None
+        key = (self.service, http_header(headers, 'host', ''), target)
+        entry = self.cache.get(key) if usable else None
+        if entry is not None and entry.vary not in (None, http_header(headers, 'accept-encoding', '')):
+            entry = None
+            
+        # the client asks for an end to end check
+        check = ('no-cache' in tokens or tokens.get('max-age') == '0' or 
+            'no-cache' in http_tokens(headers, 'pragma'))
+        if entry is not None and not check and entry.fresh(now):
+            metrics.http['hit'] += 1
+            sock.sendall(entry.render(version, method == 'HEAD', entry.matches(headers), 
+                keepalive, now))
+            return keepalive, True
+            
+        validators = entry.validators() if entry is not None else []
+        if validators:
+            conditional = ('if-none-match', 'if-modified-since')
+            raw = http_head(line, [h for h in headers if h[0].lower() not in conditional] + 
+                validators)
+        upstream.sock.sendall(raw)
+        
+        while True:
+            head = upstream.read_head()
+            if head is None:
+                raise HttpError('upstream closed')
+            response, status, rheaders = head
+            rversion, code = status.split(' ', 2)[:2]
+            code = int(code)
+            if code >= 200:
+                break
+            # 1xx, the final response follows
+            sock.sendall(response)
+            
+        reuse = http_keepalive(rversion, rheaders)
+        if code == 304 and validators:
+            metrics.http['revalidated'] += 1
+            entry.update(rheaders, now)
+            self.cache.put(key, entry)
+            sock.sendall(entry.render(version, method == 'HEAD', entry.matches(headers), 
+                keepalive, now))
+            return keepalive, reuse
+            
+        metrics.http['miss'] += 1
+        length = 0 if method == 'HEAD' or code in (204, 304) else http_length(rheaders)
+        if length is None:
+            # ends when the upstream closes, so does the client's response
+            reuse = keepalive = False
+            
+        vary = http_tokens(rheaders, 'vary')
+        lifetime = http_lifetime(rheaders, now)
+        store = (usable and method == 'GET' and code == 200 and lifetime is not None and 
+            (lifetime > 0 or http_header(rheaders, 'etag') or http_header(rheaders, 'last-modified')) and
+            http_header(rheaders, 'set-cookie') is None and not set(vary) - set(['accept-encoding']) and
+            (length < 0 or length <= self.cache.object_max))
+            
+        body = []
+        size = 0
+        out = [response]
+        for piece, data in upstream.read_body(length):
+            out.append(piece)
+            if store:
+                body.append(data)
+                size += len(data)
+                store = size <= self.cache.object_max
+            # send before the next read would wait
+            if not upstream.buf:
+                sock.sendall(''.join(out))
+                out = []
+        if out:
+            sock.sendall(''.join(out))
+            
+        if store:
+            self.cache.put(key, HttpEntry(status, rheaders, ''.join(body), 
+                http_header(headers, 'accept-encoding', '') if vary else None, now))
+        elif entry is not None and code == 200:
+            self.cache.discard(key)
+        return keepalive and http_keepalive(rversion, rheaders), reuse
+        
     def onread(self, session, clientid):
         try:
-            self.p2pserver.sendcmd(clientid, P2P_CMD_LOGIN)   
-            gevent.sleep(1)
+            self.p2pserver.sendcmd(clientid, P2P_CMD_LOGIN, self.service)   
+            # P2P_CMD_OPEN_OK replaces it with the idle timeout
+            session.timer = timers.schedule(P2P_OPEN_TIMEOUT, self.open_timeout, clientid)
             while session.is_loop():
                 try:
-                    data = session.read(-1)
+                    data = session.read_window()
                     if not data:
                         break
                     
-                    self.p2pserver.senddata(clientid, data)
+                    if clientid in self.opening:
+                        self.opening[clientid].append(data)
+                    else:
+                        self.p2pserver.senddata(clientid, data, session.codec)
                 except socket.error:
                     break                    
             self.p2pserver.sendcmd(clientid, P2P_CMD_LOGOUT)  
@@ -524,25 +4184,86 @@ class NetServer(StreamServer):
         finally:
             session.close()    
 
-    def onwrite(self, session):
-        session.write_loop()
-        
     def close(self):
-        for i in self.clients.keys:
-            self.clients[clientid].break_loop()     
+        for i in self.clients.keys():
+            self.clients[i].break_loop()     
             
         StreamServer.close(self)
 
-    def senddata(self, clientid, data):
+    def senddata(self, clientid, data, compressed = False):
+        if clientid in self.clients:
+            session = self.clients[clientid]
+            if compressed:
+                if session.codec is None:
+                    logging.error ('NetServer client[%d] compression is off', clientid)
+                    self.shutdown_client(clientid)
+                    return
+                    
+                try:
+                    data = session.codec.decompress(data)
+                except ValueError as ex:
+                    logging.error ('NetServer client[%d] bad compressed data: %s', clientid, ex)
+                    self.shutdown_client(clientid)
+                    return
+                if not data:
+                    return
+                    
+            if not session.write(data):
+                logging.error ('NetServer client[%d] window overrun', clientid)
+                self.shutdown_client(clientid)
+                
+    def add_window(self, clientid, count):
+        if clientid in self.clients:
+            self.clients[clientid].add_window(count)
+            
+    def pipe_for(self, clientid, cmd):
+        """ FrameDecoder sink, only raw DATA can go straight to the client """
+        if not self.splice or cmd != P2P_CMD_DATA or clientid not in self.clients:
+            return None
+            
+        return self.clients[clientid].get_write_pipe()
+            
+    def open_client(self, clientid, ok):
+        if clientid not in self.opening:
+            return
+            
+        pending = self.opening.pop(clientid)
+        if not ok:
+            logging.warning ('NetServer client[%d] open failed', clientid)
+            metrics.failed += 1
+            self.shutdown_client(clientid)
+            return
+            
+        codec = None
         if clientid in self.clients:
-            self.clients[clientid].write(data)
+            session = self.clients[clientid]
+            metrics.setup.observe(time.time() - session.created)
+            session.expire_after(self.timeouts.idle, self.shutdown_client, clientid)
+            codec = session.codec
+            
+        for data in pending:
+            self.p2pserver.senddata(clientid, data, codec)
+            
+        self.add_window(clientid, P2P_STREAM_WINDOW - P2P_OPEN_BUFFER)
+        
+    def open_timeout(self, clientid):
+        if clientid in self.opening:
+            logging.warning ('NetServer client[%d] open timeout', clientid)
+            metrics.failed += 1
+            del self.opening[clientid]
+            self.shutdown_client(clientid)
     
     def shutdown_client(self, clientid):
         if clientid in self.clients:
             self.clients[clientid].close()
             
+    def finish_client(self, clientid):
+        """ the client logged out, what it sent before still goes out """
+        if clientid in self.clients:
+            self.clients[clientid].finish()
+            
     def remove_client(self, clientid):
-        logging.info ('NetServer client[%d] logout' % clientid)
+        logging.info ('NetServer client[%d] logout', clientid)
         
         try:
             if clientid in self.clients:
@@ -550,43 +4271,147 @@ class NetServer(StreamServer):
                 del self.clients[clientid]
                 
                 ss.close()
+                
+            self.opening.pop(clientid, None)
+            if self.priority != 0:
+                self.p2pserver.set_priority(clientid, 0)
+                
+            self.p2pserver.release(clientid)
         except:
-            logging.error ('NetServer remove client[%d] exception' % clientid)        
+            logging.error ('NetServer remove client[%d] exception', clientid)        
          
-def client_loop(p2phost, serverhost):
+def client_loop(p2phost, serverhost, tunnels = 1, workers = 1, codecs = (), pool = (0, 0), 
+        stats = None, splice = False, chunk = (P2P_BUFFER_MAX, P2P_CHUNK_MAX), 
+        tunnel_opts = None, stream_opts = None, services = (), timeouts = None, resume = 0, 
+        transport = 'tcp', capture_to = None, diagnose = None):
 
     p2phost = parse_address(p2phost)
-    serverhost = parse_address(serverhost) 
+    # resolved here once, not on every backend connect
+    routes = {}
+    if serverhost:
+        routes[''] = parse_address(serverhost) 
+    for name, host, priority in services:
+        routes[name] = parse_address(host)
+    if stats:
+        stats = parse_address(stats)
+    
+    if workers > 1:
+        worker, children, p2phost, stats = fork_workers(workers, p2phost, stats)
+        gevent.signal(signal.SIGTERM, stop_workers, children)
+    if limits.path is not None:
+        gevent.signal(signal.SIGHUP, limits.reload, children if workers > 1 else ())
+    if capture_to is not None:
+        path, payload = capture_to
+        capture.open('%s.%d' % (path, worker) if workers > 1 else path, payload, 'client')
+        gevent.signal(signal.SIGTERM, capture.close)
+        gevent.signal(signal.SIGINT, capture.close)
+    if diagnose is not None:
+        block, sample, path = diagnose
+        diagnostics.start(block, sample, '%s.%d' % (path, worker) if path and workers > 1 else path)
+        
+    if stats:
+        start_stats(stats)
 
-    while True:
-        client = P2pClient(p2phost, serverhost)   
+    # one P2pClient per tunnel connection, the server keeps each
+    # stream on one tunnel so they do not share any state. Each one
+    # reconnects on its own until closed
+    connections = []
+    for i in range(tunnels):
+        client = P2pClient(p2phost, routes, codecs, pool, splice, chunk, 
+            tunnel_opts, stream_opts, timeouts, resume, transport)
         
         gevent.signal(signal.SIGTERM, client.close)
         gevent.signal(signal.SIGINT, client.close)
         
-        client.start()  
-        gevent.wait()      
+        connections.append(client.start())
         
-        time.sleep(8)        
+    # not gevent.wait(), the stats server never finishes
+    gevent.joinall(connections)
         
-def server_loop(p2phost, proxyhost):
+def server_loop(p2phost, proxyhost, tunnels = 1, workers = 1, codecs = None, stats = None, 
+        splice = False, chunk = (P2P_BUFFER_MAX, P2P_CHUNK_MAX), tunnel_opts = None, 
+        stream_opts = None, services = (), timeouts = None, resume = 0, transports = ('tcp',), 
+        http = (), httpcache = (P2P_HTTP_CACHE, None, 0), capture_to = None, diagnose = None):
 
     p2phost = parse_address(p2phost)       
-    proxyhost = parse_address(proxyhost)
+    listeners = [('', proxyhost, 0)] if proxyhost else []
+    listeners = [(name, parse_address(host), priority) 
+        for name, host, priority in listeners + list(services)]
+    unknown = set(http) - set(name for name, host, priority in listeners)
+    if unknown:
+        sys.exit('-http names unknown services: %s' % ','.join(n or '-' for n in sorted(unknown)))
+    if stats:
+        stats = parse_address(stats)
+    
+    if workers > 1:
+        # every worker accepts on the proxy port, the kernel spreads the
+        # connections, and pairs with the client worker on its own p2p port
+        worker, children, p2phost, stats = fork_workers(workers, p2phost, stats)
+        listeners = [(name, reuseport_listener(host), priority) 
+            for name, host, priority in listeners]
+        gevent.signal(signal.SIGTERM, stop_workers, children)
+    if limits.path is not None:
+        gevent.signal(signal.SIGHUP, limits.reload, children if workers > 1 else ())
+        
+    metrics.role = 'server'
+    if capture_to is not None:
+        path, payload = capture_to
+        capture.open('%s.%d' % (path, worker) if workers > 1 else path, payload, 'server')
+        gevent.signal(signal.SIGTERM, capture.close)
+        gevent.signal(signal.SIGINT, capture.close)
+    if diagnose is not None:
+        block, sample, path = diagnose
+        diagnostics.start(block, sample, '%s.%d' % (path, worker) if path and workers > 1 else path)
+    if http:
+        memory, directory, disk = httpcache
+        if directory and workers > 1:
+            directory = os.path.join(directory, '%d' % worker)
+        metrics.cache = HttpCache(memory, directory, disk)
+    if stats:
+        start_stats(stats)
     
-    netserver = NetServer(proxyhost)
-    p2pserver = P2pServer(p2phost)
+    p2pserver = P2pServer(p2phost, tunnels, codecs)
+    if tunnel_opts is not None:
+        p2pserver.sockopts = tunnel_opts
+    if timeouts is not None:
+        p2pserver.timeouts = timeouts
+    p2pserver.resume = resume
+        
+    # one listener per service, all streams share the tunnels
+    netservers = []
+    for name, host, priority in listeners:
+        netserver = NetServer(host, name)
+        netserver.priority = priority
+        netserver.splice = splice
+        netserver.chunk = chunk
+        if name in http:
+            netserver.cache = metrics.cache
+        if stream_opts is not None:
+            netserver.sockopts = stream_opts
+        if timeouts is not None:
+            netserver.timeouts = timeouts
+        if netservers:
+            netserver.share(netservers[0])
+        netserver.p2pserver = p2pserver
+        netservers.append(netserver)
+        
+        gevent.signal(signal.SIGTERM, netserver.close)
+        gevent.signal(signal.SIGINT, netserver.close)
     
-    netserver.p2pserver = p2pserver
-    p2pserver.netserver = netserver
+    p2pserver.netserver = netservers[0]
     
-    gevent.signal(signal.SIGTERM, netserver.close)
-    gevent.signal(signal.SIGINT, netserver.close)
     gevent.signal(signal.SIGTERM, p2pserver.close)
     gevent.signal(signal.SIGINT, p2pserver.close)
     
-    p2pserver.start()
-    netserver.start()
+    if 'udp' in transports:
+        udpserver = UdpServer(p2phost, p2pserver)
+        gevent.signal(signal.SIGTERM, udpserver.close)
+        gevent.signal(signal.SIGINT, udpserver.close)
+        udpserver.start()
+    if 'tcp' in transports:
+        p2pserver.start()
+    for netserver in netservers:
+        netserver.start()
      
     gevent.wait()
     
@@ -594,11 +4419,101 @@ def server_loop(p2phost, proxyhost):
 def main():  
     s = """
             Usage:
-            client mode: p2pproxy -c -p2p=host1 -server=host2
-            server mode: p2pproxy -s -p2p=host1 -server=host2
+            client mode: p2pproxy -c -p2p=host1 -server=host2 [-tunnels=N] [-workers=N] [-compress=codecs]
+                         [-pool=MIN[,MAX]] [-stats=host] [-splice=on]
+            server mode: p2pproxy -s -p2p=host1 -server=host2 [-tunnels=N] [-workers=N] [-compress=codecs]
+                         [-stats=host] [-splice=on] [-http=names] [-httpcache=SIZE[,DIR,SIZE]]
+            both modes: [-services=path] in addition to or instead of -server
+            both modes: [-chunk=[MIN,]MAX] [-tunnelbuf=RCV[,SND]] [-streambuf=RCV[,SND]] 
+                        [-nodelay=kinds]
+            both modes: [-tunneltimeout=N] [-streamidle=N] [-resume=N] [-transport=kinds]
+            client mode: [-keepalive=N] [-halfopen=N]
+            both modes: [-ratelimit=path] [-capture=path[,BYTES]] [-diagnostics=MS[,MS[,path]]]
+            both modes: [-log=path] [-loglevel=level] [-lograte=N]
             
             host: ip:port
-        """
+            services: file of 'name host:port [priority]' lines. The
+                      server listens on each host:port, the client
+                      connects streams of that name to its host:port.
+                      One tunnel carries them all. -server is the
+                      service without a name. priority: server side 
+                      tunnel scheduling level, 0 goes first, default 0
+            tunnels: parallel tunnel connections, default 1
+            workers: processes on each side, worker i uses p2p port + i, 
+                     both sides need the same value, default 1
+            compress: comma separated %s. The client offers them in 
+                      order, default none. The server accepts these, 
+                      default all. Needs this version on both sides.
+            pool: idle connections to host2 kept open per tunnel, MIN at
+                  all times, up to MAX (default MIN) during bursts of
+                  new streams. Default 0, connect on demand.
+            stats: serve prometheus metrics over http, worker i on port + i,
+                   the ports of the workers must not overlap their p2p ports
+            splice: on to pass bulk data of uncompressed streams from
+                    socket to socket with splice(2), linux only, default
+                    off. Each side decides for itself.
+            chunk: bytes read from a proxied connection at once, starts 
+                   at MIN, doubles while reads fill it up to MAX and 
+                   halves when they do not, default %d,%d
+            tunnelbuf, streambuf: SO_RCVBUF and SO_SNDBUF of the tunnel
+                   and of the proxied connections, 0 for the kernel's
+                   autotuning, default 0
+            nodelay: comma separated tunnel/stream, sockets sending with 
+                     TCP_NODELAY, none for neither, default tunnel
+            tunneltimeout: seconds without a frame from the peer before
+                           the tunnel is closed, default %d
+            keepalive: seconds without a frame from the server before
+                       the client sends a keepalive, default %d
+            streamidle: seconds without data either way before a stream
+                        is closed, each side decides, default 0, never
+            halfopen: seconds without data from the server before a 
+                      stream whose backend closed is closed, 0 for the
+                      streamidle value, default %d
+            resume: seconds the streams of a dropped tunnel wait for it
+                    to come back over a new connection, with the data 
+                    in flight sent again. Both sides need it, 0 for 
+                    off, default 0. The client reconnects regardless
+            transport: tcp or udp for the tunnel, the client picks one,
+                       the server serves a comma separated list, default
+                       tcp. Over udp the frames of each stream are put
+                       in order and sent again on their own, a lost 
+                       datagram holds up only the stream it carried.
+                       No -resume, -tunnelbuf or -nodelay over udp
+            ratelimit: file of token bucket limits on the data each side
+                       reads from its proxied connections, lines of
+                       'total RATE [BURST]', 'service NAME RATE [BURST]',
+                       'stream RATE [BURST]' or 'clientid ID RATE [BURST]'
+                       in bytes a second, k/m/g suffixes, each worker on
+                       its own. Read again on SIGHUP
+            http: comma separated services whose clients speak HTTP/1.x, 
+                  - for -server. Fresh GET responses are answered from
+                  the cache, stale ones revalidated with a conditional 
+                  request, after Cache-Control, Expires and ETag. A
+                  connection sending anything but GET or HEAD becomes
+                  a plain stream
+            httpcache: bytes of responses held in memory, k/m/g 
+                       suffixes, default 64m, then a directory for a 
+                       disk tier and its size. Each worker has its own,
+                       in a subdirectory per worker
+            capture: record every tunnel frame read or queued, time,
+                     clientid, command and length, with the first BYTES
+                     of its payload, default 0, to path, path.N for 
+                     worker N. p2pbench -replay plays it back
+            diagnostics: log every time one greenlet holds the hub 
+                         longer than MS, default %d, with its stack, 
+                         and sample the main thread every MS, default
+                         %d, 0 for not at all, counting cpu by role. 
+                         SIGUSR1 logs the blocks, the samples and where
+                         the greenlets wait, as does any line sent to 
+                         the unix socket at path, path.N for worker N, 
+                         but reset, which starts the samples over
+            log: log file, - for stderr, off for none, default p2pproxy.log
+            loglevel: debug, info, warning or error, default info
+            lograte: records per second for each kind of message, 
+                     0 for no limit, default %d
+        """ % ('/'.join(sorted(P2P_CODECS)), P2P_BUFFER_MAX, P2P_CHUNK_MAX, P2P_TUNNEL_TIMEOUT, 
+            P2P_KEEPALIVE, P2P_HALFOPEN_TIMEOUT, P2P_DIAG_BLOCK * 1e3, P2P_DIAG_SAMPLE * 1e3, 
+            P2P_LOG_RATE)
     args = sys.argv[1:] 
     if len(args) < 2:        
         sys.exit(s)
@@ -617,16 +4532,84 @@ def main():
             elif len(arr) == 2:
                 params[arr[0]] = arr[1]                
 
-    if len(params) >= 2 and 'p2p' in params and 'server' in params:
+    if 'p2p' in params and ('server' in params or 'services' in params):
         p2p = params['p2p']
-        server = params['server']
+        server = params.get('server')
+        services = load_services(params['services']) if 'services' in params else ()
+        tunnels = int(params.get('tunnels', 1))
+        workers = int(params.get('workers', 1))
+        codecs = None
+        if 'compress' in params:
+            codecs = [c for c in params['compress'].split(',') if c]
+            for c in codecs:
+                if c not in P2P_CODECS:
+                    sys.exit('Unknown codec %r, have %s' % (c, ','.join(sorted(P2P_CODECS))))
+        pool = [int(n) for n in params.get('pool', '0').split(',')]
+        pool = (pool[0], pool[-1])
+        use_splice = params.get('splice', 'off') == 'on'
+        if use_splice and splice is None:
+            sys.exit('splice(2) is not available here')
+            
+        chunk = [int(n) for n in params.get('chunk', '%d' % P2P_CHUNK_MAX).split(',')]
+        chunk = (min(chunk[0], P2P_BUFFER_MAX) if len(chunk) == 1 else chunk[0], chunk[-1])
+        if not 0 < chunk[0] <= chunk[1] <= P2P_STREAM_WINDOW:
+            sys.exit('Expected 0 < MIN <= MAX <= %d: -chunk=%s' % (P2P_STREAM_WINDOW, params['chunk']))
+            
+        nodelay = params.get('nodelay', 'tunnel').split(',')
+        tunnel_opts, stream_opts = [], []
+        for kind, opts in (('tunnel', tunnel_opts), ('stream', stream_opts)):
+            sizes = [int(n) for n in params.get(kind + 'buf', '0').split(',')]
+            opts.append(SocketOptions(sizes[0], sizes[-1], kind in nodelay))
+            
+        timeouts = Timeouts(int(params.get('keepalive', P2P_KEEPALIVE)), 
+            int(params.get('tunneltimeout', P2P_TUNNEL_TIMEOUT)), int(params.get('streamidle', 0)), 
+            int(params.get('halfopen', P2P_HALFOPEN_TIMEOUT)))
+        resume = int(params.get('resume', 0))
+        transports = params.get('transport', 'tcp').split(',')
+        if not transports or set(transports) - set(['tcp', 'udp']):
+            sys.exit(s)
+        if not server_mode and len(transports) > 1:
+            sys.exit('The client uses one transport: -transport=%s' % params['transport'])
+        if resume and transports == ['udp']:
+            sys.exit('-resume needs the tcp transport')
+        http = ['' if n == '-' else n for n in params.get('http', '').split(',') if n]
+        httpcache = params.get('httpcache', '%d' % P2P_HTTP_CACHE).split(',')
+        if len(httpcache) not in (1, 3):
+            sys.exit(s)
+        httpcache = (parse_size(httpcache[0]),) + (
+            (httpcache[1], parse_size(httpcache[2])) if len(httpcache) == 3 else (None, 0))
+        capture_to = None
+        if 'capture' in params:
+            fields = params['capture'].split(',')
+            capture_to = (fields[0], parse_size(fields[1]) if len(fields) > 1 else 0)
+        diagnose = None
+        if 'diagnostics' in params:
+            fields = params['diagnostics'].split(',')
+            diagnose = (float(fields[0] or P2P_DIAG_BLOCK * 1e3) / 1e3, 
+                float(fields[1] if len(fields) > 1 else P2P_DIAG_SAMPLE * 1e3) / 1e3, 
+                fields[2] if len(fields) > 2 else None)
+        
+        level = params.get('loglevel', 'info').upper()
+        if level not in ('DEBUG', 'INFO', 'WARNING', 'ERROR'):
+            sys.exit(s)
+        setup_logging(params.get('log', 'p2pproxy.log'), getattr(logging, level), 
+            int(params.get('lograte', P2P_LOG_RATE)))
+        if 'ratelimit' in params:
+            try:
+                limits.load(params['ratelimit'])
+            except (IOError, ValueError) as ex:
+                sys.exit(str(ex))
         
         if server_mode:
             print('start p2p server')
-            server_loop(p2p, server)
+            server_loop(p2p, server, tunnels, workers, codecs, params.get('stats'), use_splice, 
+                chunk, tunnel_opts[0], stream_opts[0], services, timeouts, resume, transports, 
+                http, httpcache, capture_to, diagnose)
         else:  
             print('start p2p client')
-            client_loop(p2p, server)
+            client_loop(p2p, server, tunnels, workers, codecs or (), pool, params.get('stats'), 
+                use_splice, chunk, tunnel_opts[0], stream_opts[0], services, timeouts, resume, 
+                transports[0], capture_to, diagnose)
     else:
         sys.exit(s)
     
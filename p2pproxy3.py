@@ -0,0 +1,986 @@
+#encoding=utf-8
+"""
+    asyncio engine of p2pproxy for python 3. It speaks the tunnel
+    protocol of p2pproxy.py byte for byte, so either side of a tunnel
+    can run either engine. Runs on uvloop when it is installed.
+"""
+
+import asyncio
+import logging
+import logging.handlers
+import queue
+import random
+import signal
+import socket
+import struct
+import sys
+import time
+import zlib
+from collections import deque
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.block
+except ImportError:
+    lz4 = None
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+P2P_CMD_LOGIN = 1
+P2P_CMD_DATA = 2
+P2P_CMD_LOGOUT = 3
+P2P_CMD_CLIENT = 4
+P2P_CMD_TIMER = 5
+P2P_CMD_WINDOW = 6
+P2P_CMD_OPEN_OK = 7
+P2P_CMD_OPEN_FAIL = 8
+# set on P2P_CMD_DATA when the payload went through the stream compressor
+P2P_FLAG_COMPRESSED = 0x100
+
+P2P_BUFFER_MAX = 2048
+P2P_FRAME_MAX = 1024*1024
+P2P_WRITE_BATCH = 64*1024
+# per stream credit, bytes in flight through the tunnel before the
+# reader waits for a P2P_CMD_WINDOW update from the peer
+P2P_STREAM_WINDOW = 256*1024
+# client data read ahead while the backend connects, the rest of the
+# window is granted by P2P_CMD_OPEN_OK
+P2P_OPEN_BUFFER = 64*1024
+P2P_OPEN_TIMEOUT = 30
+# seconds between client reconnects, doubling while the server is away
+P2P_RECONNECT_MIN = 0.5
+P2P_RECONNECT_MAX = 30
+# reads shorter than this go out as they are
+P2P_COMPRESS_MIN = 128
+# a frame that did not shrink by 1/8 sends the next ones raw, the
+# number doubles up to the max while the stream keeps not compressing
+P2P_COMPRESS_SKIP = 16
+P2P_COMPRESS_SKIP_MAX = 1024
+
+# count, clientid, cmd
+P2P_HEADER = struct.Struct('iii')
+# P2P_CMD_WINDOW payload: credit in bytes
+P2P_WINDOW = struct.Struct('i')
+# lz4 compressed stream data: compressed and plain size of each block
+P2P_LZ4_BLOCK = struct.Struct('<II')
+P2P_LOGIN = b'test_p2p'
+
+def parse_address(address):
+    try:
+        hostname, port = address.rsplit(':', 1)
+        port = int(port)
+    except ValueError:
+        sys.exit('Expected HOST:PORT: %r' % address)
+    return socket.gethostbyname(hostname), port
+
+def setup_logging(path = 'p2pproxy.log', level = logging.INFO):
+    """
+        path '-' logs to stderr, 'off' turns logging off. Records are
+        written on a thread of their own, the loop never waits for the
+        disk. Returns that thread's listener, stop() it to flush at exit
+    """
+    if path == 'off':
+        logging.disable(logging.CRITICAL)
+        return None
+
+    if path == '-':
+        target = logging.StreamHandler()
+    else:
+        target = logging.FileHandler(path)
+
+    target.setFormatter(logging.Formatter('%(asctime)s <%(name)s> [%(levelname)s]:%(message)s'))
+    records = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(records, target)
+    listener.start()
+    root = logging.getLogger()
+    root.addHandler(logging.handlers.QueueHandler(records))
+    root.setLevel(level)
+    return listener
+
+
+def zlib_codec():
+    c = zlib.compressobj(1)
+    d = zlib.decompressobj()
+    return lambda data: c.compress(data) + c.flush(zlib.Z_SYNC_FLUSH), d.decompress
+
+def zstd_codec():
+    c = zstandard.ZstdCompressor(level = 1).compressobj()
+    d = zstandard.ZstdDecompressor().decompressobj()
+    return lambda data: c.compress(data) + c.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK), d.decompress
+
+def lz4_codec():
+    # python-lz4's frame decompressor holds decoded blocks back when
+    # they come in pieces, so every frame is an lz4 block of its own
+    # behind its sizes. Blocks carry no dictionary over, lz4 is there
+    # for speed
+    pending = bytearray()
+
+    def compress(data):
+        out = lz4.block.compress(data, store_size = False)
+        return P2P_LZ4_BLOCK.pack(len(out), len(data)) + out
+
+    def decompress(data):
+        pending.extend(data)
+        out = []
+        while len(pending) >= P2P_LZ4_BLOCK.size:
+            count, size = P2P_LZ4_BLOCK.unpack_from(pending)
+            # a block is one read of the peer's, the size is not
+            # allocated on its word alone
+            if size > P2P_STREAM_WINDOW or count > P2P_FRAME_MAX:
+                raise ValueError('lz4 block of %d bytes, %d plain' % (count, size))
+            end = P2P_LZ4_BLOCK.size + count
+            if len(pending) < end:
+                break
+
+            out.append(lz4.block.decompress(bytes(pending[P2P_LZ4_BLOCK.size:end]),
+                uncompressed_size = size))
+            del pending[:end]
+
+        return b''.join(out)
+
+    return compress, decompress
+
+# name -> (compress, decompress) factory, client offers are tried in order
+P2P_CODECS = {'zlib': zlib_codec}
+if zstandard is not None:
+    P2P_CODECS['zstd'] = zstd_codec
+if lz4 is not None:
+    P2P_CODECS['lz4'] = lz4_codec
+
+class StreamCodec:
+    """
+        compression state of one stream, a compressor for what we send
+        and a decompressor for what the peer sends. Each frame is
+        flushed so the peer can decode it on arrival, the dictionary
+        carries over between frames.
+    """
+    def __init__(self, name):
+        self.compressor, self.decompressor = P2P_CODECS[name]()
+        self.skip = 0
+        self.backoff = P2P_COMPRESS_SKIP
+
+    def compress(self, data):
+        """ returns the cmd and payload of the DATA frame for data """
+        if len(data) < P2P_COMPRESS_MIN:
+            return P2P_CMD_DATA, data
+
+        if self.skip > 0:
+            self.skip -= 1
+            return P2P_CMD_DATA, data
+
+        out = self.compressor(data)
+        if len(out) * 8 > len(data) * 7:
+            # already compressed or encrypted, the peer's context has
+            # seen it so it still goes out compressed, the next don't
+            self.skip = self.backoff
+            self.backoff = min(self.backoff * 2, P2P_COMPRESS_SKIP_MAX)
+        else:
+            self.backoff = P2P_COMPRESS_SKIP
+
+        return P2P_CMD_DATA | P2P_FLAG_COMPRESSED, out
+
+    def decompress(self, data):
+        return self.decompressor(data)
+
+class FairQueue:
+    """
+        write queue of a tunnel. Frames of one clientid keep their
+        order, clientids are served deficit round robin so a bulk
+        stream cannot starve the others. Lower priority levels go first,
+        a level is only served when every level before it is empty.
+    """
+    def __init__(self, quantum = 4*P2P_BUFFER_MAX):
+        self.quantum = quantum
+        self.count = 0
+        # frames that may overtake stream data (window updates, keepalive)
+        self.urgent = deque()
+        self.streams = {}
+        self.deficit = {}
+        # level -> clientids with queued frames, in round robin order
+        self.levels = {}
+        self.priority = {}
+
+    def set_priority(self, key, level):
+        if level == 0:
+            self.priority.pop(key, None)
+        else:
+            self.priority[key] = level
+
+    def put(self, item, key = 0, urgent = False):
+        if urgent:
+            self.urgent.append(item)
+        else:
+            q = self.streams.get(key)
+            if q is None:
+                q = self.streams[key] = deque()
+                self.deficit[key] = 0
+                self.levels.setdefault(self.priority.get(key, 0), deque()).append(key)
+
+            q.append(item)
+
+        self.count += 1
+
+    def empty(self):
+        return self.count == 0
+
+    def get_nowait(self):
+        self.count -= 1
+        if self.urgent:
+            return self.urgent.popleft()
+
+        level = min(self.levels)
+        active = self.levels[level]
+        key = active[0]
+        q = self.streams[key]
+        if len(active) > 1:
+            size = sum(map(len, q[0]))
+            while self.deficit[key] < size:
+                # used up its share this round, next stream
+                self.deficit[key] += self.quantum
+                active.rotate(-1)
+                key = active[0]
+                q = self.streams[key]
+                size = sum(map(len, q[0]))
+
+            self.deficit[key] -= size
+
+        item = q.popleft()
+        if not q:
+            del self.streams[key]
+            del self.deficit[key]
+            active.popleft()
+            if not active:
+                del self.levels[level]
+
+        return item
+
+class FrameParser:
+    def __init__(self, on_frame):
+        """
+            on_frame : called with (clientid, cmd, data) for every frame.
+            DATA payloads are passed as memoryview pieces as soon as they
+            arrive, cmd keeps P2P_FLAG_COMPRESSED. Other commands come
+            with their whole payload as bytes
+        """
+        self.on_frame = on_frame
+        # a header or control frame split across reads
+        self.buf = bytearray()
+        # rest of the DATA frame being received
+        self.remain = 0
+        self.clientid = 0
+        self.cmd = 0
+
+    def feed(self, data):
+        if self.buf:
+            self.buf += data
+            data = bytes(self.buf)
+            self.buf.clear()
+
+        view = memoryview(data)
+        pos = 0
+        end = len(data)
+        while pos < end:
+            if self.remain > 0:
+                n = min(self.remain, end - pos)
+                self.remain -= n
+                pos += n
+                self.on_frame(self.clientid, self.cmd, view[pos - n:pos])
+                continue
+
+            if end - pos < P2P_HEADER.size:
+                break
+
+            count, clientid, cmd = P2P_HEADER.unpack_from(data, pos)
+            is_data = (cmd & ~P2P_FLAG_COMPRESSED) == P2P_CMD_DATA
+            if count < 0 or (not is_data and count > P2P_FRAME_MAX):
+                raise IOError('frame cmd[%d] count[%d] is error' % (cmd, count))
+
+            if is_data:
+                pos += P2P_HEADER.size
+                self.remain, self.clientid, self.cmd = count, clientid, cmd
+                continue
+
+            if end - pos < P2P_HEADER.size + count:
+                break
+
+            pos += P2P_HEADER.size + count
+            self.on_frame(clientid, cmd, bytes(view[pos - count:pos]))
+
+        if pos < end:
+            self.buf += view[pos:]
+
+class P2pTunnel(asyncio.Protocol):
+    """
+        one tunnel connection. Frames written in one loop iteration go
+        out in one send, when the socket backs up they wait in a
+        FairQueue and the streams take turns
+    """
+    def __init__(self):
+        self.loop = asyncio.get_event_loop()
+        self.transport = None
+        self.parser = FrameParser(self.on_frame)
+        self.queue = FairQueue()
+        self.flushing = False
+        self.paused = False
+        # codec name agreed at login
+        self.compression = None
+        self.last_read_time = time.time()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        transport.set_write_buffer_limits(P2P_WRITE_BATCH, P2P_WRITE_BATCH // 4)
+        # small control frames go back and forth during stream setup
+        sock = transport.get_extra_info('socket')
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def data_received(self, data):
+        self.last_read_time = time.time()
+        try:
+            self.parser.feed(data)
+        except IOError as ex:
+            logging.error('%s %s', type(self).__name__, ex)
+            self.transport.close()
+
+    def is_timeout(self, seconds):
+        return time.time() - self.last_read_time > seconds
+
+    def write_frame(self, clientid, cmd, data = b''):
+        if self.transport is None:
+            return
+
+        self.queue.put((P2P_HEADER.pack(len(data), clientid, cmd), data),
+            clientid, cmd == P2P_CMD_WINDOW or clientid == 0)
+        if not self.flushing and not self.paused:
+            self.flushing = True
+            self.loop.call_soon(self.flush)
+
+    def flush(self):
+        self.flushing = False
+        queue = self.queue
+        while not self.paused and not queue.empty():
+            if self.transport is None or self.transport.is_closing():
+                self.queue = FairQueue()
+                return
+
+            chunks = []
+            size = 0
+            while size < P2P_WRITE_BATCH and not queue.empty():
+                header, data = queue.get_nowait()
+                chunks.append(header)
+                chunks.append(data)
+                size += len(header) + len(data)
+
+            # pause_writing() is called from in here once the socket backs up
+            self.transport.write(b''.join(chunks))
+
+    def pause_writing(self):
+        self.paused = True
+
+    def resume_writing(self):
+        self.paused = False
+        self.flush()
+
+    def pending(self):
+        return self.transport.get_write_buffer_size()
+
+class P2pStream(asyncio.Protocol):
+    """
+        a proxied connection, what it reads goes into the tunnel as
+        DATA frames of clientid, at most window bytes ahead of the
+        credit the peer returns
+    """
+    def __init__(self, owner, clientid = 0, tunnel = None, window = P2P_STREAM_WINDOW):
+        """
+            owner : keeps the stream table, remove_client() is called on close
+            clientid : stream id in the tunnel
+            tunnel : P2pTunnel carrying the stream
+            window : bytes this stream may send before credit comes back
+        """
+        self.owner = owner
+        self.clientid = clientid
+        self.tunnel = tunnel
+        self.transport = None
+        self.window = window
+        # bytes the peer may have in flight to us
+        self.limit = P2P_STREAM_WINDOW
+        # read but not sent, the window is used up or the peer has not
+        # confirmed the stream yet
+        self.backlog = bytearray()
+        self.opening = True
+        self.reading = True
+        self.eof = False
+        self.closed = False
+        # bytes handed to the transport and how many went back as credit
+        self.written = 0
+        self.granted = 0
+        self.codec = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        transport.set_write_buffer_limits(P2P_WRITE_BATCH, P2P_WRITE_BATCH // 4)
+
+    def data_received(self, data):
+        if not self.opening and not self.backlog and len(data) <= self.window:
+            self.send(data)
+        else:
+            self.backlog += data
+            self.drain()
+
+    def eof_received(self):
+        self.eof = True
+        if self.backlog:
+            # keep the transport until the backlog has gone out
+            return True
+
+        self.close()
+
+    def connection_lost(self, exc):
+        self.close()
+
+    def send(self, data):
+        self.window -= len(data)
+        cmd = P2P_CMD_DATA
+        if self.codec is not None:
+            cmd, data = self.codec.compress(data)
+
+        self.tunnel.write_frame(self.clientid, cmd, data)
+
+    def drain(self):
+        if not self.opening:
+            while self.backlog and self.window > 0:
+                n = min(len(self.backlog), self.window, P2P_WRITE_BATCH)
+                self.send(bytes(self.backlog[:n]))
+                del self.backlog[:n]
+
+            if self.eof and not self.backlog:
+                self.close()
+                return
+
+        if self.closed:
+            return
+
+        blocked = len(self.backlog) >= self.window
+        if blocked and self.reading:
+            self.reading = False
+            self.transport.pause_reading()
+        elif not blocked and not self.reading:
+            self.reading = True
+            self.transport.resume_reading()
+
+    def open(self, window = 0):
+        """ the peer is ready, window is extra credit it grants """
+        self.opening = False
+        self.window += window
+        self.drain()
+
+    def add_window(self, count):
+        self.window += count
+        self.drain()
+
+    def deliver(self, data, compressed = False):
+        """ data from the tunnel for our socket """
+        if self.closed:
+            return
+
+        if compressed:
+            if self.codec is None:
+                logging.error('P2pStream client[%d] compression is off', self.clientid)
+                self.shutdown()
+                return
+
+            try:
+                data = self.codec.decompress(data)
+            except ValueError as ex:
+                logging.error('P2pStream client[%d] bad compressed data: %s', self.clientid, ex)
+                self.shutdown()
+                return
+            if not data:
+                return
+
+        if self.transport.get_write_buffer_size() + len(data) > self.limit:
+            logging.error('P2pStream client[%d] window overrun', self.clientid)
+            self.shutdown()
+            return
+
+        self.transport.write(data)
+        self.written += len(data)
+        self.credit()
+
+    def credit(self):
+        """ bytes that left our socket go back to the peer as window """
+        sent = self.written - self.transport.get_write_buffer_size()
+        if sent - self.granted >= self.limit // 4:
+            self.tunnel.write_frame(self.clientid, P2P_CMD_WINDOW, P2P_WINDOW.pack(sent - self.granted))
+            self.granted = sent
+
+    def resume_writing(self):
+        if not self.closed:
+            self.credit()
+
+    def close(self, logout = True):
+        """ our side is done, the peer gets P2P_CMD_LOGOUT unless logout is False """
+        if self.closed:
+            return
+
+        self.closed = True
+        if logout and self.tunnel is not None:
+            self.tunnel.write_frame(self.clientid, P2P_CMD_LOGOUT)
+
+        self.transport.close()
+        self.owner.remove_client(self.clientid)
+
+    def shutdown(self):
+        """ the peer closed the stream, queued data is still written out """
+        self.close(False)
+
+class P2pClient(P2pTunnel):
+    def __init__(self, dst, codecs = ()):
+        """
+            dst : real server host
+            codecs : compression offered to the server, preferred first
+        """
+        P2pTunnel.__init__(self)
+        self.dst = dst
+        self.codecs = codecs
+        self.clients = {}
+        # clientids whose backend connection is in progress
+        self.opening = set()
+        self.done = self.loop.create_future()
+        self.timer = None
+        self.count = 10
+
+    def connection_made(self, transport):
+        P2pTunnel.connection_made(self, transport)
+
+        login_info = P2P_LOGIN
+        if self.codecs:
+            login_info += b' ' + ','.join(self.codecs).encode()
+        self.write_frame(0, P2P_CMD_CLIENT, login_info)
+        self.timer = self.loop.call_later(1, self.ontimer)
+
+    def connection_lost(self, exc):
+        self.transport = None
+        if self.timer is not None:
+            self.timer.cancel()
+
+        self.opening.clear()
+        for stream in list(self.clients.values()):
+            stream.close(False)
+
+        if not self.done.done():
+            self.done.set_result(None)
+
+    def on_frame(self, clientid, cmd, data):
+        logging.debug('count[%d], clientid[%d], cmd[%d]', len(data), clientid, cmd)
+
+        if cmd == P2P_CMD_DATA or cmd == P2P_CMD_DATA | P2P_FLAG_COMPRESSED:
+            stream = self.clients.get(clientid)
+            if stream is not None:
+                stream.deliver(data, cmd != P2P_CMD_DATA)
+            else:
+                logging.warning('P2pClient request_data client[%d] is missing', clientid)
+        elif cmd == P2P_CMD_CLIENT:
+            # the server's pick out of our offer, empty for none
+            name = data.decode('ascii', 'replace')
+            if data and name not in self.codecs:
+                logging.error("P2pClient onread codec[%s] is error", name)
+                self.transport.close()
+                return
+
+            self.compression = name or None
+            logging.info('P2pClient compression %s', name or 'off')
+        elif cmd == P2P_CMD_LOGIN:
+            if len(data) > 0:
+                # a named service of p2pproxy.py -services, not served here
+                logging.error('P2pClient client[%d] unknown service %r', clientid, bytes(data))
+                self.write_frame(clientid, P2P_CMD_OPEN_FAIL)
+                return
+
+            logging.info('P2pClient client[%d] login', clientid)
+            self.opening.add(clientid)
+            self.loop.create_task(self.connect_client(clientid))
+        elif cmd == P2P_CMD_LOGOUT:
+            if len(data) > 0:
+                logging.error("P2pClient onread logout count[%d] is error", len(data))
+                self.transport.close()
+                return
+
+            logging.info('P2pClient client[%d] logout', clientid)
+            self.opening.discard(clientid)
+            if clientid in self.clients:
+                self.clients[clientid].shutdown()
+        elif cmd == P2P_CMD_WINDOW:
+            if len(data) != P2P_WINDOW.size:
+                logging.error("P2pClient onread window count[%d] is error", len(data))
+                self.transport.close()
+                return
+
+            if clientid in self.clients:
+                self.clients[clientid].add_window(P2P_WINDOW.unpack(data)[0])
+
+    def ontimer(self):
+        if self.count > 0:
+            self.count -= 1
+
+        if self.count == 0 and self.is_timeout(30):
+            self.write_frame(0, P2P_CMD_TIMER)
+            self.count = 10
+
+        self.timer = self.loop.call_later(1, self.ontimer)
+
+    async def connect_client(self, clientid):
+        try:
+            transport, stream = await self.loop.create_connection(
+                lambda: P2pStream(self, clientid, self), *self.dst)
+        except OSError:
+            logging.error('P2pClient failed to connect to %s', self.dst)
+            self.opening.discard(clientid)
+            self.write_frame(clientid, P2P_CMD_OPEN_FAIL)
+            return
+
+        if clientid not in self.opening:
+            # logged out while connecting, or the tunnel went down
+            stream.close(False)
+            return
+
+        self.opening.discard(clientid)
+        if self.compression:
+            stream.codec = StreamCodec(self.compression)
+        self.clients[clientid] = stream
+        self.write_frame(clientid, P2P_CMD_OPEN_OK)
+        stream.open()
+
+    def remove_client(self, clientid):
+        self.clients.pop(clientid, None)
+
+class Routes:
+    """ server side: the tunnels from the client and the streams they carry """
+    def __init__(self, tunnels = 1, codecs = None):
+        """
+            tunnels : number of tunnel connections accepted from the client
+            codecs : compression the client may pick from, None for all
+        """
+        self.size = tunnels
+        self.codecs = list(P2P_CODECS) if codecs is None else codecs
+        self.tunnels = []
+        # tunnel -> number of streams on it
+        self.load = {}
+        self.id = 0
+        # clientid -> NetServer
+        self.clients = {}
+
+    def assign(self, stream):
+        """ put a new stream on the least loaded tunnel """
+        if not self.tunnels:
+            return False
+
+        tunnel = min(self.tunnels, key = lambda t: (self.load[t], t.pending()))
+        self.load[tunnel] += 1
+        self.id += 1
+        stream.clientid = self.id
+        stream.tunnel = tunnel
+        self.clients[stream.clientid] = stream
+        return True
+
+    def remove_client(self, clientid):
+        logging.info('NetServer client[%d] logout', clientid)
+
+        stream = self.clients.pop(clientid, None)
+        if stream is not None and stream.tunnel in self.load:
+            self.load[stream.tunnel] -= 1
+
+class P2pServer(P2pTunnel):
+    """ a tunnel accepted from the client """
+    def __init__(self, routes):
+        P2pTunnel.__init__(self)
+        self.routes = routes
+        self.verified = False
+        self.timer = None
+
+    def connection_made(self, transport):
+        P2pTunnel.connection_made(self, transport)
+
+        address = transport.get_extra_info('peername')
+        logging.info("P2pServer client %s:%d connect", address[0], address[1])
+        if len(self.routes.tunnels) >= self.routes.size:
+            logging.warning('P2pServer tunnels are full.')
+            transport.close()
+            return
+
+        self.timer = self.loop.call_later(1, self.ontimer)
+
+    def connection_lost(self, exc):
+        self.transport = None
+        if self.timer is not None:
+            self.timer.cancel()
+
+        routes = self.routes
+        if self in routes.load:
+            routes.tunnels.remove(self)
+            del routes.load[self]
+
+            # only the streams carried by this tunnel go down with it
+            for stream in list(routes.clients.values()):
+                if stream.tunnel is self:
+                    stream.close(False)
+
+        logging.info('P2pServer client disconnect.')
+
+    def on_frame(self, clientid, cmd, data):
+        if not self.verified:
+            self.verify_client(clientid, cmd, data)
+            return
+
+        if cmd == P2P_CMD_DATA or cmd == P2P_CMD_DATA | P2P_FLAG_COMPRESSED:
+            stream = self.routes.clients.get(clientid)
+            if stream is not None:
+                stream.deliver(data, cmd != P2P_CMD_DATA)
+
+        elif cmd == P2P_CMD_LOGOUT:
+            if len(data) > 0:
+                logging.error("P2pServer logout count[%d] is error", len(data))
+                self.transport.close()
+                return
+
+            stream = self.routes.clients.get(clientid)
+            if stream is not None:
+                stream.shutdown()
+
+        elif cmd == P2P_CMD_TIMER:
+            self.write_frame(0, P2P_CMD_TIMER)
+            if len(data) > 0:
+                logging.error("P2pServer timer count[%d] is error", len(data))
+                self.transport.close()
+                return
+
+        elif cmd == P2P_CMD_WINDOW:
+            if len(data) != P2P_WINDOW.size:
+                logging.error("P2pServer window count[%d] is error", len(data))
+                self.transport.close()
+                return
+
+            stream = self.routes.clients.get(clientid)
+            if stream is not None:
+                stream.add_window(P2P_WINDOW.unpack(data)[0])
+
+        elif cmd == P2P_CMD_OPEN_OK or cmd == P2P_CMD_OPEN_FAIL:
+            stream = self.routes.clients.get(clientid)
+            if stream is not None:
+                stream.open_client(cmd == P2P_CMD_OPEN_OK)
+
+    def verify_client(self, clientid, cmd, data):
+        # 'test_p2p' optionally followed by the codecs the client offers
+        login = data.split(b' ', 1)
+        if cmd != P2P_CMD_CLIENT or clientid != 0 or login[0] != P2P_LOGIN:
+            logging.warning("P2pServer verify_client failed")
+            self.transport.close()
+            return
+
+        logging.info('P2pServer client login')
+        if len(self.routes.tunnels) >= self.routes.size:
+            logging.warning('P2pServer tunnels are full.')
+            self.transport.close()
+            return
+
+        if len(login) > 1:
+            offer = [c for c in login[1].decode('ascii', 'replace').split(',') if c in self.routes.codecs]
+            if offer:
+                self.compression = offer[0]
+
+            # answered ahead of any stream frame on this tunnel
+            self.write_frame(0, P2P_CMD_CLIENT, (self.compression or '').encode())
+            logging.info('P2pServer client compression %s', self.compression or 'off')
+
+        self.verified = True
+        self.routes.tunnels.append(self)
+        self.routes.load[self] = 0
+
+    def ontimer(self):
+        if self.is_timeout(120):
+            logging.warning('P2pServer client timeout')
+            self.transport.close()
+            return
+
+        self.timer = self.loop.call_later(1, self.ontimer)
+
+class NetServer(P2pStream):
+    """ a connection accepted on the proxy port """
+    def __init__(self, routes):
+        P2pStream.__init__(self, routes, window = P2P_OPEN_BUFFER)
+        self.timer = None
+
+    def connection_made(self, transport):
+        P2pStream.connection_made(self, transport)
+
+        if not self.owner.assign(self):
+            self.closed = True
+            transport.close()
+            return
+
+        address = transport.get_extra_info('peername')
+        logging.info('NetServer %s:%d connect.', address[0], address[1])
+
+        if self.tunnel.compression:
+            self.codec = StreamCodec(self.tunnel.compression)
+        self.tunnel.write_frame(self.clientid, P2P_CMD_LOGIN)
+        self.timer = self.tunnel.loop.call_later(P2P_OPEN_TIMEOUT, self.open_timeout)
+
+    def open_client(self, ok):
+        if not self.opening:
+            return
+
+        self.timer.cancel()
+        if not ok:
+            logging.warning('NetServer client[%d] open failed', self.clientid)
+            self.shutdown()
+            return
+
+        self.open(P2P_STREAM_WINDOW - P2P_OPEN_BUFFER)
+
+    def open_timeout(self):
+        if self.opening and not self.closed:
+            logging.warning('NetServer client[%d] open timeout', self.clientid)
+            self.close()
+
+    def close(self, logout = True):
+        if self.timer is not None:
+            self.timer.cancel()
+
+        P2pStream.close(self, logout)
+
+async def client_loop(p2phost, serverhost, tunnels = 1, codecs = ()):
+    loop = asyncio.get_event_loop()
+
+    async def connect():
+        delay = P2P_RECONNECT_MIN
+        while True:
+            client = P2pClient(serverhost, codecs)
+            try:
+                await loop.create_connection(lambda: client, *p2phost)
+            except OSError:
+                logging.error('P2pClient failed to connect to %s', p2phost)
+            else:
+                logging.info('P2pClient connect to server %s', p2phost)
+                delay = P2P_RECONNECT_MIN
+                await client.done
+                logging.info('P2pClient disconnect to server %s', p2phost)
+
+            # tunnels that dropped together do not all come back at once
+            await asyncio.sleep(delay / 2 + random.uniform(0, delay / 2))
+            delay = min(delay * 2, P2P_RECONNECT_MAX)
+
+    # one P2pClient per tunnel connection, the server keeps each
+    # stream on one tunnel so they do not share any state
+    await asyncio.gather(*[connect() for i in range(tunnels)])
+
+async def server_loop(p2phost, proxyhost, tunnels = 1, codecs = None):
+    loop = asyncio.get_event_loop()
+    routes = Routes(tunnels, codecs)
+
+    p2pserver = await loop.create_server(lambda: P2pServer(routes), *p2phost)
+    netserver = await loop.create_server(lambda: NetServer(routes), *proxyhost)
+
+    await asyncio.gather(p2pserver.serve_forever(), netserver.serve_forever())
+
+def main():
+    s = """
+            Usage:
+            client mode: p2pproxy3 -c -p2p=host1 -server=host2 [-tunnels=N] [-compress=codecs]
+            server mode: p2pproxy3 -s -p2p=host1 -server=host2 [-tunnels=N] [-compress=codecs]
+            both modes: [-log=path] [-loglevel=level] [-loop=asyncio|uvloop]
+
+            Same tunnel protocol and options as p2pproxy.py, the other side
+            may run either. -workers, -pool, -stats and -lograte are only
+            in p2pproxy.py.
+
+            host: ip:port
+            tunnels: parallel tunnel connections, default 1
+            compress: comma separated %s. The client offers them in
+                      order, default none. The server accepts these,
+                      default all.
+            log: log file, - for stderr, off for none, default p2pproxy.log
+            loglevel: debug, info, warning or error, default info
+            loop: event loop, default uvloop when it is installed
+        """ % '/'.join(sorted(P2P_CODECS))
+    args = sys.argv[1:]
+    if len(args) < 2:
+        sys.exit(s)
+
+    params = {}
+    server_mode = True
+
+    for arg in args:
+        if len(arg) > 1 and arg[0] == '-':
+            arr = arg[1:].split('=')
+            if len(arr) == 1 and len(arg) == 2:
+                if arg[1] == 'C' or arg[1] == 'c':
+                    server_mode = False
+                elif arg[1] == 'S' or arg[1] == 's':
+                    server_mode = True
+            elif len(arr) == 2:
+                params[arr[0]] = arr[1]
+
+    if len(params) < 2 or 'p2p' not in params or 'server' not in params:
+        sys.exit(s)
+
+    for name in ('workers', 'pool', 'stats', 'lograte'):
+        if name in params:
+            sys.exit('-%s is not supported by p2pproxy3, use p2pproxy.py' % name)
+
+    p2p = parse_address(params['p2p'])
+    server = parse_address(params['server'])
+    tunnels = int(params.get('tunnels', 1))
+    codecs = None
+    if 'compress' in params:
+        codecs = [c for c in params['compress'].split(',') if c]
+        for c in codecs:
+            if c not in P2P_CODECS:
+                sys.exit('Unknown codec %r, have %s' % (c, ','.join(sorted(P2P_CODECS))))
+
+    level = params.get('loglevel', 'info').upper()
+    if level not in ('DEBUG', 'INFO', 'WARNING', 'ERROR'):
+        sys.exit(s)
+    listener = setup_logging(params.get('log', 'p2pproxy.log'), getattr(logging, level))
+
+    loop_name = params.get('loop', 'uvloop' if uvloop is not None else 'asyncio')
+    if loop_name == 'uvloop':
+        if uvloop is None:
+            sys.exit('uvloop is not installed')
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    elif loop_name != 'asyncio':
+        sys.exit(s)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, loop.stop)
+
+    if server_mode:
+        print('start p2p server (%s)' % loop_name)
+        task = loop.create_task(server_loop(p2p, server, tunnels, codecs))
+    else:
+        print('start p2p client (%s)' % loop_name)
+        task = loop.create_task(client_loop(p2p, server, tunnels, codecs or ()))
+
+    # stopped by a signal, or the listen ports could not be bound
+    task.add_done_callback(lambda t: loop.stop())
+    try:
+        loop.run_forever()
+    finally:
+        if task.done() and not task.cancelled() and task.exception() is not None:
+            logging.error('p2pproxy3 %s', task.exception())
+            sys.exit(str(task.exception()))
+
+        if listener is not None:
+            listener.stop()
+
+if __name__ == '__main__':
+    main()